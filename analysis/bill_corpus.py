@@ -0,0 +1,75 @@
+# A compact, cached form of the sponsorship data in the bill data.xml files
+# of a Congress, for analysis scripts that would otherwise glob and parse
+# every bill file each time they run.
+#
+# Each bill is a dict with:
+#   bill_type: the bill type slug, e.g. "hr" or "sres"
+#   number: the bill number
+#   sponsor: the sponsor's GovTrack person ID, or None
+#   introduced: the introduced/@datetime string
+#   cosponsors: a list of (person ID, joined string, withdrawn string or None)
+#
+# The parsed corpus is pickled per Congress and reused until a bill file is
+# added, removed, or modified.
+
+import glob
+import os
+import pickle
+
+import lxml.etree
+
+CORPUS_PATH = "data/analysis/by-congress/%d/bill_corpus.pickle"
+CORPUS_VERSION = 1 # increment when the record format changes
+
+def get_bill_files(congressnumber):
+	return sorted(glob.glob("data/congress/%d/bills/*/*/data.xml" % congressnumber))
+
+def get_signature(files):
+	# Changes when any bill file is added, removed, or modified.
+	max_mtime = 0
+	total_size = 0
+	for fn in files:
+		st = os.stat(fn)
+		max_mtime = max(max_mtime, st.st_mtime_ns)
+		total_size += st.st_size
+	return (CORPUS_VERSION, len(files), max_mtime, total_size)
+
+def parse_bill_file(fn):
+	xml = lxml.etree.parse(fn)
+	spx = xml.xpath("sponsor/@id")
+	introduced = xml.xpath("introduced/@datetime")
+	return {
+		"bill_type": os.path.basename(os.path.dirname(os.path.dirname(fn))), # data/congress/{congress}/bills/{bill_type}/{bill_type}{number}/data.xml
+		"number": int(xml.xpath("string(@number)") or 0),
+		"sponsor": int(spx[0]) if spx else None, # e.g. debt limit with no sponsor
+		"introduced": introduced[0] if introduced else None,
+		"cosponsors": [
+			(int(node.get("id")), node.get("joined", ""), node.get("withdrawn"))
+			for node in xml.xpath("cosponsors/cosponsor")
+		],
+	}
+
+def load_bill_corpus(congressnumber, force=False):
+	# Returns the list of bills in the Congress, parsing the bill files only
+	# if the cached corpus is missing or out of date.
+	files = get_bill_files(congressnumber)
+	signature = get_signature(files)
+	cache_fn = CORPUS_PATH % congressnumber
+	if not force:
+		try:
+			with open(cache_fn, "rb") as f:
+				cached = pickle.load(f)
+			if cached["signature"] == signature:
+				return cached["bills"]
+		except (IOError, EOFError, pickle.UnpicklingError, KeyError):
+			pass
+
+	bills = [parse_bill_file(fn) for fn in files]
+
+	os.makedirs(os.path.dirname(cache_fn), exist_ok=True)
+	tmp_fn = "%s.%d.tmp" % (cache_fn, os.getpid())
+	with open(tmp_fn, "wb") as f:
+		pickle.dump({ "signature": signature, "bills": bills }, f, protocol=pickle.HIGHEST_PROTOCOL)
+	os.replace(tmp_fn, cache_fn)
+
+	return bills
@@ -20,14 +20,27 @@ writer.writerow(["date", "description", "url"] + [p.name.encode("utf8") for p in
 votes = Vote.objects.filter(voters__person=people[0]).order_by('created')
 
 # Map each person to a mapping from all votes they participated in to how they
-# voted on it (a VoteOption id).
-pvotes = {
-	p: {
-		vote_id: option_id
-		for vote_id, option_id in Voter.objects.filter(person=p).exclude(option__key="0").values_list('vote', 'option')
-	}
-	for p in people
-}
+# voted on it (a VoteOption id), slicing their columns out of the vote matrix
+# store of each Congress and chamber that the first person voted in. Votes
+# that aren't up to date in the store are queried from the database.
+from vote.matrix_store import load_matrix, get_stored_row, get_person_votes
+votes = list(votes)
+matrices = { }
+stale_vote_ids = []
+for vote in votes:
+	if (vote.congress, vote.chamber) not in matrices:
+		matrices[(vote.congress, vote.chamber)] = load_matrix(vote.congress, vote.chamber)
+	if get_stored_row(matrices[(vote.congress, vote.chamber)], vote) is None:
+		stale_vote_ids.append(vote.id)
+pvotes = { p: { } for p in people }
+for p in people:
+	for matrix in matrices.values():
+		if matrix is not None:
+			pvotes[p].update(get_person_votes(matrix, p.id, skip_options=("0",)))
+	for vote_id in stale_vote_ids:
+		pvotes[p].pop(vote_id, None)
+	for i in range(0, len(stale_vote_ids), 500):
+		pvotes[p].update(Voter.objects.filter(person=p, vote__in=stale_vote_ids[i:i+500]).exclude(option__key="0").values_list('vote', 'option'))
 
 # Filter down the votes to those that all people voted in. We repeat person[0]
 # because the not-voting filter is applied only in pvotes but not in votes.
@@ -35,7 +48,7 @@ for p in people:
 	votes = filter(lambda v : v.id in pvotes[p], votes)
 
 # Load all of the option objects in bulk and turn into a mapping from ids to objects.
-options = VoteOption.objects.filter(id__in=sum([pv.values() for pv in pvotes.values()], []))
+options = VoteOption.objects.filter(id__in=sum([list(pv.values()) for pv in pvotes.values()], []))
 options = { option.id: option for option in options }
 
 # Loop over the votes that all of the people participated in.
@@ -12,19 +12,18 @@ from collections import defaultdict
 
 from vote.models import Vote
 from vote.views import get_vote_outliers, attach_ideology_scores
+from vote.matrix_store import iter_vote_voters
 
 tqdm = lambda x : x
 if sys.stdout.isatty():
     from tqdm import tqdm
 
 congress = int(sys.argv[1])
-votes_to_process = Vote.objects.filter(congress=congress).order_by('created').values_list("id", flat=True)
+votes_to_process = Vote.objects.filter(congress=congress).order_by('created')
 rows = []
 
-for vid in tqdm(votes_to_process):
-    v = Vote.objects.get(id=vid)
-    voters = v.get_voters()
-
+# get the voters from the vote matrix store a chunk of votes at a time
+for v, voters in tqdm(iter_vote_voters(votes_to_process)):
     # attach ideology scores - used by get_vote_outliers
     attach_ideology_scores(voters, v.congress)
 
@@ -6,8 +6,9 @@
 # rank the results across subsets of Members to contextualize
 # the information.
 
-import sys, json, re
+import sys, json, re, time
 
+import numpy
 import us
 import datetime # implicitly used in eval()'ing dates inside major_actions
 
@@ -16,9 +17,66 @@ from bill.models import Cosponsor, Bill, BillStatus, RelatedBill, BillType
 from vote.models import Vote, Voter, CongressChamber
 from committee.models import CommitteeMemberRole
 
+from django.db.models import Count
+
 competitive_seats = None
 
-def get_cohorts(person, role, congress, session, committee_membership):
+def count_by(queryset, *fields):
+	# Count the rows of the queryset grouped by the fields in one query.
+	# Returns a dict from the field value (or tuple of values if more
+	# than one field) to the count.
+	counts = { }
+	for row in queryset.order_by().values_list(*fields).annotate(count=Count("id")):
+		counts[row[:-1] if len(fields) > 1 else row[0]] = row[-1]
+	return counts
+
+def prefetch_session_data(people, congress, startdate, enddate, votes_this_year):
+	# Rather than query for each Member's statistics separately, get
+	# everything we need for all Members with a few grouped queries.
+	data = { }
+	person_ids = [person.id for person, role in people]
+
+	# All of the roles of these Members, for cohorts.
+	data["roles"] = { }
+	for r in PersonRole.objects.filter(person__in=person_ids, role_type__in=(RoleType.representative, RoleType.senator)):
+		data["roles"].setdefault(r.person_id, []).append(r)
+
+	# Eligible and missed votes by Member in each chamber.
+	data["votes_elligible"] = { }
+	data["votes_missed"] = { }
+	for role_type, votes in votes_this_year.items():
+		voters = Voter.objects.filter(vote__in=votes, person__in=person_ids)
+		data["votes_elligible"][role_type] = count_by(voters, "person")
+		data["votes_missed"][role_type] = count_by(voters.filter(option__key="0"), "person")
+
+	# Cosponsorships that were joined in this time window by sponsor and by
+	# cosponsor, and by cosponsor and the party of the sponsor.
+	cosponsors = Cosponsor.objects.filter(bill__congress=congress, joined__gte=startdate, joined__lte=enddate)
+	data["cosponsors"] = count_by(cosponsors, "bill__sponsor")
+	data["cosponsored"] = count_by(cosponsors, "person")
+	data["cosponsored_by_sponsor_party"] = { }
+	for (person_id, sponsor_party), count in count_by(cosponsors, "person", "bill__sponsor_role__party").items():
+		data["cosponsored_by_sponsor_party"].setdefault(person_id, { })[sponsor_party] = count
+
+	# The bills the Members introduced in this time window, in the usual bill
+	# order, and the things we look at for each bill.
+	bills = list(Bill.objects.filter(sponsor__in=person_ids, congress=congress,
+		introduced_date__gte=startdate, introduced_date__lte=enddate)
+		.select_related("sponsor_role")
+		.prefetch_related("committees"))
+	data["bills"] = { }
+	for bill in bills:
+		data["bills"].setdefault(bill.sponsor_id, []).append(bill)
+	data["bill_cosponsors"] = { }
+	for cosponsor in Cosponsor.objects.filter(bill__in=bills, joined__gte=startdate, joined__lte=enddate).select_related("role"):
+		data["bill_cosponsors"].setdefault(cosponsor.bill_id, []).append(cosponsor)
+	data["bills_with_companion"] = set(RelatedBill.objects.filter(bill__in=bills, relation="identical",
+		related_bill__introduced_date__gte=startdate, related_bill__introduced_date__lte=enddate)
+		.values_list("bill_id", flat=True))
+
+	return data
+
+def get_cohorts(person, role, congress, session, committee_membership, session_data):
 	cohorts = []
 
 	# chamber
@@ -42,7 +100,8 @@ def get_cohorts(person, role, congress, session, committee_membership):
 	prev_congresses_served = set()
 	# use enddate__lte=endate to include the current role itself since for
 	# senators their current role may span previous congresses
-	for r in PersonRole.objects.filter(person=person, role_type=role.role_type, enddate__lte=role.enddate):
+	for r in session_data["roles"].get(person.id, []):
+		if r.role_type != role.role_type or r.enddate > role.enddate: continue
 		if not min_start_date or r.startdate < min_start_date: min_start_date = r.startdate
 		years_served += round( (min(r.enddate,datetime.datetime.now().date())-r.startdate).days / 365.25 ) # end dates for senators may be far in the future; round because terms may be slightly less than a year
 		for c in r.congress_numbers():
@@ -95,13 +154,11 @@ def get_cohorts(person, role, congress, session, committee_membership):
 	return cohorts
 
 
-def get_vote_stats(person, role, stats, votes_this_year):
+def get_vote_stats(person, role, stats, session_data):
 	# Missed vote % in the chamber that the Member is currently serving in.
 	if role.leadership_title == "Speaker": return
-	votes_elligible = Voter.objects.filter(person=person, vote__in=votes_this_year[role.role_type])
-	votes_missed = votes_elligible.filter(option__key="0")
-	v1 = votes_elligible.count()
-	v2 = votes_missed.count()
+	v1 = session_data["votes_elligible"][role.role_type].get(person.id, 0)
+	v2 = session_data["votes_missed"][role.role_type].get(person.id, 0)
 	stats["missed-votes"] = {
 		"value": round(100.0*v2/v1, 3) if v1 > 0 else None,
 		"elligible": v1,
@@ -110,12 +167,11 @@ def get_vote_stats(person, role, stats, votes_this_year):
 	}
 
 
-def get_sponsor_stats(person, role, stats, congress, startdate, enddate, committee_membership):
+def get_sponsor_stats(person, role, stats, congress, startdate, enddate, committee_membership, session_data):
 	# How many bills did the Member introduce during this time window?
-	bills = Bill.objects.filter(sponsor=person, congress=congress,
-		introduced_date__gte=startdate, introduced_date__lte=enddate)
+	bills = session_data["bills"].get(person.id, [])
 	stats["bills-introduced"] = {
-		"value": bills.count(),
+		"value": len(bills),
 	}
 
 	# How many bills were "enacted" within this time window? Follow the was_enacted_ex logic
@@ -144,7 +200,6 @@ def get_sponsor_stats(person, role, stats, congress, startdate, enddate, committ
 	# time window so that if we re-run this script on the same window at a
 	# later date nothing changes -- i.e. future activitiy on bills should
 	# not affect 1st Session statistics. Mostly.
-	bills = list(bills)
 	was_reported = []
 	has_cmte_leaders = []
 	can_has_bipartisan_cosponsor = False
@@ -177,11 +232,11 @@ def get_sponsor_stats(person, role, stats, congress, startdate, enddate, committ
 
 		# Check whether any cosponsors are on relevant committees.
 		# Warning: Committee membership data is volatile, so re-running the stats may come out different.
-		cosponsors = list(Cosponsor.objects.filter(bill=bill, joined__gte=startdate, joined__lte=enddate).select_related("person", "role"))
+		cosponsors = session_data["bill_cosponsors"].get(bill.id, [])
 		x = False
-		for committee in list(bill.committees.all()):
+		for committee in bill.committees.all():
 			for cosponsor in cosponsors:
-				if committee_membership.get(cosponsor.person.id, {}).get(committee.code) in (CommitteeMemberRole.ranking_member, CommitteeMemberRole.vice_chair, CommitteeMemberRole.chair):
+				if committee_membership.get(cosponsor.person_id, {}).get(committee.code) in (CommitteeMemberRole.ranking_member, CommitteeMemberRole.vice_chair, CommitteeMemberRole.chair):
 					x = True
 		if x: has_cmte_leaders.append(bill)
 
@@ -202,7 +257,7 @@ def get_sponsor_stats(person, role, stats, congress, startdate, enddate, committ
 						break
 
         # Check if a companion bill was introduced during the time period.
-		if RelatedBill.objects.filter(bill=bill, relation="identical", related_bill__introduced_date__gte=startdate, related_bill__introduced_date__lte=enddate).exists():
+		if bill.id in session_data["bills_with_companion"]:
 			has_companion.append(bill)
 
 
@@ -229,27 +284,28 @@ def get_sponsor_stats(person, role, stats, congress, startdate, enddate, committ
 		"bills": make_bill_entries(has_companion),
 	}
 
-def get_cosponsor_stats(person, role, stats, congress, startdate, enddate):
+def get_cosponsor_stats(person, role, stats, session_data):
 	# Count of cosponsors on the Member's bills with a join date in this session.
-	cosponsors = Cosponsor.objects.filter(bill__sponsor=person, bill__congress=congress, joined__gte=startdate, joined__lte=enddate)
 	stats["cosponsors"] = {
-		"value": cosponsors.count(),
+		"value": session_data["cosponsors"].get(person.id, 0),
 	}
 
-def get_cosponsored_stats(person, role, stats, congress, startdate, enddate):
+def get_cosponsored_stats(person, role, stats, session_data):
 	# Count of bills this person cosponsored.
-	cosponsored = Cosponsor.objects.filter(person=person, bill__congress=congress, joined__gte=startdate, joined__lte=enddate)
+	cosponsored = session_data["cosponsored"].get(person.id, 0)
 	stats["cosponsored"] = {
-		"value": cosponsored.count(),
+		"value": cosponsored,
 	}
 
-	# Of those bills, how many sponsored by a member of the other party.
-	if role.party in ("Democrat", "Republican") and cosponsored.count() > 10:
-		cosponsored_bi = cosponsored.exclude(bill__sponsor_role__party=role.party)
+	# Of those bills, how many sponsored by a member of the other party
+	# (or whose sponsor's party is unknown).
+	if role.party in ("Democrat", "Republican") and cosponsored > 10:
+		cosponsored_bi = sum(count for sponsor_party, count in session_data["cosponsored_by_sponsor_party"].get(person.id, {}).items()
+			if sponsor_party != role.party)
 		stats["cosponsored-other-party"] = {
-			"value": 100.0 * float(cosponsored_bi.count()) / float(cosponsored.count()),
-			"cosponsored": cosponsored.count(),
-			"cosponsored_other_party": cosponsored_bi.count(),
+			"value": 100.0 * float(cosponsored_bi) / float(cosponsored),
+			"cosponsored": cosponsored,
+			"cosponsored_other_party": cosponsored_bi,
 		}
 
 
@@ -259,16 +315,15 @@ def run_sponsorship_analysis(people, congress, startdate, enddate):
 	# stats we just want to look at activity during this year. This puts freshmen
 	# Members on a more equal footing.
 	global sponsorship_analysis_data
-	from analysis.sponsorship_analysis import get_people, build_matrix, smooth_matrix, build_party_list, ideology_analysis, leadership_analysis
+	from analysis.sponsorship_analysis import get_people, build_matrix, build_party_list, ideology_analysis, leadership_analysis
 	sponsorship_analysis_data = { }
 	peoplemap, people_list = get_people([role for (person,role) in people])
 	for chamber, role_type in (('h', RoleType.representative), ('s', RoleType.senator)):
 		bills_start_date, bills_end_date, rep_to_row, nreps, P = build_matrix(
 			congress, congress, chamber, peoplemap, people_list,
 			filter_startdate=startdate.isoformat(), filter_enddate=enddate.isoformat())
-		smooth_matrix(nreps, P)
 		parties = build_party_list(rep_to_row, peoplemap, nreps)
-		spectrum = ideology_analysis(nreps, parties, P)
+		spectrum, spectrum2 = ideology_analysis(nreps, parties, P)
 		pagerank = leadership_analysis(nreps, P)
 		for id, index in rep_to_row.items():
 			sponsorship_analysis_data[ (role_type, id) ] = (spectrum[index], pagerank[index])
@@ -392,10 +447,12 @@ def collect_stats(session):
 	if session:
 		votes_this_year = votes_this_year.filter(session=session)
 	votes_this_year = {
-		RoleType.representative: set(votes_this_year.filter(chamber=CongressChamber.house).values_list("id", flat=True)),
-		RoleType.senator: set(votes_this_year.filter(chamber=CongressChamber.senate).values_list("id", flat=True)),
+		RoleType.representative: votes_this_year.filter(chamber=CongressChamber.house),
+		RoleType.senator: votes_this_year.filter(chamber=CongressChamber.senate),
 	}
 
+	# Pre-fetch everything else that the statistics are computed from.
+	session_data = prefetch_session_data(people, congress, startdate, enddate, votes_this_year)
 
 	# Generate raw statistics.
 	AllStats = { }
@@ -409,14 +466,14 @@ def collect_stats(session):
 			"role_end": role.enddate.isoformat(),
 
 			"stats": { },
-			"cohorts": get_cohorts(person, role, congress, session2, committee_membership),
+			"cohorts": get_cohorts(person, role, congress, session2, committee_membership, session_data),
 		}
 
 		stats = AllStats[person.id]["stats"]
-		get_vote_stats(person, role, stats, votes_this_year)
-		get_sponsor_stats(person, role, stats, congress, startdate, enddate, committee_membership)
-		get_cosponsor_stats(person, role, stats, congress, startdate, enddate)
-		get_cosponsored_stats(person, role, stats, congress, startdate, enddate)
+		get_vote_stats(person, role, stats, session_data)
+		get_sponsor_stats(person, role, stats, congress, startdate, enddate, committee_membership, session_data)
+		get_cosponsor_stats(person, role, stats, session_data)
+		get_cosponsored_stats(person, role, stats, session_data)
 		get_sponsorship_analysis_stats(person, role, stats)
 		get_committee_stats(person, role, stats, committee_membership)
 		#get_transparency_stats(person, role, stats, congress, startdate, enddate)
@@ -427,46 +484,71 @@ def contextualize(stats):
 	# For each statistic compute ranks and percentiles within
 	# each cohort.
 
-	# collect all of the data
+	# collect all of the data: for each cohort and statistic, the
+	# values of the members of the cohort and where to put their context
 	population = { }
-	for id, moc in stats.items():
-		# what cohots is the member a member of?
-		for cohort in moc["cohorts"]:
-			for stat in moc["stats"]:
-				value = moc["stats"][stat].get("value")
-				if value is not None:
-					population.setdefault( (cohort["key"], stat), [] ).append(value)
-
-	# now go back over it and for each statistic gathered paste
-	# in the context by cohort
 	for moc in stats.values():
 		for statname, statinfo in moc["stats"].items():
 			value = statinfo.get("value")
 			if value is None: continue
 			statinfo["context"] = { }
+			# what cohots is the member a member of?
 			for cohort in moc["cohorts"]:
-				pop = population[(cohort["key"], statname)]
-
-				# don't bother with context for very small cohorts
-				if len(pop) < 6: continue
-
-				context = statinfo["context"].setdefault(cohort["key"], { })
-
-				# count individuals in the cohort population with a lower value
-				num_ties = sum(1 if v == value else 0 for v in pop) - 1 # minus himself
-				context["rank_ascending"] = sum(1 if v < value else 0 for v in pop) + 1
-				context["rank_descending"] = sum(1 if v > value else 0 for v in pop) + 1
-				context["rank_ties"] = num_ties
-				context["percentile"] = int(round(100 * sum(1 if v < value else 0 for v in pop) / float(len(pop))))
-				context["N"] = len(pop)
-				context["min"] = min(pop)
-				context["max"] = max(pop)
-
-
+				values, statinfos = population.setdefault( (cohort["key"], statname), ([], []) )
+				values.append(value)
+				statinfos.append(statinfo)
+
+	# now rank each cohort's population at once and paste in the
+	# context for each member
+	for (cohort_key, statname), (values, statinfos) in population.items():
+		# don't bother with context for very small cohorts
+		N = len(values)
+		if N < 6: continue
+
+		# count individuals in the cohort population with a lower value,
+		# and with a lower or equal value, by binary search on the sorted values
+		x = numpy.array(values)
+		pop = numpy.sort(x)
+		num_lower = numpy.searchsorted(pop, x, side="left").tolist()
+		num_lower_or_equal = numpy.searchsorted(pop, x, side="right").tolist()
+		min_value = min(values)
+		max_value = max(values)
+
+		for statinfo, lt, le in zip(statinfos, num_lower, num_lower_or_equal):
+			statinfo["context"][cohort_key] = {
+				"rank_ascending": lt + 1,
+				"rank_descending": N - le + 1,
+				"rank_ties": le - lt - 1, # minus himself
+				"percentile": int(round(100 * lt / float(N))),
+				"N": N,
+				"min": min_value,
+				"max": max_value,
+			}
+
+def check_contextualize(fn):
+	# Re-compute the context in a previously generated stats file and check
+	# that it comes out the same.
+	with open(fn) as f:
+		expected = json.load(f)["people"]
+	stats = json.loads(json.dumps(expected))
+	for moc in stats.values():
+		for statinfo in moc["stats"].values():
+			statinfo.pop("context", None)
+	start = time.time()
+	contextualize(stats)
+	print("contextualized %d Members in %.2f seconds" % (len(stats), time.time() - start), file=sys.stderr)
+	if json.dumps(stats, sort_keys=True) != json.dumps(expected, sort_keys=True):
+		raise ValueError("context does not match " + fn)
+	print("context matches", fn, file=sys.stderr)
 
 if __name__ == "__main__":
 	# What Congress (113, 114, 115...) or session (2015, 2017, ...)?
 	congress_or_session = sys.argv[1]
+	if congress_or_session == "check":
+		# check that contextualize reproduces the given stats files
+		for fn in sys.argv[2:]:
+			check_contextualize(fn)
+		sys.exit(0)
 	try:
 		notes = sys.argv[2]
 	except:
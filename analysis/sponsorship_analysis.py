@@ -20,16 +20,17 @@ import sys
 import csv
 import json
 import os
-import glob
-import math
+import time
 import numpy
+import scipy.sparse
+import scipy.sparse.linalg
 import scipy.stats
-import lxml.etree as lxml
 
 from person.models import PersonRole
 from person.types import RoleType
 from bill.models import Bill, Cosponsor
 from us import get_congress_dates
+from analysis.bill_corpus import load_bill_corpus
 
 import matplotlib
 matplotlib.use('Agg')
@@ -44,7 +45,7 @@ matplotlib.rcParams["lines.markersize"] = 3
 
 def onenorm(u):
 	# The one-norm.
-	return sum(abs(u))
+	return numpy.abs(u).sum()
 
 def rescale(u, log=False):
 	# Re-scale the vector to range from 0 to 1, and convert it out of
@@ -110,6 +111,14 @@ def attach_other_stats(congressnumber, person_role):
 
 
 def build_matrix(congressnumber, starting_congress, house_or_senate, people, people_list, filter_startdate=None, filter_enddate=None):
+	# Scan the indicated and the previous congress, but include only those
+	# Members of Congress that served in the indicated Congress.
+	bills = []
+	for cn in range(starting_congress, congressnumber+1):
+		bills.extend(load_bill_corpus(cn))
+	return build_matrix_from_corpus(bills, house_or_senate, people_list, filter_startdate=filter_startdate, filter_enddate=filter_enddate)
+
+def build_matrix_from_corpus(bills, house_or_senate, people_list, filter_startdate=None, filter_enddate=None):
 	start_date = None
 	end_date = None
 	
@@ -121,73 +130,66 @@ def build_matrix(congressnumber, starting_congress, house_or_senate, people, peo
 		return rep_to_row[id]
 		
 	# Store a flat (i.e. sparse) list of all cells that have the value 1. Note that
-	# we will get duplicates here! Scan the indicated and the previous congress,
-	# but include only those Members of Congress that served in the indicated
-	# Congress.
-	cells = []
-	for cn in range(starting_congress, congressnumber+1):
-		for billfilename in glob.glob("data/congress/{congress}/bills/{chamber}*/*/data.xml".format(congress=cn, chamber=house_or_senate)):
-			xml = lxml.parse(billfilename)
-			
-			# get the sponsor
-			spx = xml.xpath("sponsor/@id")
-			if len(spx) == 0: # e.g. debt limit with no sponsor
-				continue
-			if not int(spx[0]) in people_list[house_or_senate]:
-				continue
-			sponsor = rownum(int(spx[0]))
-
-			# loop through the cosponsors
-			has_entry = False
-			for cosponsor_node in xml.xpath("cosponsors/cosponsor"):
-				# get the cosponsor's ID
-				cosponsor_id = int(cosponsor_node.xpath("string(@id)"))
-				if cosponsor_id not in people_list[house_or_senate]: continue
-
-				# if a date filter is specified, only take cosponsors that joined within
-				# the date range (inclusive)
-				if filter_startdate:
-					join_date = cosponsor_node.xpath("string(@joined)")
-					if join_date < filter_startdate or join_date > filter_enddate:
-						continue
-
-				# add an entry to the flat list of sponsor-cosponsor pairs
-				cosponsor = rownum(cosponsor_id)
-				cells.append( (sponsor, cosponsor) )
-				has_entry = True
-
-			# if there was a sponsor/cosponsor pair from this bill, extend the
-			# start_date/end_date range to cover the introduced date of this bill.
-			if has_entry:
-				date = xml.xpath("introduced/@datetime")[0]
-				start_date = min(start_date, date) if start_date else date
-				end_date = max(end_date, date) if end_date else date
+	# we will get duplicates here!
+	rows = []
+	cols = []
+	members = people_list[house_or_senate]
+	for bill in bills:
+		if not bill["bill_type"].startswith(house_or_senate):
+			continue
+
+		# get the sponsor
+		if bill["sponsor"] is None: # e.g. debt limit with no sponsor
+			continue
+		if not bill["sponsor"] in members:
+			continue
+		sponsor = rownum(bill["sponsor"])
+
+		# loop through the cosponsors
+		has_entry = False
+		for cosponsor_id, join_date, withdrawn_date in bill["cosponsors"]:
+			if cosponsor_id not in members: continue
+
+			# if a date filter is specified, only take cosponsors that joined within
+			# the date range (inclusive)
+			if filter_startdate:
+				if join_date < filter_startdate or join_date > filter_enddate:
+					continue
+
+			# add an entry to the flat list of sponsor-cosponsor pairs
+			rows.append(sponsor)
+			cols.append(rownum(cosponsor_id))
+			has_entry = True
+
+		# if there was a sponsor/cosponsor pair from this bill, extend the
+		# start_date/end_date range to cover the introduced date of this bill.
+		if has_entry:
+			date = bill["introduced"]
+			start_date = min(start_date, date) if start_date else date
+			end_date = max(end_date, date) if end_date else date
 	
 	# In the event a member of congress neither sponsored nor cosponsored
 	# a bill, just give them an empty slot.
-	for person in people_list[house_or_senate]:
+	for person in sorted(members):
 		rownum(person)
 
 	# Get total number of members of congress seen.
 	nreps = len(rep_to_row)
 	
-	# Turn this into a dense numpy array with cells flagged as 1 if there is such
-	# a transition. Keep adding 1s... Start with the identity matrix because
-	# every rep should be counted as sponsoring his own bills.
-	P = numpy.identity(nreps, float) # numpy.zeros( (nreps,nreps) )
-	for sponsor, cosponsor in cells:
-		P[sponsor, cosponsor] += 1.0
+	# Turn this into a sparse matrix counting the transitions (duplicate
+	# cells are summed). Add the identity matrix because every rep should
+	# be counted as sponsoring his own bills.
+	P = scipy.sparse.coo_matrix((numpy.ones(len(rows)), (rows, cols)), shape=(nreps, nreps)).tocsr()
+	P = P + scipy.sparse.identity(nreps, format="csr")
 
 	# Take the square root of each cell to flatten out outliers where one person
 	# cosponsors a lot of other people's bills.
-	for i in range(nreps):
-		for j in range(nreps):
-			P[i,j] = math.sqrt(P[i,j])
+	P = P.sqrt()
 
 	return start_date, end_date, rep_to_row, nreps, P
 
 def normalize_matrix(nreps, P):
-	P = numpy.copy(P)
+	P = P.toarray()
 
 	# When we use raw counts, the numbers are not distributed around zero so the
 	# first principle component is a raw shift in the positive direction. This
@@ -213,10 +215,12 @@ def ideology_analysis(nreps, parties, P):
 
 	# Run a singular value decomposition to get a rank-reduction. The second
 	# principle component correlates well with independent judgements of
-	# where legislators are on a political right-left scale.
-	u, s, vh = numpy.linalg.svd(P)
-	spectrum = vh[1,:]
-	spectrum2 = vh[0,:]
+	# where legislators are on a political right-left scale. Only the top
+	# two components are needed. (svds returns them in ascending order.)
+	u, s, vh = scipy.sparse.linalg.svds(scipy.sparse.csr_matrix(P, dtype=float), k=2)
+	order = numpy.argsort(-s)
+	spectrum = vh[order[1],:]
+	spectrum2 = vh[order[0],:]
 
 	# The singular values tell us the significane of the components.
 	#print(s[0:10])
@@ -224,8 +228,7 @@ def ideology_analysis(nreps, parties, P):
 	# To make the spectrum left-right, we'll multiply the scores by the sign of
 	# the mean score of the Republicans to put them on the right.
 	# Actually, since scale doesn't matter, just multiply it by the mean.
-	R_scores = [spectrum[i] for i in range(nreps) if parties[i] == "Republican"]
-	R_score_mean = sum(R_scores)/len(R_scores)
+	R_score_mean = spectrum[numpy.array(parties) == "Republican"].mean()
 	spectrum = spectrum * R_score_mean
 
 	# Scale the values from 0 to 1.
@@ -241,14 +244,16 @@ def leadership_analysis(nreps, P):
 	# identity matrix so even MoCs that only cosponsor their own bills
 	# have some data. But if they have so little data, we should fudge
 	# it because if they only 'cosponsor' their own bills they will get
-	# leadership scores of 0.5.
-	for col in range(nreps):
-		s = sum(P[:,col])
-		if s == 0: raise ValueError()
-		if s < 10: # min number of cosponsorship data per person
-			P[:,col] += (10.0-s)/nreps
-			s = 10
-		P[:,col] = P[:,col] / s
+	# leadership scores of 0.5. The fudge adds the same value to every
+	# cell in the column, so rather than making P dense, keep the amount
+	# added to each column in fudge and add it in when multiplying.
+	P = scipy.sparse.csr_matrix(P, dtype=float)
+	s = numpy.asarray(P.sum(axis=0)).ravel()
+	if (s == 0).any(): raise ValueError()
+	fudge = numpy.where(s < 10, (10.0-s)/nreps, 0.0) # min number of cosponsorship data per person
+	s = numpy.maximum(s, 10.0)
+	P = P.multiply(1.0/s).tocsr() # scales the columns
+	fudge = (fudge/s).reshape((1, nreps))
 		
 	# Create a random transition vector.
 	v = numpy.ones( (nreps, 1) ) / float(nreps)
@@ -266,7 +271,7 @@ def leadership_analysis(nreps, P):
 	while True:
 		# Compute y = Ax where A is P plus some perturbation with magnitude
 		# 1-c that ensures that A is a valid aperiodic, irreducible Markov transition matrix.
-		y = c * numpy.dot(P, x)
+		y = c * (P.dot(x) + fudge.dot(x))
 		w = onenorm(x) - onenorm(y)
 		y = y + w*v
 		
@@ -278,7 +283,7 @@ def leadership_analysis(nreps, P):
 		x = y
 		
 	# Scale the values from 0 to 1 on a logarithmic scale.
-	x = rescale(x, log=True)
+	x = rescale(x.ravel(), log=True)
 
 	return x # this is the pagerank
 	
@@ -423,10 +428,11 @@ def influence_matrix(congressnumber, starting_congress, house_or_senate, people,
 	initial_score = None
 	initial_pctile = None
 	for cosponsor in [None] + list(rep_to_row):
-		P = numpy.array(P_initial) # clone
+		P = P_initial.tolil(copy=True) # clone
 		if cosponsor != None: # baseline
 			#P[(rep_to_row[sponsor], rep_to_row[cosponsor])] += 1
 			P[(rep_to_row[cosponsor], rep_to_row[sponsor])] += 1
+		P = P.tocsr()
 		spectrum = ideology_analysis(nreps, parties, P)
 		score = spectrum[rep_to_row[sponsor]]
 		pctile = scipy.stats.percentileofscore([spectrum[i] for i in range(nreps) if parties[i] == "Democrat"], score)
@@ -436,7 +442,87 @@ def influence_matrix(congressnumber, starting_congress, house_or_senate, people,
 			continue
 		print(sponsor, cosponsor, score - initial_score, pctile - initial_pctile)
 			
+def benchmark(nbills=10000, nreps=435):
+	# Time the analysis of a synthetic Congress against the dense code this
+	# script used to run: a matrix built with Python loops, a full SVD, and
+	# the per-column fudge and normalize loop before the PageRank power
+	# iteration. Check that the results match.
+	import math, random
+	rand = random.Random(0)
+	members = list(range(400000, 400000+nreps))
+	party = { pid: ("Republican" if i % 2 == 0 else "Democrat") for i, pid in enumerate(members) }
+	bills = []
+	for i in range(nbills):
+		sponsor = rand.choice(members)
+		# Cosponsors are mostly from the sponsor's party, so that there is
+		# an ideology dimension.
+		cosponsors = [c for c in rand.sample(members, min(nreps, int(rand.expovariate(1/10.0))))
+		              if party[c] == party[sponsor] or rand.random() < .2]
+		bills.append({ "bill_type": "hr", "number": i+1, "sponsor": sponsor, "introduced": "2021-01-03",
+		               "cosponsors": [(c, "2021-01-03", None) for c in cosponsors] })
+	# A few members who hardly cosponsor anything, so that the low-data
+	# fudge in the leadership analysis is exercised.
+	members.extend(range(500000, 500005))
+	for pid in range(500000, 500005): party[pid] = "Democrat"
+	people_list = { "h": set(members) }
+
+	start = time.time()
+	start_date, end_date, rep_to_row, nreps, P = build_matrix_from_corpus(bills, "h", people_list)
+	parties = [None for i in range(nreps)]
+	for k, v in rep_to_row.items(): parties[v] = party[k]
+	spectrum, spectrum2 = ideology_analysis(nreps, parties, P)
+	leadership = leadership_analysis(nreps, P)
+	sparse_time = time.time() - start
+
+	start = time.time()
+	D = numpy.identity(nreps, float)
+	for bill in bills:
+		for cosponsor_id, join_date, withdrawn_date in bill["cosponsors"]:
+			D[rep_to_row[bill["sponsor"]], rep_to_row[cosponsor_id]] += 1.0
+	for i in range(nreps):
+		for j in range(nreps):
+			D[i,j] = math.sqrt(D[i,j])
+	dense_matrix = numpy.copy(D)
+
+	u, s, vh = numpy.linalg.svd(D)
+	dense_spectrum = vh[1,:]
+	dense_spectrum2 = vh[0,:]
+	R_scores = [dense_spectrum[i] for i in range(nreps) if parties[i] == "Republican"]
+	R_score_mean = sum(R_scores)/len(R_scores)
+	dense_spectrum = rescale(dense_spectrum * R_score_mean)
+
+	for col in range(nreps):
+		s = sum(D[:,col])
+		if s == 0: raise ValueError()
+		if s < 10: # min number of cosponsorship data per person
+			D[:,col] += (10.0-s)/nreps
+			s = 10
+		D[:,col] = D[:,col] / s
+	v = numpy.ones( (nreps, 1) ) / float(nreps)
+	c = 0.85
+	x = numpy.ones( (nreps, 1) ) / float(nreps)
+	while True:
+		y = c * numpy.dot(D, x)
+		w = onenorm(x) - onenorm(y)
+		y = y + w*v
+		err = onenorm(y-x)
+		if err < .00000000001:
+			break
+		x = y
+	dense_leadership = rescale(x.ravel(), log=True)
+	dense_time = time.time() - start
+
+	assert numpy.allclose(P.toarray(), dense_matrix)
+	assert numpy.allclose(spectrum, dense_spectrum, atol=1e-6)
+	assert numpy.allclose(numpy.abs(spectrum2), numpy.abs(dense_spectrum2), atol=1e-6) # the sign is arbitrary
+	assert numpy.allclose(leadership, dense_leadership)
+	print("%d bills, %d members: sparse %.2f sec, dense %.2f sec" % (nbills, nreps, sparse_time, dense_time))
+
 if __name__ == "__main__":
+	if sys.argv[1] == "benchmark":
+		benchmark()
+		sys.exit(0)
+
 	congressnumber = int(sys.argv[1])
 
 	# Who should we include in the analysis?
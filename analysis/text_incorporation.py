@@ -223,6 +223,120 @@ def is_text_incorporated(b1_ratio, b2_ratio, cmp_text_len):
 
   return False
 
+# Most bills share nothing meaningful with a given enacted bill, so to avoid
+# running the (slow) diff on them, we first find candidate pairs using
+# sketches of each bill's text. A sketch is a sample of the hashes of the
+# bill's word shingles (runs of SHINGLE_SIZE words), taking the shingles
+# whose hash falls in 1/SAMPLE_MODULUS of the hash space. Because the
+# same shingles are sampled from every bill, the overlap between two
+# sketches estimates how much of one bill's text is contained in the
+# other's. (MinHash would estimate Jaccard similarity instead, which
+# can't detect a short bill incorporated into an omnibus bill.) An
+# inverted index from sampled hashes to bills finds all bills that
+# overlap an enacted bill in one pass over its sketch.
+SHINGLE_SIZE = 8
+SAMPLE_MODULUS = 4
+SKETCH_VERSION = 1 # increment when the sketch changes to invalidate the sketch cache
+MIN_CANDIDATE_CONTAINMENT = .05 # well below the thresholds in is_text_incorporated
+MAX_POSTING_FRACTION = .05 # ignore boilerplate shingles found in more than this fraction of bills
+
+def text_sketch(text):
+  # Returns the sorted, unique sampled shingle hashes of the text as a numpy array.
+  import numpy, zlib
+  words = numpy.array([zlib.crc32(w.encode("utf8")) for w in text.split(" ")], dtype=numpy.uint64)
+  n = len(words) - SHINGLE_SIZE + 1
+  if n <= 0:
+    return numpy.zeros(0, dtype=numpy.uint64)
+  # A polynomial rolling hash of each run of words. Multiplication wraps
+  # around in uint64, which is fine for a hash.
+  h = numpy.zeros(n, dtype=numpy.uint64)
+  with numpy.errstate(over="ignore"):
+    for k in range(SHINGLE_SIZE):
+      h = h * numpy.uint64(1000003) + words[k:k+n]
+  return numpy.unique(h[(h >> numpy.uint64(40)) % numpy.uint64(SAMPLE_MODULUS) == 0])
+
+def build_sketch_index(sketches):
+  # Returns an inverted index from sampled hashes to the keys of the
+  # sketches that contain them, omitting very common hashes.
+  import collections
+  index = collections.defaultdict(list)
+  for key, sketch in sketches.items():
+    for h in sketch.tolist():
+      index[h].append(key)
+  max_posting = max(10, int(MAX_POSTING_FRACTION * len(sketches)))
+  return { h: keys for h, keys in index.items() if len(keys) <= max_posting }
+
+def find_candidates(index, sketches, key1):
+  # Returns the keys of the sketches that overlap the sketch at key1 enough
+  # that one may contain a substantial part of the other.
+  import collections
+  sketch1 = sketches[key1]
+  overlap = collections.Counter()
+  for h in sketch1.tolist():
+    overlap.update(index.get(h, ()))
+  return set(
+    key2 for key2, count in overlap.items()
+    if key2 != key1 and count / max(1, min(len(sketch1), len(sketches[key2]))) >= MIN_CANDIDATE_CONTAINMENT
+  )
+
+def sketch_file(task):
+  # Runs in a worker process.
+  key, fn = task
+  try:
+    return (key, text_sketch(extract_text(fn)))
+  except ValueError: # xml is bad
+    return (key, None)
+
+compare_state = None # (path, prepare_text1 state) of the last enacted bill a worker loaded
+
+def compare_files(task):
+  # Compares one enacted bill's text to other bills' texts. Runs in a worker
+  # process. Returns (pair info, comparison) for each pair.
+  global compare_state
+  fn1, pairs = task
+  if compare_state is None or compare_state[0] != fn1:
+    compare_state = (fn1, prepare_text1(extract_text(fn1)))
+  ret = []
+  for info, fn2 in pairs:
+    try:
+      text2 = extract_text(fn2)
+    except ValueError: # xml is bad
+      continue
+    ret.append((info, compare_text(text2, *compare_state[1])))
+  return ret
+
+def make_compare_tasks(pairs, chunk_size=25):
+  # Group (fn1, info, fn2) pairs into tasks for compare_files, keeping
+  # pairs with the same first file together so each worker extracts
+  # the enacted bill's text once per task.
+  import itertools
+  tasks = []
+  for fn1, group in itertools.groupby(pairs, key=lambda pair : pair[0]):
+    group = [(info, fn2) for _, info, fn2 in group]
+    for i in range(0, len(group), chunk_size):
+      tasks.append((fn1, group[i:i+chunk_size]))
+  return tasks
+
+def truncate_partial_line(fn):
+  # If a run was killed while writing a row, the file ends with part
+  # of a line. Cut it off so that the next row appended to the file
+  # starts on a line of its own.
+  import os
+  with open(fn, "rb+") as f:
+    end = f.seek(0, os.SEEK_END)
+    pos = end
+    while pos > 0:
+      start = max(0, pos - 4096)
+      f.seek(start)
+      block = f.read(pos - start)
+      i = block.rfind(b"\n")
+      if i != -1:
+        pos = start + i + 1
+        break
+      pos = start
+    if pos != end:
+      f.truncate(pos)
+
 def compare_bills(b1, b2):
   from bill.billtext import get_bill_text_metadata
   fn1 = get_bill_text_metadata(b1, None)['xml_file']
@@ -244,13 +358,14 @@ if __name__ == "__main__" and sys.argv[1] == "analyze":
   #
   # Write out a CSV table.
   
-  import itertools, csv, os.path, shutil
+  import csv, os.path, pickle, time, multiprocessing
   from bill.models import *
   from bill.billtext import get_bill_text_metadata
 
   from django.utils import timezone
 
   congress = int(sys.argv[2])
+  workers = int(sys.argv[3]) if len(sys.argv) > 3 else multiprocessing.cpu_count()
 
   all_bills = Bill.objects.filter(
     congress=congress,
@@ -258,148 +373,142 @@ if __name__ == "__main__" and sys.argv[1] == "analyze":
   enacted_bills = list(all_bills.filter(
     current_status__in=BillStatus.final_status_enacted_bill))
 
-  # Write to CSV, to a temporary file for now.
-  text_comparison_tmpfile = "/tmp/text_comparison_{}.csv".format(congress)
-  with open(text_comparison_tmpfile, "w") as outfile:
-    writer = csv.writer(outfile)
+  # Load the current comparison data so we know what bill texts
+  # we've already compared. New comparisons are appended to the
+  # file as they finish, so an interrupted run picks up where it
+  # left off.
+  csv_fn = "data/analysis/by-congress/%d/text_comparison.csv" % congress
+  existing_comps = set()
+  if os.path.exists(csv_fn):
+    truncate_partial_line(csv_fn)
+    for row in csv.reader(open(csv_fn)):
+      if len(row) != 9: continue # incomplete row from an interrupted run
+      timestamp, b1_id, b1_versioncode, b1_ratio, b2_id, b2_versioncode, b2_ratio, cmp_text_len, cmp_text \
+         = row
+      existing_comps.add( ((b1_id, b1_versioncode), (b2_id, b2_versioncode) ) )
+
+  os.makedirs(os.path.dirname(csv_fn), exist_ok=True)
+
+  # The workers don't use the database, but don't let them share the
+  # parent's connection.
+  import django.db
+  for db in django.db.connections.all(): db.close()
+  start_time = time.time()
+  pool = multiprocessing.get_context("fork").Pool(workers)
+
+  # Get the current text version of each bill.
+  bill_texts = { }
+  for b in tqdm(list(all_bills), desc="Loading metadata"):
+    md = get_bill_text_metadata(b, None)
+    if md and 'xml_file' in md:
+      bill_texts[b.id] = (b, md)
+
+  # Sketch the text of each bill, reusing the sketches of text versions
+  # sketched on previous runs.
+  sketch_cache_fn = "data/analysis/by-congress/%d/text_sketches.pickle" % congress
+  try:
+    with open(sketch_cache_fn, "rb") as f:
+      sketch_cache = pickle.load(f)
+    if sketch_cache.get("version") != SKETCH_VERSION: raise ValueError()
+  except (IOError, ValueError, EOFError, pickle.UnpicklingError):
+    sketch_cache = { "version": SKETCH_VERSION, "sketches": { } }
+  sketch_keys = { b_id: (b.congressproject_id, md['version_code']) for b_id, (b, md) in bill_texts.items() }
+  to_sketch = [(sketch_keys[b_id], md['xml_file']) for b_id, (b, md) in bill_texts.items()
+               if sketch_keys[b_id] not in sketch_cache["sketches"]]
+  for key, sketch in tqdm(pool.imap_unordered(sketch_file, to_sketch, chunksize=10), total=len(to_sketch), desc="Sketching text"):
+    sketch_cache["sketches"][key] = sketch
+  with open(sketch_cache_fn + ".tmp", "wb") as f:
+    pickle.dump(sketch_cache, f, protocol=pickle.HIGHEST_PROTOCOL)
+  os.replace(sketch_cache_fn + ".tmp", sketch_cache_fn)
+
+  # Index the sketches of the bills' current text versions.
+  sketches = { b_id: sketch_cache["sketches"][key] for b_id, key in sketch_keys.items() if sketch_cache["sketches"][key] is not None }
+  index = build_sketch_index(sketches)
+
+  # For each enacted bill, find the set of bills to compare it to.
+  comps = []
+  for b1 in tqdm(enacted_bills, desc="Finding comparison pairs"):
+    if b1.id not in sketches: continue # no xml text or xml is bad
+    md1 = bill_texts[b1.id][1]
+
+    # Compare to the bills with enough text in common.
+    similar_bills = set(bill_texts[b_id][0] for b_id in find_candidates(index, sketches, b1.id))
+
+    # Add in any related bills identified by CRS. Related bills are
+    # compared even if their text doesn't look similar.
+    similar_bills |= set(rb.related_bill for rb in RelatedBill.objects.filter(bill=b1))
+
+    # Iterate over each similar bill.
+    for b2 in sorted(similar_bills, key = lambda x : (x.congress, x.bill_type, x.number)):
+      # Don't compare to other enacted bills.
+      if b2.current_status in BillStatus.final_status_enacted_bill:
+        continue
 
-    # Load the current comparison data so we know what bill texts
-    # we've already compared and copy those comparisons into the
-    # output.
-    csv_fn = "data/analysis/by-congress/%d/text_comparison.csv" % congress
-    existing_comps = set()
-    if os.path.exists(csv_fn):
-      for row in csv.reader(open(csv_fn)):
-        timestamp, b1_id, b1_versioncode, b1_ratio, b2_id, b2_versioncode, b2_ratio, cmp_text_len, cmp_text \
-           = row
-        existing_comps.add( ((b1_id, b1_versioncode), (b2_id, b2_versioncode) ) )
-        writer.writerow(row)
-
-    # For each enacted bill, find the set of bills to compare it to.
-    comps = []
-    for b1 in tqdm(enacted_bills, desc="Finding comparison pairs"):
-      # Load the enacted bill's text.
-
-      # Loads current metadata for the bill.
-      try:
-        md1 = get_bill_text_metadata(b1, None)
-        if 'xml_file' not in md1: continue # no xml text
-        text1 = extract_text(md1['xml_file'])
-      except TypeError: # no bill text at all (accessing [...] of None)
+      # Don't compare bills to resolutions.
+      if b1.noun != b2.noun:
         continue
-      except ValueError: # xml is bad
+
+      # Get the second bill's most recent text document's metadata.
+      md2 = bill_texts[b2.id][1] if b2.id in bill_texts else get_bill_text_metadata(b2, None)
+      if not md2 or 'xml_file' not in md2: # text may not be available yet
         continue
 
-      # How many bills should we expect as an upper bound to be similar
-      # to this bill? The longer this bill is, the more bills might be
-      # incorporated into it. For small bills, we'll use Solr's more-
-      # like-this query to find relevant bills. But for very large bills
-      # which are often omnibus bills with many topics, Solr produces
-      # poor results and doesn't surface all matches. Comparing every
-      # enacted bill to every bill is infeasible.
-      how_many = max(10, len(text1)/1000)
-      if how_many < 100:
-          from haystack.query import SearchQuerySet
-          qs = SearchQuerySet().using("bill").filter(indexed_model_name__in=["Bill"])\
-            .filter(congress=b1.congress).more_like_this(b1)
-          similar_bills = set(r.object for r in qs[0:how_many])
-      else:
-          # OK for these bills we really have to compare every bill to
-          # every other bill.
-          similar_bills = set(all_bills)
-
-      # Add in any related bills identified by CRS. Related bills aren't
-      # exhaustive, which is why we also look at textually similar bills,
-      # but on very large bills (like big approps bills) textual similarity
-      # doesn't exhaustively include everythig either in the top ~50 results.
-      similar_bills |= set(rb.related_bill for rb in RelatedBill.objects.filter(bill=b1))
-
-      # Iterate over each similar bill.
-      for b2 in sorted(similar_bills, key = lambda x : (x.congress, x.bill_type, x.number)):
-        # Don't compare to other enacted bills.
-        if b2.current_status in BillStatus.final_status_enacted_bill:
-          continue
-
-        # Don't compare bills to resolutions.
-        if b1.noun != b2.noun:
-          continue
-
-        # Get the second bill's most recent text document's metadata.
-        md2 = get_bill_text_metadata(b2, None)
-        if not md2: # text may not be available yet
-          continue
-
-        # Did we do a comparison already? Skip if so.
-        key = ((b1.congressproject_id, md1['version_code']), (b2.congressproject_id, md2['version_code']))
-        if key in existing_comps:
-          continue
-
-        # The enacted bill must be newer than the non-enacted bill.
-        # Since authorizations are repeated from year to year, we
-        # should exclude cases where a bill looks like one previously
-        # enacted. Since text is not always published simultaneously
-        # with status, especially often for enrolled bills, we can
-        # look at the text date but better the bill's current status.
-        # Sometimes the text gets ahead of the bill, like when a bill
-        # gets reprinted when it moves across chambers, which doesnt
-        # represent substantive action. hr1567-114 had a text print
-        # after its companion bill s1252-114 was enrolled.
-        if b1.current_status_date <= b2.current_status_date:
-          continue
-
-        comps.append((b1, b2))
-
-    # Only compare some pairs of bills in a run. In the 116th Congress
-    # about 200,000 comparison pairs were performed, so this gets us
-    # all of them in about one month if this script is run once per day,
-    # without this script potentially running for an excessively long
-    # time and blocking other scrapers. Most enacted bills only trigger
-    # a comparison with a handful of other bills, but the blow-up comes
-    # from the large omnibus bills which get compared with every other
-    # introduced bill.
-    max_comps = 500
-    if len(comps) > max_comps:
-        print("Only running first", max_comps, "of", len(comps), "bill comparison pairs.")
-        comps = comps[:max_comps]
-
-    # Now perform text comparison on the pairs of bills.
-    prev_b1 = None
-    for (b1, b2) in tqdm(comps, desc="Comparing text"):
-        # Load the first bill (the enacted bill)'s text.
-        if b1 is not prev_b1:
-          md1 = get_bill_text_metadata(b1, None) # repeated above
-          text1 = extract_text(md1['xml_file'])
-          state = prepare_text1(text1)
-          prev_b1 = b1
-
-        # Load the second bill's text.
-        md2 = get_bill_text_metadata(b2, None) # repeated above
-        try:
-          text2 = extract_text(md2['xml_file'])
-        except KeyError: # no xml_file
-          continue
-        except ValueError: # xml is bad
-          continue
-
-        # Run comparison.
-        ratio1, ratio2, text = compare_text(text2, *state)
-
-        # Write out the comparison. We write out everything so that we know
-        # we've done the computation and don't need to do it again later.
+      # Did we do a comparison already? Skip if so.
+      key = ((b1.congressproject_id, md1['version_code']), (b2.congressproject_id, md2['version_code']))
+      if key in existing_comps:
+        continue
+
+      # The enacted bill must be newer than the non-enacted bill.
+      # Since authorizations are repeated from year to year, we
+      # should exclude cases where a bill looks like one previously
+      # enacted. Since text is not always published simultaneously
+      # with status, especially often for enrolled bills, we can
+      # look at the text date but better the bill's current status.
+      # Sometimes the text gets ahead of the bill, like when a bill
+      # gets reprinted when it moves across chambers, which doesnt
+      # represent substantive action. hr1567-114 had a text print
+      # after its companion bill s1252-114 was enrolled.
+      if b1.current_status_date <= b2.current_status_date:
+        continue
+
+      comps.append((md1['xml_file'], key, md2['xml_file']))
+
+  # Only compare some pairs of bills in a run so that this script
+  # doesn't potentially run for an excessively long time and block
+  # other scrapers. Most enacted bills only trigger a comparison with
+  # a handful of other bills, but the large omnibus bills can be
+  # similar to many introduced bills.
+  max_comps = 500 * workers
+  if len(comps) > max_comps:
+      print("Only running first", max_comps, "of", len(comps), "bill comparison pairs.")
+      comps = comps[:max_comps]
+
+  # Now perform text comparison on the pairs of bills in the worker
+  # pool, appending each comparison to the CSV file as it finishes.
+  # We write out everything so that we know we've done the computation
+  # and don't need to do it again later.
+  with open(csv_fn, "a") as outfile:
+    writer = csv.writer(outfile)
+    tasks = make_compare_tasks(comps)
+    for results in tqdm(pool.imap_unordered(compare_files, tasks), total=len(tasks), desc="Comparing text"):
+      for ((b1_id, b1_versioncode), (b2_id, b2_versioncode)), (ratio1, ratio2, text) in results:
         writer.writerow([
           timezone.now().isoformat(),
 
-          b1.congressproject_id, md1['version_code'],
+          b1_id, b1_versioncode,
           ratio1,
 
-          b2.congressproject_id, md2['version_code'],
+          b2_id, b2_versioncode,
           ratio2,
 
           len(text),
           text[:1000].encode("utf8") if ((ratio1 > .1 or ratio2 > .1) and len(text) > 500) else "",
           ])
+      outfile.flush()
 
-  shutil.move(text_comparison_tmpfile, csv_fn)
+  pool.close()
+  pool.join()
+  print("Compared %d pairs of bills in %.1f seconds." % (len(comps), time.time() - start_time))
 
 elif __name__ == "__main__" and sys.argv[1] == "load":
   # Update the Bill.text_incorporation field in our database.
@@ -422,6 +531,7 @@ elif __name__ == "__main__" and sys.argv[1] == "load":
   # over earlier versions of a bill.
   latest_version_code = { }
   for row in csv.reader(open(csv_fn)):
+    if len(row) != 9: continue # incomplete row from an interrupted run
     timestamp, b1_id, b1_versioncode, b1_ratio, b2_id, b2_versioncode, b2_ratio, cmp_text_len, cmp_text \
        = row
     latest_version_code[b1_id] = b1_versioncode
@@ -430,6 +540,7 @@ elif __name__ == "__main__" and sys.argv[1] == "load":
   # Collate the text incorporation data by bill.
   text_incorporation = collections.defaultdict(lambda : { })
   for row in csv.reader(open(csv_fn)):
+    if len(row) != 9: continue # incomplete row from an interrupted run
     timestamp, b1_id, b1_versioncode, b1_ratio, b2_id, b2_versioncode, b2_ratio, cmp_text_len, cmp_text \
        = row
     cmp_text_len = int(cmp_text_len)
@@ -548,6 +659,7 @@ elif __name__ == "__main__" and sys.argv[1] == "count":
   # over earlier versions of a bill.
   latest_version_code = { }
   for row in csv.reader(open(csv_fn)):
+    if len(row) != 9: continue # incomplete row from an interrupted run
     timestamp, b1_id, b1_versioncode, b1_ratio, b2_id, b2_versioncode, b2_ratio, cmp_text_len, cmp_text \
        = row
     latest_version_code[b1_id] = b1_versioncode
@@ -557,6 +669,7 @@ elif __name__ == "__main__" and sys.argv[1] == "count":
   total = 0
   count = 0
   for row in csv.reader(open(csv_fn)):
+    if len(row) != 9: continue # incomplete row from an interrupted run
     timestamp, b1_id, b1_versioncode, b1_ratio, b2_id, b2_versioncode, b2_ratio, cmp_text_len, cmp_text \
        = row
     b1_ratio = round(float(b1_ratio),3)
@@ -584,6 +697,7 @@ elif __name__ == "__main__" and sys.argv[-1] == "test":
   congress = 114
   csv_fn = "data/analysis/by-congress/%d/text_comparison.csv" % congress
   for row in csv.reader(open(csv_fn)):
+    if len(row) != 9: continue # incomplete row from an interrupted run
     timestamp, b1_id, b1_versioncode, b1_ratio, b2_id, b2_versioncode, b2_ratio, cmp_text_len, cmp_text = row
     b1_ratio = float(b1_ratio)
     b2_ratio = float(b2_ratio)
@@ -692,6 +806,43 @@ elif __name__ == "__main__" and sys.argv[1] == "graph":
 elif __name__ == "__main__" and sys.argv[1] == "extract-text":
   print(extract_text(sys.argv[2]).encode("utf8"))
 
+elif __name__ == "__main__" and sys.argv[1] == "benchmark":
+  # Compare every pair of bill text XML files in a directory (a fixture
+  # corpus) with and without candidate pruning, and report the number of
+  # pairs compared, the time taken, and any incorporations that pruning
+  # missed.
+  import glob, os.path, time, multiprocessing
+  workers = int(sys.argv[3]) if len(sys.argv) > 3 else multiprocessing.cpu_count()
+  texts = { }
+  for fn in sorted(glob.glob(os.path.join(sys.argv[2], "*.xml"))):
+    try:
+      texts[fn] = extract_text(fn)
+    except ValueError: # xml is bad
+      pass
+  all_pairs = [(fn1, (fn1, fn2), fn2) for fn1 in texts for fn2 in texts if fn1 != fn2]
+
+  def run(pairs):
+    start = time.time()
+    with multiprocessing.get_context("fork").Pool(workers) as pool:
+      results = [r for rs in pool.imap_unordered(compare_files, make_compare_tasks(pairs)) for r in rs]
+    found = set(info for info, (ratio1, ratio2, text) in results if is_text_incorporated(ratio1, ratio2, len(text)))
+    return time.time() - start, found
+
+  all_time, all_found = run(all_pairs)
+
+  start = time.time()
+  sketches = { fn: text_sketch(text) for fn, text in texts.items() }
+  index = build_sketch_index(sketches)
+  candidate_pairs = [(fn1, (fn1, fn2), fn2) for fn1 in texts for fn2 in sorted(find_candidates(index, sketches, fn1))]
+  sketch_time = time.time() - start
+  candidate_time, candidate_found = run(candidate_pairs)
+
+  print("%d files, %d workers" % (len(texts), workers))
+  print("all pairs:  %6d pairs compared in %6.1f sec, %d incorporated" % (len(all_pairs), all_time, len(all_found)))
+  print("candidates: %6d pairs compared in %6.1f sec (+%.1f sec sketching), %d incorporated" % (len(candidate_pairs), candidate_time, sketch_time, len(candidate_found)))
+  for fn1, fn2 in sorted(all_found - candidate_found):
+    print("missed:", fn1, fn2)
+
 
 elif __name__ == "__main__" and len(sys.argv) == 3:
   # Compare two bills.
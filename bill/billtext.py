@@ -181,35 +181,183 @@ def parse_usc_citation(cite):
         
     return { "type": "unknown", "text": cite.text }
 
-def get_bill_text_versions(bill):
-    # Scan the bill's text-versions directory for downloaded bill text.
+# Finding a bill's text versions and the latest one means listing its
+# text-versions directory and reading every version's data.json, which
+# bill pages, events, and the parser do over and over. So the metadata
+# of each bill's text versions is kept in an index file per Congress,
+# which is updated after new text is fetched (update_bill_text_versions_index).
+# A bill's entry is only used if its text-versions directory, the version
+# directories and files in it, and the versions' metadata files haven't been
+# modified since the entry was made; otherwise the directory is scanned.
+BILL_TEXT_VERSIONS_INDEX_PATH = "data/misc/bill-text-versions"
+bill_text_versions_index = { } # congress => (index file mtime, index)
+
+def get_bill_text_versions_index_file(congress):
+    return os.path.join(BILL_TEXT_VERSIONS_INDEX_PATH, "%d.json" % congress)
+
+def get_bill_text_versions_index_key(bill):
+    return os.path.basename(bill.data_dir_path) # e.g. "hr1234"
+
+def load_bill_text_versions_index(congress):
+    # Load the index from disk, or from memory if it hasn't changed.
+    fn = get_bill_text_versions_index_file(congress)
+    try:
+        mtime = os.stat(fn).st_mtime_ns
+    except OSError:
+        return { }
+    if congress in bill_text_versions_index and bill_text_versions_index[congress][0] == mtime:
+        return bill_text_versions_index[congress][1]
+    try:
+        with open(fn) as f:
+            index = json.load(f)
+    except ValueError:
+        return { }
+    bill_text_versions_index[congress] = (mtime, index)
+    return index
+
+def get_bill_text_versions_stamp(d):
+    # Return a digest of the modification times of the text-versions
+    # directory and of the version directories and files in it, and the
+    # modification times and sizes of each version's metadata files, which
+    # are sometimes rewritten in place. It changes when a version is added,
+    # a file is added to a version, or a version's metadata changes. None
+    # if the directory doesn't exist.
+    import hashlib
+    try:
+        stats = [os.stat(d).st_mtime_ns]
+        names = sorted(os.listdir(d))
+    except OSError:
+        return None
+    for st in names:
+        for fn in (st, st + "/data.json", st + "/mods.xml"):
+            try:
+                fst = os.stat(d + "/" + fn)
+            except OSError:
+                continue
+            stats.append((fn, fst.st_mtime_ns, fst.st_size))
+    return hashlib.sha1(repr(stats).encode("utf8")).hexdigest()
+
+def get_bill_mods_numpages(fn):
+    # Just the page count from a MODS file, or None if the file can't be read.
+    try:
+        return load_bill_mods_metadata(fn)["numpages"]
+    except (IOError, ValueError, lxml.etree.LxmlError):
+        return None
+
+def scan_bill_text_versions(bill, with_numpages=False):
+    # Scan the bill's text-versions directory for downloaded bill text
+    # and return an index entry for the bill, or None if there is no text.
+    # Reading the page counts means parsing each version's MODS file, so
+    # that's only done when building the index and not on page views.
     from os import listdir
     d = bill.data_dir_path + "/text-versions"
-    if not os.path.exists(d):
-        return # don't yield anything, no text available
+    stamp = get_bill_text_versions_stamp(d)
+    if stamp is None:
+        return None # no text available
+    versions = { }
     for st in listdir(d):
         # statuscode/data.json are metadata files generated by the govinfo parser
-        fn = bill.data_dir_path + "/text-versions/" + st + "/data.json"
-        if os.path.exists(fn):
-            yield st
+        if os.path.exists(d + "/" + st + "/data.json"):
+            dat = get_bill_text_version_regular(bill, st)
+            if with_numpages and "mods_file" in dat:
+                dat["numpages"] = get_bill_mods_numpages(dat["mods_file"])
+            versions[st] = dat
 
         # also find docs.house.gov-scraped files
         m = re.match(r"(dhg-\d+).json$", st)
         if m:
-            yield m.group(1)
+            versions[m.group(1)] = get_bill_text_metadata_dhg(bill, m.group(1))
+
+    # Make the metadata JSON-serializable. These fields are restored by
+    # get_bill_text_version_from_index.
+    for dat in versions.values():
+        dat["issued_on"] = dat["issued_on"].isoformat()
+        del dat["corresponding_status_codes"]
+        if settings.DEBUG and not dat.get("thumbnail_path"):
+            dat.pop("has_thumbnail", None) # set just because of DEBUG
+
+    return { "stamp": stamp, "versions": versions }
+
+def get_bill_text_versions_entry(bill):
+    # Get the bill's entry from the index, or scan its directory if it
+    # has changed since the index was updated.
+    entry = load_bill_text_versions_index(bill.congress).get(get_bill_text_versions_index_key(bill))
+    stamp = get_bill_text_versions_stamp(bill.data_dir_path + "/text-versions")
+    if stamp is None:
+        return None # no text available
+    if entry is None or entry.get("stamp") != stamp:
+        entry = scan_bill_text_versions(bill)
+    return entry
+
+def get_bill_text_version_from_index(dat):
+    # Return a copy of a version's metadata from the index with the fields
+    # that can't be stored in JSON restored.
+    dat = dict(dat)
+    dat["issued_on"] = datetime.date(*(int(d) for d in dat["issued_on"].split("-")))
+    if dat["version_code"].startswith("dhg-"):
+        dat["corresponding_status_codes"] = set()
+    else:
+        dat["corresponding_status_codes"] = get_gpo_status_code_corresponding_status(dat["version_code"])
+        if settings.DEBUG:
+            dat["has_thumbnail"] = True
+    return dat
+
+def update_bill_text_versions_index(congress):
+    # Update the index for a Congress, rescanning only the bills whose
+    # text-versions directories have changed, and return the number of
+    # bills rescanned.
+    from bill.models import Bill
+    index = dict(load_bill_text_versions_index(congress))
+    rescanned = 0
+    seen = set()
+    for bill in Bill.objects.filter(congress=congress).only("congress", "bill_type", "number"):
+        key = get_bill_text_versions_index_key(bill)
+        stamp = get_bill_text_versions_stamp(bill.data_dir_path + "/text-versions")
+        if stamp is None: continue
+        seen.add(key)
+        # Check if anything changed without reading the metadata files.
+        if key in index and index[key].get("stamp") == stamp:
+            continue
+        entry = scan_bill_text_versions(bill, with_numpages=True)
+        if entry is not None:
+            index[key] = entry
+            rescanned += 1
+    for key in set(index) - seen:
+        del index[key]
+
+    fn = get_bill_text_versions_index_file(congress)
+    os.makedirs(os.path.dirname(fn), exist_ok=True)
+    tmp_fn = "%s.%d.tmp" % (fn, os.getpid())
+    with open(tmp_fn, "w") as f:
+        json.dump(index, f)
+    os.replace(tmp_fn, fn)
+    return rescanned
+
+def get_bill_text_versions(bill):
+    # Return the version codes of the bill's downloaded bill text.
+    entry = get_bill_text_versions_entry(bill)
+    if not entry:
+        return [] # no text available
+    return list(entry["versions"])
 
 def get_bill_text_metadata(bill, version):
-    import glob
+    entry = get_bill_text_versions_entry(bill)
 
     if version == None:
-        # Cycle through files to find most recent version by date.
+        # Cycle through versions to find most recent version by date.
+        if not entry:
+            return None
         dat = None
-        for st in get_bill_text_versions(bill):
-            d = get_bill_text_metadata(bill, st)
-            if not dat or d["issued_on"] > dat["issued_on"]:
+        for d in entry["versions"].values():
+            if not dat or d["issued_on"] > dat["issued_on"]: # ISO dates compare in date order
                 dat = d
-        return dat
+        return get_bill_text_version_from_index(dat) if dat else None
 
+    if entry and version in entry["versions"]:
+        return get_bill_text_version_from_index(entry["versions"][version])
+
+    # Not a known version --- read it from disk, which raises IOError if it
+    # doesn't exist.
     if version.startswith("dhg-"):
         return get_bill_text_metadata_dhg(bill, version)
     return get_bill_text_version_regular(bill, version)
@@ -372,10 +520,9 @@ def load_bill_text(bill, version, plain_text=False, mods_only=False, with_citati
         return ret
 
     if "xml_file" in dat and not plain_text:
-        # convert XML on the fly to HTML
-        import lxml.html, congressxml
+        # convert XML to HTML, or get it from the render cache
         ret.update({
-            "text_html": lxml.html.tostring(congressxml.convert_xml(dat["xml_file"]), encoding=str),
+            "text_html": render_bill_text_xml(dat["xml_file"])["text_html"],
             "source": dat.get("xml_file_source"),
         })
 
@@ -389,19 +536,11 @@ def load_bill_text(bill, version, plain_text=False, mods_only=False, with_citati
     elif "text_file" in dat:
         # bill text from the Statutes at Large, or when plain_text is True then from GPO
 
-        bill_text_content = open(dat["text_file"]).read()
-
-        # In the GPO BILLS collection, there's gunk at the top and bottom that we'd
-        # rather just remove: metadata in brackets at the top, and <all> at the end.
-        # We remove it because it's not really useful when indexing.
-        if bill_text_content:
-            bill_text_content = re.sub(r"^\s*(\[[^\n]+\]\s*)*", "", bill_text_content)
-            bill_text_content = re.sub(r"\s*<all>\s*$", "", bill_text_content)
+        bill_text_content = read_bill_text_file(dat["text_file"])
 
         # Caller just wants the plain text?
         if plain_text:
-            # replace form feeds (OCR'd layers only) with an indication of the page break
-            return bill_text_content.replace("\u000C", "\n=============================================\n")
+            return bill_text_to_plain_text(bill_text_content)
             
         # Return the text wrapped in <pre>, and replace form feeds with an <hr>.
         import html
@@ -420,6 +559,109 @@ def load_bill_text(bill, version, plain_text=False, mods_only=False, with_citati
 
     return ret
 
+# Converting bill XML to HTML takes seconds and hundreds of MB of memory
+# for the largest bills, so the rendered HTML is cached on disk keyed by
+# the XML file's path and modification time and the converter version.
+# Increment BILL_TEXT_RENDER_VERSION when congressxml's output changes.
+# "manage.py prerender_bill_text" fills the cache for newly fetched text.
+BILL_TEXT_RENDER_CACHE_PATH = getattr(settings, "BILL_TEXT_RENDER_CACHE_PATH", "data/misc/bill-text-html")
+BILL_TEXT_RENDER_VERSION = 1
+
+def get_bill_text_render_cache_file(xml_file):
+    import hashlib
+    key = hashlib.sha1(json.dumps([
+        BILL_TEXT_RENDER_VERSION,
+        xml_file,
+        os.stat(xml_file).st_mtime_ns,
+    ]).encode("utf8")).hexdigest()
+    return os.path.join(BILL_TEXT_RENDER_CACHE_PATH, key[0:2], key + ".json")
+
+def render_bill_text_xml(xml_file, force=False):
+    # Returns a dict with the HTML rendering of a bill text XML file
+    # ("text_html") and the ids of the elements in it that can be
+    # linked to ("anchors"), from the cache if it's been rendered.
+    cache_file = get_bill_text_render_cache_file(xml_file)
+    if not force:
+        try:
+            with open(cache_file) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            pass
+
+    import lxml.html, congressxml
+    dom = congressxml.convert_xml(xml_file)
+    ret = {
+        "source_file": xml_file,
+        "text_html": lxml.html.tostring(dom, encoding=str),
+        "anchors": dom.xpath("//@id"),
+    }
+
+    # Write atomically since web workers and the prerender command may be
+    # rendering the same file at the same time.
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    tmp_file = "%s.%d.tmp" % (cache_file, os.getpid())
+    with open(tmp_file, "w") as f:
+        json.dump(ret, f)
+    os.replace(tmp_file, cache_file)
+
+    return ret
+
+def load_bill_text_xml_dom(xml_file):
+    # Returns the rendered HTML of a bill text XML file as an lxml tree,
+    # the same as congressxml.convert_xml but using the render cache.
+    import lxml.etree, lxml.html
+    return lxml.etree.ElementTree(lxml.html.fromstring(render_bill_text_xml(xml_file)["text_html"]))
+
+def read_bill_text_file(fn):
+    bill_text_content = open(fn).read()
+
+    # In the GPO BILLS collection, there's gunk at the top and bottom that we'd
+    # rather just remove: metadata in brackets at the top, and <all> at the end.
+    # We remove it because it's not really useful when indexing.
+    if bill_text_content:
+        bill_text_content = re.sub(r"^\s*(\[[^\n]+\]\s*)*", "", bill_text_content)
+        bill_text_content = re.sub(r"\s*<all>\s*$", "", bill_text_content)
+
+    return bill_text_content
+
+def bill_text_to_plain_text(bill_text_content):
+    # replace form feeds (OCR'd layers only) with an indication of the page break
+    return bill_text_content.replace("\u000C", "\n=============================================\n")
+
+BILL_INDEX_TEXT_CACHE_PATH = "data/misc/bill-index-text"
+
+def load_bill_index_text(bill):
+    # Same as load_bill_text(bill, None, plain_text=True), but the extracted
+    # text is cached on disk per text version (i.e. per text file) so that
+    # re-indexing a bill whose text hasn't changed doesn't re-read and re-clean
+    # the text file, which can be very large.
+    import hashlib
+
+    dat = get_bill_text_metadata(bill, None)
+    if not dat or "text_file" not in dat:
+        return "" # for indexing, just return empty string if no text is available
+    text_file = dat["text_file"]
+
+    cache_file = os.path.join(BILL_INDEX_TEXT_CACHE_PATH, hashlib.sha1(text_file.encode("utf8")).hexdigest() + ".txt")
+    try:
+        if os.stat(cache_file).st_mtime_ns >= os.stat(text_file).st_mtime_ns:
+            with open(cache_file) as f:
+                return f.read()
+    except OSError:
+        pass # not cached yet (or the text file is missing, which raises below)
+
+    bill_text_content = bill_text_to_plain_text(read_bill_text_file(text_file))
+
+    # Write the cache file atomically since parser workers may be indexing
+    # at the same time.
+    os.makedirs(BILL_INDEX_TEXT_CACHE_PATH, exist_ok=True)
+    tmp_file = "%s.%d.tmp" % (cache_file, os.getpid())
+    with open(tmp_file, "w") as f:
+        f.write(bill_text_content)
+    os.replace(tmp_file, cache_file)
+
+    return bill_text_content
+
 def load_citation_info(metadata):
     if "citations" not in metadata: return
 
@@ -0,0 +1,52 @@
+from django.core.management.base import BaseCommand
+from django.conf import settings
+
+import multiprocessing
+import os.path
+import time
+
+from bill.models import Bill
+from bill.billtext import get_bill_text_versions, get_bill_text_metadata, get_bill_text_render_cache_file, render_bill_text_xml
+
+def render(xml_file):
+	# Runs in a worker process. Return errors rather than raising them so
+	# that one bad file doesn't stop the others.
+	try:
+		render_bill_text_xml(xml_file)
+		return (xml_file, None)
+	except Exception as e:
+		return (xml_file, str(e))
+
+class Command(BaseCommand):
+	help = 'Renders bill text XML to HTML into the bill text render cache for text versions that are not yet cached.'
+
+	def add_arguments(self, parser):
+		parser.add_argument('--congress', type=int, default=settings.CURRENT_CONGRESS, help='only bills in this Congress')
+		parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(), help='number of worker processes to render with')
+
+	def handle(self, *args, **options):
+		# Find the XML files of each text version that haven't been rendered.
+		xml_files = []
+		for bill in Bill.objects.filter(congress=options["congress"]).only("congress", "bill_type", "number"):
+			for version in get_bill_text_versions(bill):
+				try:
+					xml_file = get_bill_text_metadata(bill, version).get("xml_file")
+				except (IOError, ValueError):
+					continue
+				if xml_file and os.path.exists(xml_file) and not os.path.exists(get_bill_text_render_cache_file(xml_file)):
+					xml_files.append(xml_file)
+		print("Rendering", len(xml_files), "bill text versions.")
+		if not xml_files: return
+
+		# The largest files take the longest, so start them first. Recycle
+		# workers periodically since the converter uses a lot of memory on
+		# large bills.
+		xml_files.sort(key=lambda fn : -os.path.getsize(fn))
+		start = time.time()
+		errors = 0
+		with multiprocessing.get_context("fork").Pool(options["workers"], maxtasksperchild=25) as pool:
+			for xml_file, error in pool.imap_unordered(render, xml_files):
+				if error:
+					print(xml_file, error)
+					errors += 1
+		print("Rendered %d files in %.1f seconds, %d errors." % (len(xml_files) - errors, time.time() - start, errors))
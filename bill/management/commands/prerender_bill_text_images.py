@@ -0,0 +1,53 @@
+from django.core.management.base import BaseCommand
+from django.conf import settings
+
+import multiprocessing
+import os.path
+import time
+
+from bill.models import Bill
+from bill.billtext import get_bill_text_versions, get_bill_text_metadata
+from bill.text_images import PRERENDER_SIZES, get_pdf_source, get_image_key, get_image_path, prerender_page_images
+
+def render(source):
+	# Runs in a worker process. Return errors rather than raising them so
+	# that one bad file doesn't stop the others.
+	try:
+		return (source, prerender_page_images(source), None)
+	except Exception as e:
+		return (source, 0, str(e))
+
+class Command(BaseCommand):
+	help = 'Renders the page images used for bill thumbnails and cards for text versions that are not yet cached.'
+
+	def add_arguments(self, parser):
+		parser.add_argument('--congress', type=int, default=settings.CURRENT_CONGRESS, help='only bills in this Congress')
+		parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(), help='number of worker processes to render with')
+
+	def handle(self, *args, **options):
+		# Find the PDFs of text versions that are missing any of the page images.
+		sources = []
+		for bill in Bill.objects.filter(congress=options["congress"]).only("congress", "bill_type", "number"):
+			for version in get_bill_text_versions(bill):
+				try:
+					metadata = get_bill_text_metadata(bill, version)
+				except (IOError, ValueError):
+					continue
+				if not metadata.get("thumbnail_base_path"): continue
+				source = get_pdf_source(metadata)
+				if not source or "url" in source: continue
+				if all(os.path.exists(get_image_path(get_image_key(source, width, aspect))) for width, aspect in PRERENDER_SIZES): continue
+				sources.append(source)
+		print("Rendering page images for", len(sources), "bill text versions.")
+		if not sources: return
+
+		start = time.time()
+		count = 0
+		errors = 0
+		with multiprocessing.get_context("fork").Pool(options["workers"]) as pool:
+			for source, n, error in pool.imap_unordered(render, sources):
+				count += n
+				if error:
+					print(source, error)
+					errors += 1
+		print("Rendered %d images in %.1f seconds, %d errors." % (count, time.time() - start, errors))
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+from django.conf import settings
+
+from bill.billtext import update_bill_text_versions_index
+from bill.models import Bill
+
+class Command(BaseCommand):
+	help = 'Updates the index of bill text version metadata for bills whose text has changed.'
+
+	def add_arguments(self, parser):
+		parser.add_argument('--congress', type=int, action='append', help='Congress to update (may be repeated, defaults to the current Congress)')
+		parser.add_argument('--all', action='store_true', help='Update the index of every Congress that has bills, e.g. to build the indexes for historical Congresses')
+
+	def handle(self, *args, **options):
+		if options["all"]:
+			congresses = sorted(Bill.objects.order_by().values_list("congress", flat=True).distinct())
+		else:
+			congresses = options["congress"] or [settings.CURRENT_CONGRESS]
+		for congress in congresses:
+			count = update_bill_text_versions_index(congress)
+			print(congress, "updated", count, "bills")
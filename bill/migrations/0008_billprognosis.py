@@ -0,0 +1,26 @@
+# Generated by Django 4.1.13 on 2026-10-18 12:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+import jsonfield.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bill', '0007_auto_20210515_0915'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BillPrognosis',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model_version', models.CharField(help_text='Identifies the prognosis model the prognosis was computed with.', max_length=32)),
+                ('fingerprint', models.CharField(help_text='A hash of the model inputs the prognosis was computed from.', max_length=40)),
+                ('prognosis', jsonfield.fields.JSONField(help_text='The return value of compute_prognosis.')),
+                ('proscore_prediction', models.FloatField(help_text='The prediction of compute_prognosis with proscore=True.')),
+                ('bill', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='stored_prognosis', to='bill.Bill')),
+            ],
+        ),
+    ]
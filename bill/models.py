@@ -9,7 +9,7 @@ from jsonfield import JSONField
 from committee.models import Committee, CommitteeMeeting, CommitteeMember, MEMBER_ROLE_WEIGHTS
 from bill.status import BillStatus, get_bill_status_string
 from bill.title import get_bill_number, get_primary_bill_title
-from bill.billtext import load_bill_text, get_bill_text_versions, get_bill_text_metadata
+from bill.billtext import load_bill_text, load_bill_index_text, get_bill_text_versions, get_bill_text_metadata
 from us import get_congress_dates, get_session_from_date
 
 from django.conf import settings
@@ -71,7 +71,10 @@ class BillTerm(models.Model):
 
     def get_feed(self):
         from events.models import Feed
-        return Feed.objects.get_or_create(feedname="crs:%d" % self.id)[0]
+        return Feed.get_cached(self.get_feedname())
+
+    def get_feedname(self):
+        return "crs:%d" % self.id
 
     @staticmethod
     def from_feed(feed, test=False):
@@ -277,11 +280,12 @@ class Bill(models.Model):
 
     # indexing
     def get_index_text(self):
-        bill_text = load_bill_text(self, None, plain_text=True)
+        bill_text = load_bill_index_text(self)
         if ((82 <= self.congress <= 92) or (103 <= self.congress)) and not bill_text: print("NO BILL TEXT", self)
-        summary_text = ""
-        bs = BillSummary.objects.filter(bill=self).first()
-        if bs: summary_text = bs.plain_text()
+        try:
+            summary_text = self.oursummary.plain_text()
+        except BillSummary.DoesNotExist:
+            summary_text = ""
         return "\n".join([
             self.title,
             self.display_number_no_congress_number.replace(".", ""),
@@ -293,13 +297,14 @@ class Bill(models.Model):
         return self.title
     haystack_index = ('bill_type', 'congress', 'number', 'sponsor', 'current_status', 'terms', 'introduced_date', 'current_status_date', 'committees', 'cosponsors')
     haystack_index_extra = (('proscore', 'Float'), ('sponsor_party', 'MultiValue'), ('usc_citations_uptree', 'MultiValue'), ('enacted_ex', 'Boolean'), ('cosponsor_count', 'Integer'))
+    haystack_prefetch_related = ('stored_prognosis', 'oursummary', 'sponsor_role') # read by proscore, get_index_text, sponsor_party
     def get_terms_index_list(self):
         return sorted(set([t.id for t in self.terms.all()]))
     def get_committees_index_list(self):
         return [c.id for c in self.committees.all()]
     def get_cosponsors_index_list(self):
         return [c.id for c in self.cosponsors.all()]
-    def proscore(self):
+    def proscore(self, prediction=None):
         """A modified prognosis score that omits factors associated with uninteresting bills, such as naming post offices. Only truly valid for current bills, and useless to compare across Congresses, but returns a value for all bills."""
         # To aid search, especially for non-current bills, add in something to give most recently active bills a boost.
 
@@ -315,10 +320,35 @@ class Bill(models.Model):
         if hasattr(csd, 'date'): csd = csd.date()
         r = (csd - cstart).days / 365.0 # ranges from 0.0 to about 2.0.
         if self.is_current:
-            from .prognosis import compute_prognosis
-            r += compute_prognosis(self, proscore=True)["prediction"]
+            if prediction is None:
+                stored = self.get_stored_prognosis()
+                if stored:
+                    prediction = stored.proscore_prediction
+                else:
+                    from .prognosis import compute_prognosis
+                    prediction = compute_prognosis(self, proscore=True)["prediction"]
+            r += prediction
         r *= type_boost[self.bill_type]
         return r
+    @staticmethod
+    def proscores(bills):
+        """Computes proscore() for many bills at once, returning a dict from bill id to score."""
+        from .prognosis import compute_prognosis_batch, prognosis_model_version
+        current = [b for b in bills if b.is_current]
+        predictions = dict(BillPrognosis.objects.filter(bill_id__in=[b.id for b in current], model_version=prognosis_model_version())
+            .values_list("bill_id", "proscore_prediction"))
+        progs = compute_prognosis_batch([b for b in current if b.id not in predictions], proscore=True)
+        predictions.update({ bill_id: prog["prediction"] for bill_id, prog in progs.items() })
+        return { b.id: b.proscore(prediction=predictions.get(b.id)) for b in bills }
+    def get_stored_prognosis(self):
+        # Gets the BillPrognosis stored by the parser, if it was computed with the current model.
+        from .prognosis import prognosis_model_version
+        try:
+            stored = self.stored_prognosis
+        except BillPrognosis.DoesNotExist:
+            return None
+        if stored.model_version != prognosis_model_version(): return None
+        return stored
     def sponsor_party(self):
         from person.types import RoleType
         from person.models import PersonRole
@@ -614,8 +644,12 @@ class Bill(models.Model):
 
         # There are no prognoses for dead bills.
         if self.congress != settings.CURRENT_CONGRESS: return None
-        from .prognosis import compute_prognosis
-        prog = compute_prognosis(self)
+        stored = self.get_stored_prognosis()
+        if stored:
+            prog = dict(stored.prognosis)
+        else:
+            from .prognosis import compute_prognosis
+            prog = compute_prognosis(self)
         prog["congressdates"] = get_congress_dates(prog["congress"])
         return prog
 
@@ -680,8 +714,36 @@ class Bill(models.Model):
 
     def get_feed(self):
         from events.models import Feed
+        return Feed.get_cached(self.get_feedname())
+
+    def get_feedname(self):
         bt = BillType.by_value(self.bill_type)
-        return Feed.objects.get_or_create(feedname="bill:" + bt.xml_code + str(self.congress) + "-" + str(self.number))[0]
+        return "bill:" + bt.xml_code + str(self.congress) + "-" + str(self.number)
+
+    # names of the feeds that don't depend on a particular bill that create_events adds events to
+    STATIC_EVENT_FEEDNAMES = ["misc:activebills", "misc:enactedbills", "misc:introducedbills", "misc:activebills2", "misc:comingup", "misc:billsummaries"]
+
+    @staticmethod
+    def prefetch_event_feeds(bills, create=True):
+        # Loads the feeds that create_events needs for a batch of bills --- the bill,
+        # sponsor, subject term, and committee feeds and the global bill feeds ---
+        # into the feed cache in bulk. Feeds of related bills and reintroductions
+        # are resolved in create_events. Requires events.models.enable_feed_caching().
+        from events.models import Feed
+        from person.models import Person
+        bills = list(bills)
+        bill_ids = [b.id for b in bills]
+        feednames = list(Bill.STATIC_EVENT_FEEDNAMES)
+        for b in bills:
+            feednames.append(b.get_feedname())
+            if b.sponsor_id: feednames.append(Person.feedname_for_id(b.sponsor_id, "ps"))
+        for i in range(0, len(bill_ids), 500):
+            chunk = bill_ids[i:i+500]
+            feednames.extend("crs:%d" % term_id for term_id in
+                Bill.terms.through.objects.filter(bill_id__in=chunk).values_list("billterm_id", flat=True).distinct())
+            feednames.extend(Committee(code=code).get_feedname("bills") for code in
+                Bill.committees.through.objects.filter(bill_id__in=chunk).values_list("committee__code", flat=True).distinct())
+        Feed.prefetch(feednames, create=create)
 
     @staticmethod
     def from_feed(feed):
@@ -719,13 +781,27 @@ class Bill(models.Model):
         if self.congress < 112: return # not interested, creates too much useless data and slow to load
         from events.models import Feed, Event
         with Event.update(self) as E:
+            # resolve all of the feeds that we'll add events to with one query (when
+            # the feed cache is enabled and they're not already cached)
+            terms = list(self.terms.all())
+            committees = list(self.committees.all())
+            related_bills = [rb.related_bill for rb in self.get_related_bills()
+                             if rb.related_bill.relatedbills.count() <= 20] # see below
+            reintroductions = list(self.find_reintroductions())
+            Feed.prefetch(
+                [b.get_feedname() for b in [self] + related_bills + reintroductions]
+                + ([self.sponsor.get_feedname("ps")] if self.sponsor != None else [])
+                + [ix.get_feedname() for ix in terms]
+                + [cx.get_feedname("bills") for cx in committees]
+                + Bill.STATIC_EVENT_FEEDNAMES)
+
             # collect the feeds that we'll add major actions to
             bill_feed = self.get_feed()
             index_feeds = [bill_feed]
             if self.sponsor != None:
                 index_feeds.append(self.sponsor.get_feed("ps"))
-            index_feeds.extend([ix.get_feed() for ix in self.terms.all()])
-            index_feeds.extend([cx.get_feed("bills") for cx in self.committees.all()])
+            index_feeds.extend([ix.get_feed() for ix in terms])
+            index_feeds.extend([cx.get_feed("bills") for cx in committees])
             #index_feeds.extend([Feed.objects.get_or_create(feedname="usc:" + str(sec))[0] for sec in self.usc_citations_uptree()])
 
             # also index into feeds for any related bills and previous versions of this bill
@@ -734,10 +810,9 @@ class Bill(models.Model):
             # many dozens of other bills are attached to, but when tracking an approps bill
             # especially indirectly through a bill search users probably dont want to get
             # events on all of the bills related to what's in the approps bills
-            for rb in self.get_related_bills():
-                if rb.related_bill.relatedbills.count() <= 20:
-                    index_feeds.append(rb.related_bill.get_feed())
-            for b in self.find_reintroductions():
+            for rb in related_bills:
+                index_feeds.append(rb.get_feed())
+            for b in reintroductions:
                 index_feeds.append(b.get_feed())
 
             # generate events for major actions
@@ -1711,6 +1786,14 @@ def get_formatted_bill_summary(bill):
 
     return date, summary
 
+class BillPrognosis(models.Model):
+    """The prognosis of a current bill, computed by the parser when the bill or the model's inputs change so that pages and the search index don't evaluate the model."""
+    bill = models.OneToOneField(Bill, related_name="stored_prognosis", on_delete=models.CASCADE)
+    model_version = models.CharField(max_length=32, help_text="Identifies the prognosis model the prognosis was computed with.")
+    fingerprint = models.CharField(max_length=40, help_text="A hash of the model inputs the prognosis was computed from.")
+    prognosis = JSONField(help_text="The return value of compute_prognosis.")
+    proscore_prediction = models.FloatField(help_text="The prediction of compute_prognosis with proscore=True.")
+
 class BillLink(models.Model):
     bill = models.ForeignKey(Bill, db_index=True, related_name="links", on_delete=models.PROTECT)
     url = models.CharField(max_length=256)
@@ -59,6 +59,31 @@ def load_committee_membership(congress):
 			committee_membership[id][code] = ROLE_MAPPING[mnode.get("role", "Member")]
 	return committee_membership
 
+def get_congress_tables_key(congress):
+	# The tables are reloaded when the committee membership file changes or
+	# the person parser has updated the roles that the majority party is
+	# computed from since they were loaded.
+	import os.path
+	from django.db.models import Max
+	from parser.models import File
+	from settings import CONGRESS_PROJECT_PATH
+	try:
+		xml_mtime = os.stat("data/historical-committee-membership/%d.xml" % congress).st_mtime_ns
+	except OSError:
+		xml_mtime = None
+	roles_processed = File.objects.filter(path__startswith=CONGRESS_PROJECT_PATH + "/congress-legislators/")\
+		.aggregate(processed=Max("processed"))["processed"]
+	return (xml_mtime, roles_processed)
+
+cached_congress_tables = { }
+def load_congress_tables(congress):
+	# The majority party and committee membership tables for a Congress,
+	# which are kept in memory until their source data changes.
+	key = get_congress_tables_key(congress)
+	if congress not in cached_congress_tables or cached_congress_tables[congress][0] != key:
+		cached_congress_tables[congress] = (key, (load_majority_party(congress), load_committee_membership(congress)))
+	return cached_congress_tables[congress][1]
+
 cached_leadership_scores = { }
 def get_leadership_score(person):
 	if person.id in cached_leadership_scores: return cached_leadership_scores[person.id]
@@ -90,7 +115,45 @@ def load_lobbying_data(congress):
 			lobbying_data[(bt, bn)] = lobbying_data.get((bt, bn), 0) + 1
 	return { "median": median(lobbying_data.values()), "counts": lobbying_data }
 
-def get_bill_factors(bill, pop_title_prefixes, committee_membership, majority_party, lobbying_data, include_related_bills=True):
+def load_bill_factor_data(bills):
+	# Load what get_bill_factors queries for each bill for many bills at once,
+	# including their identical bills (which get_bill_factors recurses into).
+	bills = list(bills)
+	data = {
+		"cosponsors": { },
+		"committees": { },
+		"identical": { },
+		"previous_bills": { },
+	}
+	def chunks(ids):
+		ids = sorted(ids)
+		for i in range(0, len(ids), 500):
+			yield ids[i:i+500]
+
+	for chunk in chunks(set(bill.id for bill in bills)):
+		for rb in RelatedBill.objects.filter(bill_id__in=chunk, relation="identical").select_related("related_bill", "related_bill__sponsor", "related_bill__sponsor_role").order_by("id"):
+			data["identical"].setdefault(rb.bill_id, []).append(rb)
+	bills += [rb.related_bill for rbs in data["identical"].values() for rb in rbs]
+
+	for chunk in chunks(set(bill.id for bill in bills)):
+		for cosponsor in Cosponsor.objects.filter(bill_id__in=chunk, withdrawn=None).select_related("person", "role"):
+			data["cosponsors"].setdefault(cosponsor.bill_id, []).append(cosponsor)
+		for bc in Bill.committees.through.objects.filter(bill_id__in=chunk).select_related("committee").order_by("committee__name"):
+			data["committees"].setdefault(bc.bill_id, []).append(bc.committee)
+
+	sponsors = { }
+	for bill in bills:
+		if bill.sponsor_id: sponsors.setdefault(bill.congress-1, set()).add(bill.sponsor_id)
+	for congress, sponsor_ids in sponsors.items():
+		for chunk in chunks(sponsor_ids):
+			for reintro in Bill.objects.filter(congress=congress, sponsor_id__in=chunk).order_by("id"):
+				data["previous_bills"].setdefault((congress, reintro.sponsor_id), []).append(reintro)
+
+	return data
+
+def get_bill_factors(bill, pop_title_prefixes, committee_membership, majority_party, lobbying_data, include_related_bills=True, prefetched=None):
+	# prefetched is optionally the return value of load_bill_factor_data
+	# for a set of bills including this one.
 	factors = list()
 	
 	# introduced date (idea from Yano, Smith and Wilkerson 2012 paper)
@@ -108,8 +171,12 @@ def get_bill_factors(bill, pop_title_prefixes, committee_membership, majority_pa
 		if bill.title_no_number.startswith(prefix + " "):
 			factors.append(("startswith:" + prefix, "The %s's title starts with \"%s.\"" % (bill.noun, prefix), "Title starts with \"%s\"." % prefix))
 	
-	cosponsors = list(Cosponsor.objects.filter(bill=bill, withdrawn=None).select_related("person"))
-	committees = list(bill.committees.all())
+	if prefetched is not None:
+		cosponsors = prefetched["cosponsors"].get(bill.id, [])
+		committees = prefetched["committees"].get(bill.id, [])
+	else:
+		cosponsors = list(Cosponsor.objects.filter(bill=bill, withdrawn=None).select_related("person"))
+		committees = list(bill.committees.all())
 	
 	maj_party = majority_party[bill.bill_type]
 	
@@ -186,7 +253,11 @@ def get_bill_factors(bill, pop_title_prefixes, committee_membership, majority_pa
 		def normalize_title(title):
 			# remove anything that looks like a year
 			return re.sub(r"of \d\d\d\d$", "", title)
-		for reintro in Bill.objects.filter(congress=bill.congress-1, sponsor=bill.sponsor):
+		if prefetched is not None:
+			reintros = prefetched["previous_bills"].get((bill.congress-1, bill.sponsor_id), [])
+		else:
+			reintros = Bill.objects.filter(congress=bill.congress-1, sponsor=bill.sponsor)
+		for reintro in reintros:
 			if normalize_title(bill.title_no_number) == normalize_title(reintro.title_no_number):
 				if reintro.current_status != BillStatus.introduced:
 					factors.append(("reintroduced_of_reported", "This %s was reported by committee as %s in the previous session of Congress." % (bill.noun, reintro.display_number), "Got past committee in a previous Congress."))
@@ -198,7 +269,11 @@ def get_bill_factors(bill, pop_title_prefixes, committee_membership, majority_pa
 		# Add factors from any CRS-identified identical bill, changing most factors'
 		# key into companion_KEY so that they become separate factors to consider.
 		# For some specific factors, lump them in with the factor for the bill itself.
-		for rb in RelatedBill.objects.filter(bill=bill, relation="identical").select_related("related_bill", "related_bill__sponsor_role"):
+		if prefetched is not None:
+			identical = prefetched["identical"].get(bill.id, [])
+		else:
+			identical = RelatedBill.objects.filter(bill=bill, relation="identical").select_related("related_bill", "related_bill__sponsor_role")
+		for rb in identical:
 			# has a companion
 			factors.append(("companion", "The %s has been introduced in both chambers (the other is %s)." % (bill.noun, rb.related_bill.display_number), "Has a companion bill in the other chamber."))
 			
@@ -207,7 +282,7 @@ def get_bill_factors(bill, pop_title_prefixes, committee_membership, majority_pa
 				if bill.sponsor_role.party != rb.related_bill.sponsor_role.party:
 					factors.append(("companion_bipartisan", "The %s's companion %s was sponsored by a member of the other party." % (bill.noun, rb.related_bill.display_number), "Has a companion bill sponsored by a member of the other party."))
 			
-			for f in get_bill_factors(rb.related_bill, pop_title_prefixes, committee_membership, majority_party, lobbying_data, include_related_bills=False):
+			for f in get_bill_factors(rb.related_bill, pop_title_prefixes, committee_membership, majority_party, lobbying_data, include_related_bills=False, prefetched=prefetched):
 				if "startswith" in f[0]: continue # don't include title factors because the title is probs the same
 				if f[0] in ("introduced_first90days", "introduced_last90days", "introduced_firstyear", "reintroduced_of_reported", "reintroduced") or f[0].startswith("committee_"):
 					f = (f[0], "%s (on companion bill %s)" % (f[1], rb.related_bill.display_number), f[2])
@@ -497,6 +572,14 @@ def compute_prognosis_2(prognosis_model, bill, committee_membership, majority_pa
 	model_1 = prognosis_model.factors[(bill_type_map_inv[bill.bill_type], True)]
 	model_2 = prognosis_model.factors[(bill_type_map_inv[bill.bill_type], False)]
 	
+	factors = filter_model_factors(factors, model_1, model_2, proscore)
+
+	prediction_1 = eval_model(model_1, [factors])[0]
+	prediction_2 = eval_model(model_2, [factors])[0]
+
+	return make_prognosis(bill, factors, model_1, model_2, prediction_1, prediction_2, testing)
+
+def filter_model_factors(factors, model_1, model_2, proscore):
 	# Eliminate factors that are not used in either model.
 	factors = [f for f in factors if f[0] in model_1["factors"] or f[0] in model_2["factors"]]
 	
@@ -510,20 +593,22 @@ def compute_prognosis_2(prognosis_model, bill, committee_membership, majority_pa
 			or (key in model_1["factors"] and model_1["factors"][key]["regression_beta"] < 0)
 			or (key in model_2["factors"] and model_2["factors"][key]["regression_beta"] < 0)]
 
-	def eval_model(model):
-		# make a prediction using the logistic regression model
-		if model["regression_beta"] == None:
-			return model["success_rate"]
-		else:
-			factor_keys = set(f[0] for f in factors)
-			predictors = [0.0 for f in range(len(model["regression_beta"])-1)] # remove the intercept
-			for key, index in model["regression_predictors_map"].items():
-				predictors[index] = 1.0 if key in factor_keys else 0.0
-			return float(calcprob(model["regression_beta"], numpy.transpose(numpy.array([predictors]))))
-			
-	prediction_1 = eval_model(model_1)
-	prediction_2 = eval_model(model_2)
-	
+	return factors
+
+def eval_model(model, factor_lists):
+	# make a prediction using the logistic regression model for each
+	# list of factors, with one predictor column per list
+	if model["regression_beta"] == None:
+		return [model["success_rate"]] * len(factor_lists)
+	predictors = numpy.zeros((len(model["regression_beta"])-1, len(factor_lists))) # remove the intercept
+	for j, factors in enumerate(factor_lists):
+		for key, descr, gen_descr in factors:
+			index = model["regression_predictors_map"].get(key)
+			if index is not None:
+				predictors[index, j] = 1.0
+	return [float(p) for p in numpy.ravel(calcprob(model["regression_beta"], predictors))]
+
+def make_prognosis(bill, factors, model_1, model_2, prediction_1, prediction_2, testing):
 	is_introduced = bill.current_status == BillStatus.introduced
 	
 	def helps(factor, state1, state2):
@@ -554,12 +639,156 @@ def compute_prognosis_2(prognosis_model, bill, committee_membership, majority_pa
 
 def compute_prognosis(bill, proscore=False):
 	from . import prognosis_model
-	majority_party = load_majority_party(bill.congress)
-	committee_membership = load_committee_membership(bill.congress)
+	majority_party, committee_membership = load_congress_tables(bill.congress)
 	prog = compute_prognosis_2(prognosis_model, bill, committee_membership, majority_party, None, proscore=proscore)
 	prog["congress"] = prognosis_model.congress
 	return prog
-		
+
+def compute_bill_factors_batch(bills):
+	# Returns a dict from bill id to get_bill_factors for many bills, computed
+	# from data loaded with a few queries for the whole batch.
+	from . import prognosis_model
+	bills = list(bills)
+	prefetched = load_bill_factor_data(bills)
+	tables = { congress: load_congress_tables(congress) for congress in set(bill.congress for bill in bills) }
+	ret = { }
+	for bill in bills:
+		majority_party, committee_membership = tables[bill.congress]
+		ret[bill.id] = get_bill_factors(bill, prognosis_model.pop_title_prefixes, committee_membership, majority_party, None, prefetched=prefetched)
+	return ret
+
+def compute_prognosis_batch(bills, proscore=False, factors=None):
+	# Computes the same thing as compute_prognosis for many bills at once,
+	# returning a dict from bill id to prognosis. Each model is evaluated over
+	# all of the bills it applies to at once. factors is optionally the return
+	# value of compute_bill_factors_batch for the bills.
+	from . import prognosis_model
+	bills = list(bills)
+	if factors is None:
+		factors = compute_bill_factors_batch(bills)
+
+	bills_by_type = { }
+	for bill in bills:
+		bill_type = bill_type_map_inv[bill.bill_type]
+		bill_factors = filter_model_factors(factors[bill.id], prognosis_model.factors[(bill_type, True)], prognosis_model.factors[(bill_type, False)], proscore)
+		bills_by_type.setdefault(bill_type, []).append((bill, bill_factors))
+
+	ret = { }
+	for bill_type, items in bills_by_type.items():
+		model_1 = prognosis_model.factors[(bill_type, True)]
+		model_2 = prognosis_model.factors[(bill_type, False)]
+		predictions_1 = eval_model(model_1, [factors for bill, factors in items])
+		predictions_2 = eval_model(model_2, [factors for bill, factors in items])
+		for (bill, factors), prediction_1, prediction_2 in zip(items, predictions_1, predictions_2):
+			prog = make_prognosis(bill, factors, model_1, model_2, prediction_1, prediction_2, False)
+			prog["congress"] = prognosis_model.congress
+			ret[bill.id] = prog
+	return ret
+
+cached_model_version = None
+def prognosis_model_version():
+	# Identifies the generated model so that stored prognoses computed
+	# with a different model are ignored.
+	global cached_model_version
+	if cached_model_version is None:
+		import hashlib
+		from . import prognosis_model
+		h = hashlib.sha1(repr((prognosis_model.pop_title_prefixes, prognosis_model.factors)).encode("utf8")).hexdigest()
+		cached_model_version = "%d-%s" % (prognosis_model.congress, h[:12])
+	return cached_model_version
+
+def get_prognosis_fingerprint(bill, factors):
+	# A hash of everything the stored prognosis of a bill depends on
+	# besides the model.
+	import hashlib, json
+	return hashlib.sha1(json.dumps([
+		int(bill.bill_type),
+		int(bill.current_status),
+		sorted([key, descr] for key, descr, gen_descr in factors),
+	]).encode("utf8")).hexdigest()
+
+def update_stored_prognoses(bills):
+	# Recompute and store the prognosis of each bill that is current and whose
+	# model or inputs changed since it was last stored, and remove stored
+	# prognoses for bills that are no longer current. Returns the number of
+	# prognoses written.
+	from .models import BillPrognosis
+	bills = list(bills)
+	current = [bill for bill in bills if bill.is_current]
+	version = prognosis_model_version()
+
+	existing = { }
+	for i in range(0, len(bills), 500):
+		for stored in BillPrognosis.objects.filter(bill_id__in=[bill.id for bill in bills[i:i+500]]):
+			existing[stored.bill_id] = stored
+
+	stale = [existing[bill.id].id for bill in bills if not bill.is_current and bill.id in existing]
+	for i in range(0, len(stale), 500):
+		BillPrognosis.objects.filter(id__in=stale[i:i+500]).delete()
+
+	factors = compute_bill_factors_batch(current)
+	fingerprints = { bill.id: get_prognosis_fingerprint(bill, factors[bill.id]) for bill in current }
+	changed = [bill for bill in current
+		if bill.id not in existing
+		or existing[bill.id].model_version != version
+		or existing[bill.id].fingerprint != fingerprints[bill.id]]
+	if not changed: return 0
+
+	progs = compute_prognosis_batch(changed, factors=factors)
+	proscore_progs = compute_prognosis_batch(changed, proscore=True, factors=factors)
+	to_update, to_create = [], []
+	for bill in changed:
+		stored = existing.get(bill.id) or BillPrognosis(bill=bill)
+		stored.model_version = version
+		stored.fingerprint = fingerprints[bill.id]
+		stored.prognosis = progs[bill.id]
+		stored.proscore_prediction = proscore_progs[bill.id]["prediction"]
+		(to_update if stored.id else to_create).append(stored)
+	BillPrognosis.objects.bulk_update(to_update, ["model_version", "fingerprint", "prognosis", "proscore_prediction"], batch_size=500)
+	BillPrognosis.objects.bulk_create(to_create, batch_size=500)
+	return len(changed)
+
+def update_stored_prognoses_by_id(bill_ids):
+	# Runs update_stored_prognoses in chunks for bills given by id.
+	bill_ids = sorted(set(bill_ids))
+	count = 0
+	for i in range(0, len(bill_ids), 500):
+		count += update_stored_prognoses(Bill.objects.filter(id__in=bill_ids[i:i+500]).select_related("sponsor", "sponsor_role"))
+	return count
+
+def benchmark_prognosis(congress):
+	# Time scoring all of the bills in a Congress one at a time vs. in a batch,
+	# and check that they agree.
+	import time
+	from . import prognosis_model
+
+	bills = list(Bill.objects.filter(congress=congress).select_related("sponsor", "sponsor_role"))
+
+	start = time.time()
+	load_majority_party(congress)
+	load_committee_membership(congress)
+	print("loading tables: %.1f ms" % ((time.time() - start) * 1000))
+	majority_party, committee_membership = load_congress_tables(congress)
+
+	start = time.time()
+	one_at_a_time = { bill.id: compute_prognosis_2(prognosis_model, bill, committee_membership, majority_party, None, proscore=True) for bill in bills }
+	elapsed_single = time.time() - start
+
+	start = time.time()
+	batch = compute_prognosis_batch(bills, proscore=True)
+	elapsed_batch = time.time() - start
+
+	for bill in bills:
+		a, b = one_at_a_time[bill.id], batch[bill.id]
+		assert abs(a["prediction"] - b["prediction"]) < 1e-9, (bill, a["prediction"], b["prediction"])
+		for key in ("factors_help_help", "factors_hurt_hurt", "factors_help_hurt", "factors_hurt_help"):
+			assert sorted(a[key]) == sorted(b[key]), (bill, key)
+
+	print("%d bills: one at a time %.1f s (%.1f bills/sec), batch %.1f s (%.1f bills/sec)" % (
+		len(bills),
+		elapsed_single, len(bills) / elapsed_single,
+		elapsed_batch, len(bills) / elapsed_batch))
+
 def test_prognosis(congress):
 	from math import exp
 	from numpy import mean, median, std, digitize, percentile, average
@@ -768,3 +997,5 @@ if __name__ == "__main__":
 		index_successful_paragraphs(114)
 	elif sys.argv[-1] == "dump":
 		dump_prognosis(118)
+	elif sys.argv[-2] == "benchmark":
+		benchmark_prognosis(int(sys.argv[-1]))
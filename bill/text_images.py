@@ -0,0 +1,203 @@
+# Images of the first pages of bill text PDFs, which are used for bill
+# thumbnails and social media cards.
+#
+# Rasterizing a PDF with pdftoppm takes a while, and crawlers fetching the
+# cards of many bills at once used to tie up all of the web workers. So
+# page images are rendered by a small pool of background processes in each
+# web process, and a request waits only briefly for its image before
+# getting a placeholder. Concurrent requests for the same image share one
+# render. Rendered images are stored in a cache directory, named by a hash
+# of the PDF's identity (its path, size, and modification time, which is
+# much cheaper than hashing the PDF itself on each request) and the image
+# width and aspect ratio. "manage.py prerender_bill_text_images" renders
+# the common sizes for new text versions ahead of time.
+
+import concurrent.futures, hashlib, io, json, os, re, threading
+
+IMAGE_CACHE_PATH = "data/misc/bill-text-images"
+IMAGE_VERSION = 1 # increment when the rendering changes to invalidate cached images
+RENDER_WORKERS = 2 # number of render processes per web process
+MAX_PENDING = 50 # beyond this many queued renders, serve placeholders without queuing
+RENDER_WAIT = 4.0 # seconds that a request waits for a render before getting a placeholder
+
+# The (width, aspect) sizes that the site's templates link to.
+PRERENDER_SIZES = ((0, 240.0/200.0), (0, .5), (0, .5625), (75, 240.0/200.0), (125, 1.2))
+
+def get_pdf_source(metadata):
+    # Returns a dict describing where to get the PDF of a text version
+    # from its metadata, or None if no PDF is available.
+    from django.conf import settings
+    if metadata.get("pdf_file"):
+        return { "pdf_file": metadata["pdf_file"] }
+    if metadata.get("govinfo_package_file"):
+        return { "govinfo_package_file": metadata["govinfo_package_file"] }
+    if settings.DEBUG and metadata.get("gpo_pdf_url"):
+        # When debugging in a local environment we may not have bill text available
+        # so download the PDF from GPO.
+        return { "url": metadata["gpo_pdf_url"] }
+    return None
+
+def get_image_key(source, width, aspect):
+    if "url" in source:
+        identity = source["url"]
+    else:
+        fn = source.get("pdf_file") or source["govinfo_package_file"]
+        st = os.stat(fn)
+        identity = [fn, st.st_size, st.st_mtime_ns]
+    return hashlib.sha1(json.dumps([IMAGE_VERSION, identity, width, round(aspect, 3)]).encode("utf8")).hexdigest()
+
+def get_image_path(key):
+    return os.path.join(IMAGE_CACHE_PATH, key[0:2], key + ".png")
+
+def read_pdf(source):
+    # Use the PDF files on disk, or extract from the package.zip file, or download the PDF on the fly.
+    if "pdf_file" in source:
+        with open(source["pdf_file"], 'rb') as f:
+            return f.read()
+    elif "govinfo_package_file" in source:
+        import zipfile
+        with zipfile.ZipFile(source["govinfo_package_file"]) as zf:
+            for n in zf.namelist():
+                if re.search(r"/pdf/.*.pdf$", n):
+                    return zf.read(n)
+        raise LookupError("No PDF is available in %s." % source["govinfo_package_file"])
+    else:
+        import subprocess
+        return subprocess.check_output(["/usr/bin/wget", "-O", "-", "-q", source["url"]])
+
+def pdftopng(pdf_bytes, pagenumber, width=900):
+    # Rasterizes a page of a PDF to a greyscale PIL.Image.
+    # Crop out the GPO seal & the vertical margins.
+    from PIL import Image, ImageOps
+    import subprocess
+    pngbytes = subprocess.check_output(["/usr/bin/pdftoppm", "-f", str(pagenumber), "-l", str(pagenumber), "-scale-to", str(width), "-png", "-"],
+        input=pdf_bytes)
+    im = Image.open(io.BytesIO(pngbytes))
+    im = im.convert("L")
+
+    # crop out the GPO seal:
+    im = im.crop((0, int((.06 if pagenumber==1 else 0) * im.size[0]), im.size[0], im.size[1]))
+
+    # zealous-crop the vertical margins, but at least leaving a little
+    # at the bottom so that when we paste the two pages of the two images
+    # together they don't get totally scruntched, and put in some padding
+    # at the top.
+    # (.getbbox() crops out zeroes, so we'll invert the image to make it work with white)
+    bbox = ImageOps.invert(im).getbbox()
+    vpad = int(.02*im.size[1])
+    if bbox:
+        im = im.crop( (0, max(0, bbox[1]-vpad), im.size[0], min(im.size[1], bbox[3]+vpad) ) )
+
+    return im
+
+def make_page_image(pg1, pg2, width, aspect):
+    # Since some bills have big white space at the top of the first page,
+    # we'll combine the first two pages and then shift the window down
+    # until the real start of the bill.
+    from PIL import Image, ImageOps
+    img = Image.new(pg1.mode, (pg1.size[0], int(pg1.size[1]+pg2.size[1])))
+    img.paste(pg1, (0,0))
+    img.paste(pg2, (0,pg1.size[1]))
+
+    # Zealous crop the (horizontal) margins. We do this only after the two
+    # pages have been combined so that we don't mess up their alignment.
+    # Add some padding.
+    hpad = int(.02*img.size[0])
+    bbox = ImageOps.invert(img).getbbox()
+    if bbox: # if image is empty, bbox is None
+        img = img.crop( (max(0, bbox[0]-hpad), 0, min(img.size[0], bbox[2]+hpad), img.size[1]) )
+
+    # Now take a window from the top matching a particular aspect ratio.
+    img = img.crop((0,0, img.size[0], int(aspect*img.size[0])))
+
+    # Resize to requested width.
+    if width:
+        img.thumbnail((width, int(aspect*width)), Image.LANCZOS)
+
+    return img
+
+def rasterize_pdf(source):
+    # Rasterize the first two pages of the PDF.
+    pdf_bytes = read_pdf(source)
+    pg1 = pdftopng(pdf_bytes, 1)
+    try:
+        pg2 = pdftopng(pdf_bytes, 2)
+    except:
+        pg2 = pg1.crop((0, 0, pg1.size[0], 0)) # may only be one page!
+    return (pg1, pg2)
+
+def save_image(img, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = "%s.%d.tmp" % (path, os.getpid())
+    img.save(tmp_path, "PNG")
+    os.replace(tmp_path, path)
+
+def render_page_image(source, width, aspect, path):
+    # Renders a page image into the cache and returns its path. This runs
+    # in the render processes and doesn't use Django.
+    pg1, pg2 = rasterize_pdf(source)
+    save_image(make_page_image(pg1, pg2, width, aspect), path)
+    return path
+
+render_pool = None
+pending_renders = { } # image key => Future
+pending_renders_lock = threading.Lock()
+
+def submit_render(key, source, width, aspect):
+    # Queue a render unless one is already queued for the same image, and
+    # return its Future, or None if too many renders are queued.
+    global render_pool
+    with pending_renders_lock:
+        future = pending_renders.get(key)
+        if future is not None:
+            return future
+        if len(pending_renders) >= MAX_PENDING:
+            return None
+        if render_pool is None:
+            # Spawn rather than fork the render processes so that they don't
+            # inherit the web process's threads and database connections.
+            import multiprocessing
+            render_pool = concurrent.futures.ProcessPoolExecutor(RENDER_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+        try:
+            future = render_pool.submit(render_page_image, source, width, aspect, get_image_path(key))
+        except concurrent.futures.process.BrokenProcessPool:
+            render_pool = None
+            raise
+        pending_renders[key] = future
+
+    def done(future):
+        with pending_renders_lock:
+            if pending_renders.get(key) is future:
+                del pending_renders[key]
+    future.add_done_callback(done)
+    return future
+
+def get_page_image(source, width, aspect, wait=RENDER_WAIT):
+    # Returns the path to the page image, or None if it is still being
+    # rendered. Raises LookupError if the source has no PDF.
+    key = get_image_key(source, width, aspect)
+    path = get_image_path(key)
+    if os.path.exists(path):
+        return path
+    future = submit_render(key, source, width, aspect)
+    if future is None:
+        return None
+    try:
+        return future.result(timeout=wait)
+    except concurrent.futures.TimeoutError:
+        return None
+
+def prerender_page_images(source):
+    # Renders the page images of a text version in PRERENDER_SIZES in the
+    # current process, skipping ones that are already cached, and returns
+    # the number rendered.
+    count = 0
+    pages = None
+    for width, aspect in PRERENDER_SIZES:
+        path = get_image_path(get_image_key(source, width, aspect))
+        if os.path.exists(path): continue
+        if pages is None:
+            pages = rasterize_pdf(source) # once for all of the sizes
+        save_image(make_page_image(pages[0], pages[1], width, aspect), path)
+        count += 1
+    return count
@@ -612,7 +612,7 @@ def make_bill_text_comparison(left_bill, left_version, right_bill, right_version
             pass
 
     # Load bill text metadata.
-    from .billtext import load_bill_text
+    from .billtext import load_bill_text, load_bill_text_xml_dom
     left = load_bill_text(left_bill, left_version, mods_only=True)
     right = load_bill_text(right_bill, right_version, mods_only=True)
 
@@ -622,8 +622,7 @@ def make_bill_text_comparison(left_bill, left_version, right_bill, right_version
         # into HTML. Otherwise use the legacy HTML that we
         # scraped from THOMAS.
         if "xml_file" in docinfo:
-            import congressxml
-            return congressxml.convert_xml(docinfo["xml_file"])
+            return load_bill_text_xml_dom(docinfo["xml_file"])
         elif "html_file" in docinfo:
             return lxml.etree.parse(docinfo["html_file"])
         else:
@@ -1005,33 +1004,7 @@ def bill_text_image(request, congress, type_slug, number, image_type):
         aspect = 240.0/200.0
     if image_type == "card": aspect = .5 # height/width
 
-    # Rasterizes a page of a PDF to a greyscale PIL.Image.
-    # Crop out the GPO seal & the vertical margins.
-    def pdftopng(pdf_bytes, pagenumber, width=900):
-        from PIL import Image
-        import subprocess, io
-        pngbytes = subprocess.check_output(["/usr/bin/pdftoppm", "-f", str(pagenumber), "-l", str(pagenumber), "-scale-to", str(width), "-png", "-"],
-            input=pdf_bytes)
-        im = Image.open(io.BytesIO(pngbytes))
-        im = im.convert("L")
-
-        # crop out the GPO seal:
-        im = im.crop((0, int((.06 if pagenumber==1 else 0) * im.size[0]), im.size[0], im.size[1]))
-
-        # zealous-crop the vertical margins, but at least leaving a little
-        # at the bottom so that when we paste the two pages of the two images
-        # together they don't get totally scruntched, and put in some padding
-        # at the top.
-        # (.getbbox() crops out zeroes, so we'll invert the image to make it work with white)
-        from PIL import ImageOps
-        bbox = ImageOps.invert(im).getbbox()
-        vpad = int(.02*im.size[1])
-        if bbox:
-            im = im.crop( (0, max(0, bbox[1]-vpad), im.size[0], min(im.size[1], bbox[3]+vpad) ) )
-
-        return im
-
-    # Find the PDF file and rasterize the first two pages.
+    # Find the PDF file and get an image of its first page(s).
 
     textversion = request.GET.get("textversion") # usually None
     if textversion and not re.match("^[a-z0-9-]+$", textversion): raise Http404()
@@ -1042,78 +1015,35 @@ def bill_text_image(request, congress, type_slug, number, image_type):
         # if bill text metadata isn't available, we won't show the bill text as a part of the thumbnail
         metadata = None
 
-    cache_fn = None
-
     from PIL import Image
+    from .text_images import get_pdf_source, get_page_image
 
-    if not metadata or not metadata.get("thumbnail_base_path"):
-        # Start with a blank page.
-        w = max(width, 100)
-        pg1 = Image.new("RGB", (w, int(aspect*w)), color=(255,255,255))
-        pg2 = pg1
-    else:
-        # Check if we have a cached file. We want to cache longer than our HTTP cache
-        # because these thumbnails basically never change and calling pdftoppm is expensive.
-        # But see run_scrapers.py for how we can periodically delete old thumbnail files
-        # because they take up a ton of disk space.
-        import os.path
-        cache_fn = metadata["thumbnail_base_path"] + "-" + image_type + "_" + str(width) + "_" + str(round(aspect,3)) + ".png"
-        if os.path.exists(cache_fn):
-            with open(cache_fn, "rb") as f:
-                return HttpResponse(f.read(), content_type="image/png")
-
-        # Use the PDF files on disk, or extract from the package.zip file, or download the PDF on the fly.
-        if metadata.get("pdf_file"):
-            with open(metadata["pdf_file"], 'rb') as f:
-                pdf_bytes = f.read()
-        elif metadata.get("govinfo_package_file"):
-            import zipfile
-            with zipfile.ZipFile(metadata["govinfo_package_file"]) as zf:
-                for n in zf.namelist():
-                    if re.search(r"/pdf/.*.pdf$", n):
-                        pdf_bytes = zf.read(n)
-                        break
-                else:
-                    # No PDF is available.
-                    raise Http404()
-        elif settings.DEBUG and metadata.get("gpo_pdf_url"):
-            # When debugging in a local environment we may not have bill text available
-            # so download the PDF from GPO.
-            import os, tempfile, subprocess
-            pdf_bytes = subprocess.check_output(["/usr/bin/wget", "-O", "-", "-q", metadata["gpo_pdf_url"]])
-        else:
+    img = None
+    is_placeholder = False
+    if metadata and metadata.get("thumbnail_base_path"):
+        source = get_pdf_source(metadata)
+        if not source:
             # No PDF is available.
             raise Http404()
-
-        pg1 = pdftopng(pdf_bytes, 1)
         try:
-            pg2 = pdftopng(pdf_bytes, 2)
-        except:
-            pg2 = pg1.crop((0, 0, pg1.size[0], 0)) # may only be one page!
-
-
-    # Since some bills have big white space at the top of the first page,
-    # we'll combine the first two pages and then shift the window down
-    # until the real start of the bill.
-    img = Image.new(pg1.mode, (pg1.size[0], int(pg1.size[1]+pg2.size[1])))
-    img.paste(pg1, (0,0))
-    img.paste(pg2, (0,pg1.size[1]))
-
-    # Zealous crop the (horizontal) margins. We do this only after the two
-    # pages have been combined so that we don't mess up their alignment.
-    # Add some padding.
-    from PIL import ImageOps
-    hpad = int(.02*img.size[0])
-    bbox = ImageOps.invert(img).getbbox()
-    if bbox: # if image is empty, bbox is None
-        img = img.crop( (max(0, bbox[0]-hpad), 0, min(img.size[0], bbox[2]+hpad), img.size[1]) )
-
-    # Now take a window from the top matching a particular aspect ratio.
-    img = img.crop((0,0, img.size[0], int(aspect*img.size[0])))
+            page_image_fn = get_page_image(source, width, aspect)
+        except LookupError:
+            # No PDF is available.
+            raise Http404()
+        if page_image_fn:
+            # Without symbology, the cached page image is the response.
+            if image_type not in ("thumbnail", "card"):
+                with open(page_image_fn, "rb") as f:
+                    return HttpResponse(f.read(), content_type="image/png")
+            img = Image.open(page_image_fn)
+        else:
+            # The page image is still being rendered.
+            is_placeholder = True
 
-    # Resize to requested width.
-    if width:
-        img.thumbnail((width, int(aspect*width)), Image.LANCZOS)
+    if img is None:
+        # Start with a blank page.
+        w = max(width, 100)
+        img = Image.new("L", (w, int(aspect*w)), color=255)
 
     # Add symbology.
     if image_type in ("thumbnail", "card"):
@@ -1147,13 +1077,12 @@ def bill_text_image(request, congress, type_slug, number, image_type):
     imgbytes = imgbytesbuf.getvalue()
     imgbytesbuf.close()
 
-    # Save to cache.
-    if cache_fn:
-        with open(cache_fn, "wb") as f:
-            f.write(imgbytes)
-
-    # Return.
-    return HttpResponse(imgbytes, content_type="image/png")
+    # Return. Don't let placeholders be cached long.
+    response = HttpResponse(imgbytes, content_type="image/png")
+    if is_placeholder:
+        from django.utils.cache import patch_cache_control
+        patch_cache_control(response, max_age=60)
+    return response
 
 @anonymous_view
 def bill_get_json(request, congress, type_slug, number):
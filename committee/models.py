@@ -166,9 +166,12 @@ class Committee(models.Model):
             }
 
     def get_feed(self, feed_type=""):
-        if feed_type not in ("", "bills", "meetings"): raise ValueError(feed_type)
         from events.models import Feed
-        return Feed.objects.get_or_create(feedname="committee%s:%s" % (feed_type, self.code))[0]
+        return Feed.get_cached(self.get_feedname(feed_type))
+
+    def get_feedname(self, feed_type=""):
+        if feed_type not in ("", "bills", "meetings"): raise ValueError(feed_type)
+        return "committee%s:%s" % (feed_type, self.code)
 
     @staticmethod
     def from_feed(feed, test=False):
@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+import time
+
+from events.models import Feed
+
+class Command(BaseCommand):
+	help = 'Times Feed.get_events_for on the most active feeds with one query per feed vs. combined queries.'
+
+	def add_arguments(self, parser):
+		parser.add_argument('--count', type=int, default=20, help='number of events to fetch')
+		parser.add_argument('--sizes', default='1,10,100,1000', help='comma-separated numbers of feeds to query at once')
+		parser.add_argument('--repeat', type=int, default=3, help='number of runs to average over')
+
+	def handle(self, *args, **options):
+		sizes = [int(n) for n in options["sizes"].split(",")]
+
+		# Take the feeds with the most recent events, since those are the ones
+		# users track.
+		with connection.cursor() as cursor:
+			cursor.execute("SELECT feed_id FROM events_event GROUP BY feed_id ORDER BY MAX(id) DESC LIMIT %s", [max(sizes)])
+			feed_ids = [row[0] for row in cursor.fetchall()]
+		feeds = list(Feed.objects.filter(id__in=feed_ids))
+
+		for n in sizes:
+			if n > len(feeds):
+				print("Only", len(feeds), "feeds have events, skipping", n)
+				continue
+			results = { }
+			for label, feeds_per_query in (("per-feed", 1), ("combined", Feed.FEEDS_PER_QUERY)):
+				start = time.time()
+				for i in range(options["repeat"]):
+					events = Feed.get_events_for(feeds[0:n], options["count"], feeds_per_query=feeds_per_query)
+				results[label] = ((time.time() - start) / options["repeat"], events)
+			assert [(e["source_content_type"], e["source_object_id"], e["eventid"]) for e in results["per-feed"][1]] \
+			    == [(e["source_content_type"], e["source_object_id"], e["eventid"]) for e in results["combined"][1]]
+			print("%5d feeds: per-feed %8.1f ms, combined %8.1f ms" % (n, results["per-feed"][0]*1000, results["combined"][0]*1000))
@@ -5,6 +5,7 @@ from django.template import Context, Template
 from django.template.loader import get_template
 from django.conf import settings
 import django.core.mail
+from django.core.mail.backends.base import BaseEmailBackend
 
 from optparse import make_option
 
@@ -14,6 +15,7 @@ from emailverification.models import Ping, BouncedEmail
 from htmlemailer import send_mail as send_html_mail
 
 import os, sys
+import queue, threading, time
 from datetime import datetime, timedelta
 import yaml
 from website.templatetags.govtrack_utils import markdown
@@ -30,9 +32,7 @@ launch_time = datetime.now()
 import multiprocessing
 django.setup() # StackOverflow user says call setup when using multiprocessing
 
-#if debugging single-threade
-#global_mail_connection = django.core.mail.get_connection()
-#global_mail_connection.open()
+#if debugging single-threaded, see the commented-out lines in the main loop
 
 # globals that are loaded by the parent process before forking children
 utm = "utm_campaign=govtrack_email_update&utm_source=govtrack/email_update&utm_medium=email"
@@ -40,6 +40,25 @@ template_body_text = None
 template_body_html = None
 latest_blog_post_by_category = None
 prev_blog_post_creation_dates = None
+event_inboxes = None
+
+# users are loaded and filtered in chunks of this size and sent to
+# the workers in batches of this size
+USER_CHUNK_SIZE = 5000
+USER_BATCH_SIZE = 10
+
+# Emails are rendered by a pool of worker processes (one per CPU) and handed
+# back to the parent, which sends them over a small pool of persistent mail
+# connections. Sparkpost says have up to 10 concurrent connections. The queue
+# between the stages is bounded so rendering can't run far ahead of sending.
+SEND_CONNECTIONS = 5
+SEND_QUEUE_SIZE = 100
+SEND_TIMEOUT = 60 # seconds
+SEND_RETRIES = 2
+# Render workers forked up front to replace workers that get stuck or die,
+# since forking once the sender threads are running could leave the child
+# holding a lock (e.g. stdout's) that another thread had taken.
+SPARE_WORKERS = 2
 
 class Command(BaseCommand):
 	help = 'Sends out email updates of events to subscribing users.'
@@ -50,6 +69,7 @@ class Command(BaseCommand):
 	def handle(self, *args, **options):
 		global template_body_text
 		global template_body_html
+		global event_inboxes
 
 		if options["mode"][0] not in ('daily', 'weekly', 'testadmin', 'testcount'):
 			print("Specify daily or weekly or testadmin or testcount.")
@@ -89,40 +109,110 @@ class Command(BaseCommand):
 
 		# enable caching during event generation
 		enable_event_source_caching()
+		enable_feed_caching()
+		Feed.prefetch(Feed.objects.filter(tracked_in_lists__email__gt=0).values_list("feedname", flat=True).distinct(), create=False)
 
 		# load globals
 		template_body_text = get_template("events/emailupdate_body.txt")
 		template_body_html = get_template("events/emailupdate_body.html")
 		load_latest_blog_posts()
 
-		# counters for analytics on what we sent
+		# Get the new events for all of the lists we might email in one pass over the
+		# events table rather than one query per list. The workers are forked after
+		# this, so they share it. When sending old events (for testing), the lists are
+		# queried individually.
+		if not send_old_events:
+			event_inboxes = SubscriptionList.prepare_inboxes(
+				SubscriptionList.objects.filter(user_id__in=users.values("id"), email__in=list_email_freq))
+
+		# counters for analytics on what we sent, for the render stage --- the send
+		# stage keeps its own
 		counts = {
-			"total_emails_sent": 0,
+			"total_emails_rendered": 0,
 			"total_events_sent": 0,
 			"total_users_skipped_stale": 0,
 			"total_users_skipped_bounced": 0,
 			"total_time_querying": timedelta(seconds=0),
 			"total_time_rendering": timedelta(seconds=0),
-			"total_time_sending": timedelta(seconds=0),
 		}
 
+		# Stream the users in id order in chunks, and for each chunk load what we need
+		# to skip ineligible users and the ids of their lists with email updates turned
+		# on with a few set-based queries. Yields (user id, [list id, ...]) tuples.
+		def user_iterator():
+			last_id = 0
+			while True:
+				chunk = list(users.filter(id__gt=last_id)[0:USER_CHUNK_SIZE])
+				if len(chunk) == 0: break
+				last_id = chunk[-1]["id"]
+				user_ids = [user["id"] for user in chunk]
+
+				profiles = { prof.user_id: prof for prof in UserProfile.objects.filter(user_id__in=user_ids).select_related("user") }
+				bounced = set(BouncedEmail.objects.filter(user_id__in=user_ids).values_list("user_id", flat=True))
+				sublists = { }
+				for user_id, sublist_id in SubscriptionList.objects.filter(user_id__in=user_ids, email__in=list_email_freq).order_by("id").values_list("user_id", "id"):
+					sublists.setdefault(user_id, []).append(sublist_id)
+
+				for user in chunk:
+					# Skip users who have been given an inactivity warning and have not
+					# logged in afterwards. Some early accounts or incompletely created
+					# accounts may be missing a UserProfile object.
+					prof = profiles.get(user["id"])
+					if prof and prof.is_inactive():
+						counts["total_users_skipped_stale"] += 1
+						continue
+
+					# Skip users that emails to whom have bounced.
+					if user["id"] in bounced:
+						counts["total_users_skipped_bounced"] += 1
+						continue
+
+					yield (user["id"], sublists.get(user["id"], []))
+
+		# Group the eligible users into small batches to send to the workers.
+		def batch_iterator():
+			batch = []
+			for user in user_iterator():
+				batch.append(user)
+				if len(batch) == USER_BATCH_SIZE:
+					yield batch
+					batch = []
+			if batch:
+				yield batch
+
 		# when debugging, show a progress meter
-		def user_iterator(): return users
+		batches = batch_iterator()
 		if sys.stdout.isatty():
-			def user_iterator():
-				import tqdm
-				return tqdm.tqdm(list(users))
+			import tqdm
+			batches = tqdm.tqdm(batches, total=(users.count() + USER_BATCH_SIZE - 1) // USER_BATCH_SIZE)
 
-		# Create a pool of workers. (multiprocessing.Pool behaves weirdly with Django.)
-		# Sparkpost says have up to 10 concurrent connections.
+		# Create a pool of workers to query and render, plus spares to replace
+		# workers that get stuck or die. (multiprocessing.Pool behaves weirdly
+		# with Django.) All of the forking happens here, before the sender
+		# threads are started.
 		def create_worker():
 			for db in django.db.connections.all(): db.close() # close before forking
 			parent_conn, child_conn = multiprocessing.Pipe()
 			proc = multiprocessing.Process(target=pool_worker, args=(child_conn,))
 			proc.start()
 			return [proc, parent_conn, 0]
-		pool = [create_worker() for i in range(5)]
-		
+		pool = [create_worker() for i in range(multiprocessing.cpu_count())]
+		spares = [create_worker() for i in range(SPARE_WORKERS)]
+
+		# Start the threads that send what the workers render.
+		sender = MailSender(SEND_CONNECTIONS, mark_lists)
+
+		def replace_worker(worker):
+			# Kill the worker and return a spare to use in its place, or None
+			# if there are no spares left.
+			worker[1].close()
+			worker[0].terminate()
+			if spares:
+				print("Using a spare worker.")
+				return spares.pop()
+			print("No spare workers left.")
+			return None
+
 		def dequeue(worker, limit):
 			while worker[2] > limit: # the worker has more than limit emails in its queue
 				# Each worker sends back some data each time it finishes handling
@@ -132,65 +222,72 @@ class Command(BaseCommand):
 				try:
 					if not worker[1].poll(60*10): # 10 minutes
 						raise ConnectionResetError()
-					wcounts = worker[1].recv()
+					wcounts, deliveries = worker[1].recv()
 					worker[2] -= 1
 					for k, v in wcounts.items():
 						counts[k] += v
+					for delivery in deliveries:
+						sender.put(delivery) # blocks while the send queue is full
 				except ConnectionResetError:
 					# Worker seems to be stuck or gone.
-					print("Worker got stuck/died. Making a new one.")
-					worker[1].close()
-					worker[0].terminate()
-					return create_worker()
+					print("Worker got stuck/died.")
+					return replace_worker(worker)
 			return worker
 
-		for i, user in enumerate(user_iterator()):
-			# Skip users who have been given an inactivity warning and have not
-			# logged in afterwards. Some early accounts or incompletely created
-			# accounts may be missing a UserProfile object.
-			prof = UserProfile.objects.filter(user_id=user["id"]).first()
-			if prof and prof.is_inactive():
-				counts["total_users_skipped_stale"] += 1
-				continue
-
-			# Skip users that emails to whom have bounced.
-			if BouncedEmail.objects.filter(user_id=user["id"]).exists():
-				counts["total_users_skipped_bounced"] += 1
-				continue
-
+		def set_worker(k, worker):
+			# Put the worker (or its replacement) back in the pool, or drop
+			# it if it couldn't be replaced.
+			if worker is not None:
+				pool[k] = worker
+				return
+			del pool[k]
+			if not pool:
+				sender.finish()
+				raise CommandError("All of the workers got stuck or died.")
+
+		for i, batch in enumerate(batches):
 			## if debugging, can run it in the main process and ignore the pool
-			#wcounts = send_email_update(user["id"], list_email_freq, send_mail, mark_lists, send_old_events, global_mail_connection)
+			#wcounts, deliveries = send_email_update_batch(batch, list_email_freq, send_mail, mark_lists, send_old_events)
 			#for k, v in wcounts.items(): counts[k] += v
+			#for delivery in deliveries: sender.put(delivery)
 
 			# Enque task.
 			while True:
-				worker = pool[i % len(pool)]
+				k = i % len(pool)
+				worker = pool[k]
 				try:
-					worker[1].send([user["id"], list_email_freq, send_mail, mark_lists, send_old_events])
+					worker[1].send([batch, list_email_freq, send_mail, mark_lists, send_old_events])
 					worker[2] += 1
 					break
 				except BrokenPipeError:
-					# Something is wrong with the worker. Kill it and make
-					# a new worker, and then try again.
-					print("Worker pipe broken. Making a new one.")
-					worker[1].close()
-					worker[0].terminate()
-					pool[i % len(pool)] = create_worker()
+					# Something is wrong with the worker. Kill it and replace
+					# it with a spare, and then try again.
+					print("Worker pipe broken.")
+					set_worker(k, replace_worker(worker))
 					continue
 
 			# Deque results periodically so that the loop tracks overall progress and the pipe doesn't hit a limit.
-			# If a worker gets stuck, replace it with a new one.
-			pool[i % len(pool)] = dequeue(worker, 10)
+			# If a worker gets stuck, replace it with a spare.
+			set_worker(k, dequeue(worker, 2))
 
 		# signal we're done so processes terminate, then join to reclaim the workers
-		for worker in pool: worker[1].send(None)
+		for worker in pool + spares: worker[1].send(None)
 		for worker in pool: dequeue(worker, 0)
-		for worker in pool: worker[0].join(1)
+		for worker in pool + spares: worker[0].join(1)
+
+		# wait for the send queue to drain
+		sender.finish()
+		counts["total_events_sent"] += sender.counts.pop("total_events_sent")
 
 		# show stats
-		print("Sent" if send_mail else "Would send", counts["total_emails_sent"], "emails and", counts["total_events_sent"], "events")
-		for k, v in list(counts.items()):
-			print(k, v)
+		if send_mail:
+			print("Sent", sender.counts["total_emails_sent"], "emails and", counts["total_events_sent"], "events")
+		else:
+			print("Would send", counts["total_emails_rendered"], "emails and", counts["total_events_sent"], "events")
+		for stage, stage_counts in (("render", counts), ("send", sender.counts)):
+			print("[%s]" % stage)
+			for k, v in list(stage_counts.items()):
+				print(k, v)
 
 		# show queries (requires DEBUG to be true)
 		if settings.DEBUG:
@@ -205,28 +302,50 @@ def pool_worker(conn):
 		# in case there was any shared state with parent process
 		for db in django.db.connections.all(): db.close()
 
-		# open a new email connection
-		with django.core.mail.get_connection() as mail_connection:
-		
-			# Process incoming tasks.
-			while True:
-				args = conn.recv()
-				if args is None: break # stop when we get a None
-				conn.send(send_email_update(*args, mail_connection))
+		# Process incoming tasks.
+		while True:
+			args = conn.recv()
+			if args is None: break # stop when we get a None
+			conn.send(send_email_update_batch(*args))
 
-			# Close the connection.
-			conn.close()
+		# Close the connection.
+		conn.close()
 	except Exception as e:
 		print("Uncaught exception", e)
 
-def send_email_update(user_id, list_email_freq, send_mail, mark_lists, send_old_events, mail_connection):
+def send_email_update_batch(batch, list_email_freq, send_mail, mark_lists, send_old_events):
+	# Load the users, their profiles, and their lists with email updates
+	# turned on for the batch at once, then render each user's update.
+	# Returns the counts and the rendered emails to send.
+	users = User.objects.in_bulk([user_id for user_id, sublist_ids in batch])
+	profiles = { prof.user_id: prof for prof in UserProfile.objects.filter(user_id__in=list(users)) }
+	sublists = SubscriptionList.objects.in_bulk([sublist_id for user_id, sublist_ids in batch for sublist_id in sublist_ids])
+
+	counts = { }
+	deliveries = []
+	for user_id, sublist_ids in batch:
+		if user_id not in users: continue # deleted since we started
+		user = users[user_id]
+		if user_id in profiles:
+			user._profile = profiles[user_id] # see User.userprofile
+			user._profile.user = user
+		wcounts, delivery = send_email_update(user, [sublists[id] for id in sublist_ids if id in sublists], list_email_freq, send_mail, mark_lists, send_old_events)
+		for k, v in wcounts.items():
+			counts[k] = counts[k] + v if k in counts else v
+		if delivery: deliveries.append(delivery)
+	return counts, deliveries
+
+def send_email_update(user, sublists, list_email_freq, send_mail, mark_lists, send_old_events):
+	# Queries and renders a user's email update. Returns counts and, if there
+	# is an email to send, a dict with the message and what to record once it
+	# is sent (see MailSender).
 	global launch_time
 	global latest_blog_post_by_category
 	global prev_blog_post_creation_dates
+	global event_inboxes
 
 	user_start_time = datetime.now()
 
-	user = User.objects.get(id=user_id)
 	profile = user.userprofile()
 
 	# get the email's From: header and return path
@@ -241,7 +360,7 @@ def send_email_update(user_id, list_email_freq, send_mail, mark_lists, send_old_
 	eventslists = []
 	most_recent_event = None
 	eventcount = 0
-	for sublist in user.subscription_lists.all():
+	for sublist in sublists:
 		# If this list does not have email updates turned on for
 		# the target frequently, move on.
 		if sublist.email not in list_email_freq: continue
@@ -263,7 +382,8 @@ def send_email_update(user_id, list_email_freq, send_mail, mark_lists, send_old_
 		if send_old_events: sublist.last_event_mailed = None
 
 		# Get any new events to email the user about.
-		max_id, events = sublist.get_new_events()
+		max_id, events = sublist.get_new_events(
+			inbox=event_inboxes.pop(sublist.id, []) if event_inboxes is not None else None)
 		if len(events) > 0:
 			eventslists.append( (sublist, events) )
 			eventcount += len(events)
@@ -296,7 +416,7 @@ def send_email_update(user_id, list_email_freq, send_mail, mark_lists, send_old_
 	if len(eventslists) == 0 and not send_old_events and blog_post is None:
 		return {
 			"total_time_querying": user_querying_end_time-user_start_time,
-		}
+		}, None
 
 	# Render the body of the email.
 	body_context = {
@@ -313,10 +433,11 @@ def send_email_update(user_id, list_email_freq, send_mail, mark_lists, send_old_
 	if not send_mail:
 		# don't email, don't update lists with the last emailed id
 		return {
+			"total_emails_rendered": 1,
 			"total_events_sent": eventcount,
 			"total_time_querying": user_querying_end_time-user_start_time,
 			"total_time_rendering": user_rendering_end_time-user_querying_end_time,
-		}
+		}, None
 	
 	# Add a pingback image into the email to know (with some low accuracy) which
 	# email addresses are still valid, for folks that have not logged in recently
@@ -326,71 +447,220 @@ def send_email_update(user_id, list_email_freq, send_mail, mark_lists, send_old_
 		and not Ping.objects.filter(user=user, pingtime__gt=launch_time - timedelta(days=60)).exists():
 		emailpingurl = Ping.get_ping_url(user)
 
-	# send
-	try:
-		timings = { }
-		send_html_mail(
-			"events/emailupdate",
-			emailreturnpath,
-			[user.email],
-			{
-				"user": user,
-				"date": datetime.now().strftime("%b. %d").replace(" 0", " "),
-				"emailpingurl": emailpingurl,
-				"body_text": body_text,
-				"body_html": body_html,
-				"blog_post": blog_post,
-				"SITE_ROOT_URL": settings.SITE_ROOT_URL,
-				"utm": utm,
-			},
-			headers={
-				'Reply-To': emailfromaddr,
-				'Auto-Submitted': 'auto-generated',
-				'X-Auto-Response-Suppress': 'OOF',
-				'X-Unsubscribe-Link': profile.get_one_click_unsub_url(),
-				'List-Unsubscribe': "<" + profile.get_one_click_unsub_url() + ">",
-			},
-			fail_silently=False,
-			connection=mail_connection,
-		)
-	except Exception as e:
-		if "recipient address was suppressed due to" in str(e):
-			be, is_new = BouncedEmail.objects.get_or_create(user=user)
-			if not is_new:
-				be.bounces += 1
-				be.save()
-			print(user, "user is on suppression list already")
-		else:
-			print(user, e)
-			import traceback; traceback.print_exc()
-		# raise - debugging - must also disable process pool to see what happened
-
-		# don't update this user's lists with what events were sent because it failed
-		return {
-			"total_time_querying": user_querying_end_time-user_start_time,
-			"total_time_sending": datetime.now()-user_querying_end_time,
-		}
-	
-	if mark_lists: # skipped when debugging
-		# mark each list as having mailed events up to the max id found from the
-		# events table so that we know not to email those events in a future update.
+	# Render the message. It is captured rather than sent here, and then
+	# sent by the parent process.
+	outbox = CaptureEmailBackend()
+	send_html_mail(
+		"events/emailupdate",
+		emailreturnpath,
+		[user.email],
+		{
+			"user": user,
+			"date": datetime.now().strftime("%b. %d").replace(" 0", " "),
+			"emailpingurl": emailpingurl,
+			"body_text": body_text,
+			"body_html": body_html,
+			"blog_post": blog_post,
+			"SITE_ROOT_URL": settings.SITE_ROOT_URL,
+			"utm": utm,
+		},
+		headers={
+			'Reply-To': emailfromaddr,
+			'Auto-Submitted': 'auto-generated',
+			'X-Auto-Response-Suppress': 'OOF',
+			'X-Unsubscribe-Link': profile.get_one_click_unsub_url(),
+			'List-Unsubscribe': "<" + profile.get_one_click_unsub_url() + ">",
+		},
+		fail_silently=False,
+		connection=outbox,
+	)
+	message = outbox.messages[0]
+	message.connection = None # so it can be pickled back to the parent
+
+	# Once sent, mark each list as having mailed events up to the max id found
+	# from the events table so that we know not to email those events in a
+	# future update. (Skipped when debugging.)
+	delivery = {
+		"message": message,
+		"user_id": user.id,
+		"email": user.email,
+		"events": eventcount,
+		"sublists": [],
+		"blog_post": None,
+	}
+	if mark_lists:
 		for sublist, events in eventslists:
-			sublist.last_event_mailed = max(sublist.last_event_mailed, most_recent_event) if sublist.last_event_mailed is not None else most_recent_event
-			sublist.last_email_sent = launch_time
-			sublist.save()
+			delivery["sublists"].append((
+				sublist.id,
+				max(sublist.last_event_mailed, most_recent_event) if sublist.last_event_mailed is not None else most_recent_event))
 		if blog_post:
-			profile.last_blog_post_emailed = blog_post.id
-			profile.save()
+			delivery["blog_post"] = blog_post.id
 
-	user_sending_end_time = datetime.now()
+	user_rendering_end_time = datetime.now()
 
 	return {
-		"total_emails_sent": 1,
-		"total_events_sent": eventcount,
+		"total_emails_rendered": 1,
 		"total_time_querying": user_querying_end_time-user_start_time,
 		"total_time_rendering": user_rendering_end_time-user_querying_end_time,
-		"total_time_sending": user_sending_end_time-user_rendering_end_time,
-	}
+	}, delivery
+
+class CaptureEmailBackend(BaseEmailBackend):
+	# Collects messages instead of sending them.
+	def __init__(self, *args, **kwargs):
+		super().__init__(*args, **kwargs)
+		self.messages = []
+	def send_messages(self, email_messages):
+		self.messages.extend(email_messages)
+		return len(email_messages)
+
+class MailSender:
+	# Sends rendered email updates from a bounded queue with a pool of threads,
+	# each holding a persistent mail connection. (Mail backends block, so threads
+	# rather than an event loop.) A send is retried on a new connection only if
+	# the message clearly wasn't accepted: the connection couldn't be opened or
+	# the server rejected it with a temporary (4xx) error. A send that doesn't
+	# finish within SEND_TIMEOUT may or may not have gone out, so it isn't
+	# retried and, like a failure, the user's lists aren't marked. Once an email
+	# is sent, the user's lists are marked as having been mailed.
+
+	def __init__(self, num_connections, mark_lists):
+		self.mark_lists = mark_lists
+		self.queue = queue.Queue(maxsize=SEND_QUEUE_SIZE)
+		self.lock = threading.Lock()
+		self.counts = {
+			"total_emails_sent": 0,
+			"total_emails_failed": 0,
+			"total_events_sent": 0,
+			"total_send_retries": 0,
+			"total_send_timeouts": 0,
+			"total_time_sending": timedelta(seconds=0),
+		}
+		self.threads = [threading.Thread(target=self.run) for i in range(num_connections)]
+		for t in self.threads: t.start()
+
+	def put(self, delivery):
+		self.queue.put(delivery)
+
+	def finish(self):
+		for t in self.threads: self.queue.put(None)
+		for t in self.threads: t.join()
+
+	def count(self, **kwargs):
+		with self.lock:
+			for k, v in kwargs.items():
+				self.counts[k] += v
+
+	def run(self):
+		mail_connection = None
+		try:
+			while True:
+				delivery = self.queue.get()
+				if delivery is None: break # stop when we get a None
+				try:
+					mail_connection = self.send(delivery, mail_connection)
+				except Exception as e:
+					# Keep the thread alive so the queue keeps draining.
+					print(delivery["email"], e)
+					import traceback; traceback.print_exc()
+		finally:
+			if mail_connection is not None:
+				try:
+					mail_connection.close()
+				except Exception:
+					pass
+			django.db.connection.close()
+
+	def send(self, delivery, mail_connection):
+		# Returns the connection to use for the next send, which is a new one
+		# if this one timed out or failed.
+		start_time = datetime.now()
+		for attempt in range(SEND_RETRIES + 1):
+			if attempt > 0:
+				self.count(total_send_retries=1)
+				time.sleep(2 ** attempt)
+			try:
+				if mail_connection is None:
+					mail_connection = django.core.mail.get_connection()
+					mail_connection.open()
+			except Exception as e:
+				# nothing was sent, so try again
+				print(delivery["email"], "could not connect:", e)
+				mail_connection = None
+				if attempt < SEND_RETRIES: continue
+				self.count(total_emails_failed=1, total_time_sending=datetime.now()-start_time)
+				return None
+			try:
+				send_with_timeout(mail_connection, delivery["message"])
+				break
+			except TimeoutError:
+				# The message may have been accepted, so don't send it again, and
+				# abandon the stuck connection to its thread. The lists aren't
+				# marked, so the events go out again next time if it wasn't sent.
+				self.count(total_send_timeouts=1, total_time_sending=datetime.now()-start_time)
+				print(delivery["email"], "timed out sending")
+				return None
+			except Exception as e:
+				if "recipient address was suppressed due to" in str(e):
+					be, is_new = BouncedEmail.objects.get_or_create(user_id=delivery["user_id"])
+					if not is_new:
+						be.bounces += 1
+						be.save()
+					print(delivery["email"], "user is on suppression list already")
+					attempt = SEND_RETRIES # no point retrying
+				else:
+					print(delivery["email"], e)
+					import traceback; traceback.print_exc()
+					if not is_temporary_rejection(e):
+						attempt = SEND_RETRIES # it may have been accepted, or retrying won't help
+				if mail_connection is not None:
+					try:
+						mail_connection.close()
+					except Exception:
+						pass
+					mail_connection = None
+			if attempt == SEND_RETRIES:
+				# don't update this user's lists with what events were sent because it failed
+				self.count(total_emails_failed=1, total_time_sending=datetime.now()-start_time)
+				return None
+
+		if self.mark_lists:
+			for sublist_id, last_event_mailed in delivery["sublists"]:
+				SubscriptionList.objects.filter(id=sublist_id).update(
+					last_event_mailed=last_event_mailed, last_email_sent=launch_time)
+			if delivery["blog_post"]:
+				UserProfile.objects.filter(user_id=delivery["user_id"]).update(
+					last_blog_post_emailed=delivery["blog_post"])
+
+		self.count(total_emails_sent=1, total_events_sent=delivery["events"],
+			total_time_sending=datetime.now()-start_time)
+		return mail_connection
+
+def is_temporary_rejection(e):
+	# Did the mail server reject the message with a temporary (4xx) error,
+	# so that the message wasn't accepted and might be on a retry?
+	import smtplib
+	if isinstance(e, smtplib.SMTPRecipientsRefused):
+		return len(e.recipients) > 0 and all(400 <= code < 500 for code, resp in e.recipients.values())
+	if isinstance(e, smtplib.SMTPResponseException):
+		return 400 <= e.smtp_code < 500
+	return False
+
+def send_with_timeout(mail_connection, message):
+	# Sends the message on a helper thread so that a hung connection can't
+	# stall the sender. Raises TimeoutError if it doesn't finish in time.
+	result = { }
+	def target():
+		try:
+			mail_connection.send_messages([message])
+		except Exception as e:
+			result["error"] = e
+	t = threading.Thread(target=target, daemon=True)
+	t.start()
+	t.join(SEND_TIMEOUT)
+	if t.is_alive():
+		raise TimeoutError()
+	if "error" in result:
+		raise result["error"]
 
 def load_latest_blog_posts():
 	# Load the latest blog post by category since
@@ -21,6 +21,14 @@ def enable_event_source_caching():
     global EVENT_SOURCE_CACHE
     EVENT_SOURCE_CACHE = dict()
 
+# When parsing and sending email updates, cache Feed objects by feedname in
+# memory so that each feed is only looked up (or created) once per process.
+FEED_CACHE = None
+def enable_feed_caching():
+    global FEED_CACHE
+    if FEED_CACHE is None:
+        FEED_CACHE = dict()
+
 class Feed(models.Model):
     """Each Feed has a code name that can be used to reconstruct information about the feed."""
     feedname = models.CharField(max_length=64, unique=True, db_index=True)
@@ -38,7 +46,7 @@ class Feed(models.Model):
             return Feed(feedname=feedname)
                 
         try:
-            return Feed.objects.get(feedname=feedname)
+            return Feed.get_cached(feedname, create=False)
         except Feed.DoesNotExist:
             # Certain feeds aren't in the db. Try a db lookup first, then...
             for feedname2, feedmeta in Feed.feed_metadata.items():
@@ -46,12 +54,18 @@ class Feed(models.Model):
                     return Feed(feedname=feedname)
             raise
 
+    # How many per-feed subqueries get_events_for combines into one query. SQLite
+    # allows at most 500 terms in a compound SELECT.
+    FEEDS_PER_QUERY = 100
+
     @staticmethod
-    def get_events_for(feeds, count):
+    def get_events_for(feeds, count, feeds_per_query=None):
         # This method returns the most recent events matching a set of feeds,
         # or all events if feeds is None. Feeds is an iterable of Feed objects
         # or str's of Feed feednames, which must exist.
         
+        if feeds_per_query is None: feeds_per_query = Feed.FEEDS_PER_QUERY
+
         source_feed_map = { }
         if feeds != None:
             feeds, source_feed_map = expand_feeds(feeds)
@@ -95,17 +109,30 @@ class Feed(models.Model):
             else:
                 # pull events by feed. When we query on the 'seq' column, MySQL uses the when-based
                 # index rather than the feed-based index, which causes a big problem if there are
-                # no recent events.
+                # no recent events. And when we query on multiple feeds at once, MySQL doesn't use
+                # the feed-based index well. So we take the most recent 'count' events from each
+                # feed in a separate subquery, but combine the subqueries with UNION ALL so that
+                # there is one round-trip to the database per FEEDS_PER_QUERY feeds. (Each subquery
+                # is wrapped in a derived table because SQLite doesn't allow ORDER BY/LIMIT on the
+                # parts of a compound SELECT directly.)
                 ret = []
                 seen = { }
-                for feed in feeds:
-                    cursor.execute("SELECT source_content_type_id, source_object_id, eventid, `when`, seq FROM events_event WHERE feed_id = %s ORDER BY `when` DESC, source_content_type_id DESC, source_object_id DESC LIMIT %s", [feed.id, count])
+                feeds_by_id = { feed.id: feed for feed in feeds }
+                for i in range(0, len(feeds), feeds_per_query):
+                    chunk = feeds[i:i+feeds_per_query]
+                    sql = " UNION ALL ".join(
+                        "SELECT * FROM (SELECT feed_id, source_content_type_id, source_object_id, eventid, `when`, seq FROM events_event WHERE feed_id = %s ORDER BY `when` DESC, source_content_type_id DESC, source_object_id DESC LIMIT %s) AS feed_" + str(j)
+                        for j in range(len(chunk)))
+                    params = []
+                    for feed in chunk: params.extend([feed.id, count])
+                    cursor.execute(sql, params)
                     
                     batch = cursor.fetchall()
                     for b in batch:
-                        key = tuple(b[0:3]) # the unique part for identifying the event
+                        feed = feeds_by_id[b[0]]
+                        key = tuple(b[1:4]) # the unique part for identifying the event
                         if not key in seen:
-                            v = { "source_content_type": b[0], "source_object_id": b[1], "eventid": b[2], "when": b[3], "seq": b[4], "feeds": set() }
+                            v = { "source_content_type": b[1], "source_object_id": b[2], "eventid": b[3], "when": b[4], "seq": b[5], "feeds": set() }
                             ret.append(v)
                             seen[key] = v
                         seen[key]["feeds"].add(source_feed_map.get(feed, feed).feedname)
@@ -221,9 +248,44 @@ class Feed(models.Model):
 
     @staticmethod # private method
     def get_noarg_feed(feedname):
-        feed, is_new = Feed.objects.get_or_create(feedname=feedname)
+        return Feed.get_cached(feedname)
+
+    @staticmethod
+    def get_cached(feedname, create=True):
+        # Gets the Feed with the given feedname, creating it if it doesn't exist
+        # and create is True (else raising Feed.DoesNotExist), and using the feed
+        # cache if enable_feed_caching() has been called.
+        if FEED_CACHE is not None and feedname in FEED_CACHE:
+            return FEED_CACHE[feedname]
+        if create:
+            feed = Feed.objects.get_or_create(feedname=feedname)[0]
+        else:
+            feed = Feed.objects.get(feedname=feedname)
+        if FEED_CACHE is not None:
+            FEED_CACHE[feedname] = feed
         return feed
 
+    @staticmethod
+    def prefetch(feednames, create=True):
+        # Loads the Feeds with the given feednames into the feed cache with
+        # one feedname__in query (per chunk), creating any missing feeds in
+        # bulk if create is True. Does nothing if feed caching isn't enabled.
+        if FEED_CACHE is None: return
+        missing = sorted(set(feednames) - set(FEED_CACHE))
+        chunk_size = 500 # stay well under the SQLite variable limit
+        for i in range(0, len(missing), chunk_size):
+            chunk = missing[i:i+chunk_size]
+            for feed in Feed.objects.filter(feedname__in=chunk):
+                FEED_CACHE[feed.feedname] = feed
+            if create:
+                new_feeds = [feedname for feedname in chunk if feedname not in FEED_CACHE]
+                if new_feeds:
+                    # Another process may create the same feeds concurrently, so
+                    # ignore conflicts and then query for the ids.
+                    Feed.objects.bulk_create([Feed(feedname=feedname) for feedname in new_feeds], ignore_conflicts=True)
+                    for feed in Feed.objects.filter(feedname__in=new_feeds):
+                        FEED_CACHE[feed.feedname] = feed
+
     # iterator methods
     
     @staticmethod
@@ -412,16 +474,19 @@ class Event(models.Model):
         return ret
     
     # This is used to update the events for an object and delete any events that are not updated.
+    # Calls to add() are buffered and the changes are written in bulk on __exit__.
     class update:
         def __init__(self, source):
             self.source = source
+            self.sourcearg = Event.sourcearg(source)
             
             # get a list of events previously created for this source so that if they
-            # are not updated we can delete them
+            # are not updated we can delete them, keyed by (feed id, eventid)
             self.existing_events = {}
-            for event in Event.objects.filter(**Event.sourcearg(source)):
-                self.existing_events[event.id] = True
+            for id, feed_id, eventid, when in Event.objects.filter(**self.sourcearg).values_list("id", "feed_id", "eventid", "when"):
+                self.existing_events[(feed_id, eventid)] = (id, when)
             self.seq = { }
+            self.new_events = { } # (feed id, eventid) => (when, seq), in the order added
 
         def __enter__(self):
             return self
@@ -436,23 +501,41 @@ class Event(models.Model):
             # Track the sequence number for this eventid, increment in insertion order.
             if not eventid in self.seq: self.seq[eventid] = len(self.seq)
             
-            # Create the record for this event for this feed, if it does not exist.
-            event, created = Event.objects.get_or_create(
-                feed = feed,
-                eventid = eventid,
-                defaults = {"when": when, "seq": self.seq[eventid]},
-                **Event.sourcearg(self.source)
-                )
-            #print ("[%s] %s event record: %s | %s | %s" % (unicode(self.source)[0:15], "New" if created else "Existing", feed.feedname, repr(self.source), eventid)).encode("utf8")
-            if not created and event.id in self.existing_events:
-                del self.existing_events[event.id] # i.e. don't delete this event on __exit__
-                if event.when != when: # update this if it changed
-                    event.when = when
-                    event.save()
+            # Record this event for this feed. If it is added more than once, the
+            # first time wins.
+            key = (feed.id, eventid)
+            if key not in self.new_events:
+                self.new_events[key] = (when, self.seq[eventid])
             
         def __exit__(self, type, value, traceback):
-            # Clear out any events that were not updated.
-            Event.objects.filter(id__in=self.existing_events).delete()
+            # Don't write a partial update if an exception occurred.
+            if type is not None:
+                return False
+
+            # Clear out any events that were not updated. Do this first because
+            # new records may collide with old ones on the unique indexes.
+            obsolete = [id for key, (id, when) in self.existing_events.items() if key not in self.new_events]
+            if obsolete:
+                Event.objects.filter(id__in=obsolete).delete()
+
+            # Update the date of existing events if it changed. The seq of existing
+            # events is left as is.
+            changed = [
+                Event(id=self.existing_events[key][0], when=when)
+                for key, (when, seq) in self.new_events.items()
+                if key in self.existing_events and self.existing_events[key][1] != when ]
+            if changed:
+                Event.objects.bulk_update(changed, ["when"], batch_size=500)
+
+            # Create the records for new events, in the order they were added
+            # so that their ids increase in that order.
+            created = [
+                Event(feed_id=feed_id, eventid=eventid, when=when, seq=seq, **self.sourcearg)
+                for (feed_id, eventid), (when, seq) in self.new_events.items()
+                if (feed_id, eventid) not in self.existing_events ]
+            if created:
+                Event.objects.bulk_create(created, batch_size=500)
+
             return False
 
 class SubscriptionList(models.Model):
@@ -536,7 +619,13 @@ class SubscriptionList(models.Model):
             self.save()
         return self.public_id
 
-    def get_new_events(self):
+    def get_new_events(self, inbox=None):
+        # Returns the maximum event id and the new events for this list. If inbox
+        # is given, it is this list's rows from SubscriptionList.prepare_inboxes
+        # and no queries are made.
+        if inbox is not None:
+            return SubscriptionList.collate_new_events(inbox)
+
         feeds, source_feed_map = expand_feeds(self.trackers.all())
         if len(feeds) == 0: return None, []
         
@@ -559,13 +648,23 @@ class SubscriptionList(models.Model):
         # The Django ORM can't handle generating a nice query. It adds joins that ruin indexing.
         from django.db import connection, transaction
         with connection.cursor() as cursor:
-            cursor.execute("SELECT id, source_content_type_id, source_object_id, eventid, `when`, seq, feed_id FROM events_event WHERE id > %s AND `when` > %s AND feed_id IN (" + ",".join(str(f.id) for f in feeds) + ") ORDER BY `when`, source_content_type_id, source_object_id, seq", [self.last_event_mailed if self.last_event_mailed else 0, datetime.now() - timedelta(days=BACKFILL_DAYS_DAILY if self.email == 1 else BACKFILL_DAYS_WEEKLY)])
+            cursor.execute("SELECT id, source_content_type_id, source_object_id, eventid, `when`, seq, feed_id FROM events_event WHERE id > %s AND `when` > %s AND feed_id IN (" + ",".join(str(f.id) for f in feeds) + ") ORDER BY `when`, source_content_type_id, source_object_id, seq", [self.last_event_mailed if self.last_event_mailed else 0, self.get_backfill_start()])
             batch = cursor.fetchall()
         
+        # Replace the feed ids with the feeds the user is tracking that include them.
+        feedmap = dict((f.id, source_feed_map.get(f, f)) for f in feeds)
+        return SubscriptionList.collate_new_events([b[0:6] + (feedmap[b[6]],) for b in batch])
+
+    def get_backfill_start(self, now=None):
+        return (now or datetime.now()) - timedelta(days=BACKFILL_DAYS_DAILY if self.email == 1 else BACKFILL_DAYS_WEEKLY)
+
+    @staticmethod
+    def collate_new_events(batch):
+        # batch is a list of (id, source_content_type_id, source_object_id, eventid, when, seq, tracked feed)
+        # tuples, with one row per feed the event is in.
         max_id = None
         ret = []
         seen = { } # uniqify because events are duped for each feed they are in, but track which feeds generated the events
-        feedmap = dict((f.id, source_feed_map.get(f, f)) for f in feeds)
         for b in batch:
             key = b[1:3] # get the part that uniquely identifies the event, across feeds
             if max_id is None: max_id = b[0]
@@ -577,16 +676,99 @@ class SubscriptionList(models.Model):
                 v = { "id": b[0], "source_content_type": b[1], "source_object_id": b[2], "eventid": b[3], "when": b[4], "seq": b[5], "feeds": set() }
                 ret.append(v)
                 seen[key] = v
-            v["feeds"].add(feedmap[b[6]])
+            v["feeds"].add(b[6])
                 
         ret.sort(key = lambda x : (x["when"], x["source_content_type"], x["source_object_id"], x["seq"]))
     
         return max_id, ret
+
+    @staticmethod
+    def prepare_inboxes(sublists, now=None):
+        # Computes the new events for many subscription lists at once, for
+        # send_email_updates. Rather than querying the events table for each list,
+        # this inverts the lists' (expanded) trackers into a map from feed to lists,
+        # reads the new rows of the events table once, and buckets them by list.
+        # Returns a dict from list id to the inbox argument for get_new_events.
+        from django.db import connection
+        from django.db.models import Max
+
+        now = now or datetime.now()
+        sublists = { sublist.id: sublist for sublist in sublists }
+        if len(sublists) == 0: return { }
+
+        def chunks(items, size=500):
+            items = list(items)
+            for i in range(0, len(items), size):
+                yield items[i:i+size]
+
+        # Load the trackers of all of the lists.
+        trackers = collections.defaultdict(list)
+        for chunk in chunks(sublists):
+            for sublist_id, feed_id in SubscriptionList.trackers.through.objects.filter(subscriptionlist_id__in=chunk).values_list("subscriptionlist_id", "feed_id"):
+                trackers[sublist_id].append(feed_id)
+        feeds = { }
+        for chunk in chunks(set(feed_id for feed_ids in trackers.values() for feed_id in feed_ids)):
+            feeds.update(Feed.objects.in_bulk(chunk))
+
+        # Expand each tracked feed once and then invert the subscriptions, mapping each
+        # feed id to the lists that get its events and the tracked feed that includes it.
+        # Like expand_feeds, a feed tracked directly is its own source, otherwise the
+        # source is the first feed that included it.
+        expansions = { }
+        subscribers = collections.defaultdict(list)
+        for sublist_id, feed_ids in trackers.items():
+            feedmap = { }
+            for feed_id in feed_ids:
+                feedmap[feed_id] = feeds[feed_id]
+            for feed_id in feed_ids:
+                if feed_id not in expansions:
+                    expansions[feed_id] = expand_feeds([feeds[feed_id]])
+                expanded, source_feed_map = expansions[feed_id]
+                for f in expanded:
+                    if f.id and f.id not in feedmap:
+                        feedmap[f.id] = source_feed_map.get(f, f)
+            for feed_id, source_feed in feedmap.items():
+                subscribers[feed_id].append((sublist_id, source_feed))
+
+        # Apply the last_event_mailed workaround in get_new_events in bulk: advance
+        # each list's last_event_mailed to the maximum id of the event it refers to.
+        last_events = { }
+        for chunk in chunks(set(sublist.last_event_mailed for sublist in sublists.values() if sublist.last_event_mailed)):
+            for id, sct, soid, eventid in Event.objects.filter(id__in=chunk).values_list("id", "source_content_type_id", "source_object_id", "eventid"):
+                last_events[id] = (sct, soid, eventid)
+        max_ids = { }
+        for sct in set(key[0] for key in last_events.values()):
+            for chunk in chunks(set(key[1] for key in last_events.values() if key[0] == sct)):
+                for soid, eventid, max_id in Event.objects.filter(source_content_type_id=sct, source_object_id__in=chunk)\
+                    .values_list("source_object_id", "eventid").annotate(max_id=Max("id")).values_list("source_object_id", "eventid", "max_id"):
+                    max_ids[(sct, soid, eventid)] = max_id
+        for sublist in sublists.values():
+            if sublist.last_event_mailed in last_events:
+                sublist.last_event_mailed = max_ids.get(last_events[sublist.last_event_mailed], sublist.last_event_mailed)
+
+        # Read the events table once, from the lowest high-water mark of all of the
+        # lists and the longest backfill window, and bucket the rows by list.
+        min_id = min(sublist.last_event_mailed or 0 for sublist in sublists.values())
+        min_when = min(sublist.get_backfill_start(now) for sublist in sublists.values())
+        list_windows = { sublist.id: (sublist.last_event_mailed or 0, sublist.get_backfill_start(now)) for sublist in sublists.values() }
+        inboxes = { sublist_id: [] for sublist_id in sublists }
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT id, source_content_type_id, source_object_id, eventid, `when`, seq, feed_id FROM events_event WHERE id > %s AND `when` > %s ORDER BY `when`, source_content_type_id, source_object_id, seq", [min_id, min_when])
+            while True:
+                batch = cursor.fetchmany(10000)
+                if not batch: break
+                for b in batch:
+                    for sublist_id, source_feed in subscribers.get(b[6], []):
+                        last_event_mailed, backfill_start = list_windows[sublist_id]
+                        if b[0] > last_event_mailed and b[4] > backfill_start:
+                            inboxes[sublist_id].append(b[0:6] + (source_feed,))
+
+        return inboxes
         
 def expand_feeds(feeds):
     # Some feeds include the events of other feeds.
     # Tail-recursively expand the feeds.
-    feeds = [f if isinstance(f, Feed) else Feed.objects.get(feedname=f) for f in feeds]
+    feeds = [f if isinstance(f, Feed) else Feed.get_cached(f, create=False) for f in feeds]
     map_to_source = { }
     i = 0
     while i < len(feeds):
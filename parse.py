@@ -57,6 +57,8 @@ def parse_args():
                       help='Slow down parsing so we don\'t interfere with other processes.')
     parser.add_option('--filter',
                       help='Only process files matching a regex.')
+    parser.add_option('--workers', type='int', default=1,
+                      help='Number of worker processes to parse bills or analyze votes with.')
     kwargs, args = parser.parse_args()
     if not args:
         parser.print_usage()
@@ -68,6 +70,11 @@ def main():
     kwargs, args = parse_args()
 
     setup_logging(kwargs.level)
+
+    # Cache Feed records in memory while generating events.
+    from events.models import enable_feed_caching
+    enable_feed_caching()
+
     parser = __import__('parser.%s_parser' % args[0], globals(), locals(), ['xxx'])
     getattr(parser, kwargs.method)(kwargs)
     logging.debug('Done')
@@ -105,10 +105,11 @@ def main(options):
     """
 
     if options.congress:
-        files = glob.glob(CONGRESS_DATA_PATH + '/{congress}/amendments/*/*/data.xml'.format(congress=options.congress))
+        files_pattern = CONGRESS_DATA_PATH + '/{congress}/amendments/*/*/data.xml'.format(congress=options.congress)
         log.info('Parsing amendments of only congress#%s' % options.congress)
     else:
-        files = glob.glob(CONGRESS_DATA_PATH + '/*/amendments/*/*/data.xml')
+        files_pattern = CONGRESS_DATA_PATH + '/*/amendments/*/*/data.xml'
+    files = glob.glob(files_pattern)
         
     if options.filter:
         files = [f for f in files if re.match(options.filter, f)]
@@ -117,6 +118,18 @@ def main(options):
     total = len(files)
     progress = Progress(total=total, name='files', step=100)
 
+    # Load the checksum records of the files and the ids of the amendments
+    # already in the database with a query each rather than for each file.
+    File.objects.preload(files_pattern)
+    existing_amdts = Amendment.objects.all()
+    if options.congress:
+        existing_amdts = existing_amdts.filter(congress=options.congress)
+    existing_amdts = {
+        (congress, amendment_type, number): amdt_id
+        for amdt_id, congress, amendment_type, number
+        in existing_amdts.values_list("id", "congress", "amendment_type", "number")
+    }
+
     amendment_processor = AmendmentProcessor()
     seen_amdt_ids = []
     for fname in files:
@@ -128,8 +141,10 @@ def main(options):
             if not m:
                 raise ValueError("Invalid file name", fname)
             else:
-                amdt = Amendment.objects.get(congress=int(m.group("congress")), amendment_type=AmendmentType.by_slug(m.group("amendment_type")), number=int(m.group("number")))
-                seen_amdt_ids.append(amdt.id) # don't delete me later
+                key = (int(m.group("congress")), AmendmentType.by_slug(m.group("amendment_type")), int(m.group("number")))
+                if key not in existing_amdts:
+                    raise Amendment.DoesNotExist(fname)
+                seen_amdt_ids.append(existing_amdts[key]) # don't delete me later
             continue
             
         tree = etree.parse(fname)
@@ -182,6 +197,8 @@ def main(options):
         Vote.objects.filter(related_amendment=amdt).update(missing_data=True)
 
         File.objects.save_file(fname)
+
+    File.objects.flush()
         
     # Are any amendments in the database no longer on disk?
     if options.congress and not options.filter:
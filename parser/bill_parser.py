@@ -5,6 +5,8 @@ Parser of:
  * bills located in data/congress/*/bills/...
  
 for x in {82..112}; do echo $x; ./parse.py bill --congress=$x -l ERROR --force --disable-events --disable-indexing; done
+
+Use --workers=N to parse in N processes, sharded by congress and bill type.
 """
 from lxml import etree
 import logging
@@ -31,13 +33,18 @@ from django.conf import settings
 log = logging.getLogger('parser.bill_parser')
 PERSON_CACHE = {}
 TERM_CACHE = {}
+COMMITTEE_CACHE = {}
+BILL_ID_CACHE = {}
 
-def get_person(pk):
+def load_person_cache():
     global PERSON_CACHE
-    pk = int(pk)
     if not PERSON_CACHE:
         PERSON_CACHE = dict((x.pk, x) for x in Person.objects.all())
-    return PERSON_CACHE[pk]
+
+
+def get_person(pk):
+    load_person_cache()
+    return PERSON_CACHE[int(pk)]
 
 
 def normalize_name(name):
@@ -47,7 +54,7 @@ def normalize_name(name):
     return name.lower()
 
 
-def get_term(name, congress):
+def load_term_cache():
     global TERM_CACHE
     if not TERM_CACHE:
         for term in BillTerm.objects.all():
@@ -59,9 +66,47 @@ def get_term(name, congress):
         # Re-use the new named entities terms for pre-111th Congress bill.s
         for term in BillTerm.objects.get(name="Geographic Areas, Entities, and Committees").subterms.all():
                 TERM_CACHE[(TermType.old, normalize_name(term.name))] = term
-            
+
+
+def get_term(name, congress):
+    load_term_cache()
     return TERM_CACHE[(TermType.new if congress >= 111 else TermType.old, normalize_name(name))]
 
+
+def load_committee_cache():
+    global COMMITTEE_CACHE
+    if not COMMITTEE_CACHE:
+        COMMITTEE_CACHE = dict(Committee.objects.values_list('code', 'id'))
+
+
+def get_committee_id(code):
+    load_committee_cache()
+    return COMMITTEE_CACHE[code]
+
+
+def get_bill_id(congress, bill_type, number):
+    """
+    Look up a bill's id by its number, using an index of all bills
+    in the congress that is loaded the first time the congress is seen.
+    Raises Bill.DoesNotExist if there is no such bill.
+    """
+
+    congress = int(congress)
+    if congress not in BILL_ID_CACHE:
+        BILL_ID_CACHE[congress] = {
+            (bt, n): id
+            for id, bt, n in Bill.objects.filter(congress=congress).values_list('id', 'bill_type', 'number')
+        }
+    key = (bill_type, int(number))
+    if key not in BILL_ID_CACHE[congress]:
+        # The bill may have been created after the index was loaded, e.g.
+        # by another worker process.
+        bill_id = Bill.objects.filter(congress=congress, bill_type=bill_type, number=number).values_list('id', flat=True).first()
+        if bill_id is None:
+            raise Bill.DoesNotExist()
+        BILL_ID_CACHE[congress][key] = bill_id
+    return BILL_ID_CACHE[congress][key]
+
 class TermProcessor(XmlProcessor):
     REQUIRED_ATTRIBUTES = ['value']
     ATTRIBUTES = ['value']
@@ -113,6 +158,8 @@ class BillProcessor(XmlProcessor):
             raise ValueError()
 
         obj.save() # save before using m2m relations
+        if obj.congress in BILL_ID_CACHE:
+            BILL_ID_CACHE[obj.congress][(obj.bill_type, obj.number)] = obj.id
         self.process_committees(obj, node)
         if int(obj.congress) >= 93:
             # Bills from the Statutes at Large use some other subject term domain.
@@ -164,14 +211,16 @@ class BillProcessor(XmlProcessor):
             obj.sponsor = None
 
     def process_consponsors(self, obj, node):
-        cosp = set()
+        # Collect the cosponsor records in the file, by person. If a person
+        # is listed twice, the last entry wins.
+        cosponsors = { }
         for subnode in node.xpath('./cosponsors/cosponsor'):
             try:
                 person = get_person(subnode.get('id'))
             except IndexError:
                 log.error('Could not find cosponsor %s' % subnode.get('id'))
             else:
-                joined = self.parse_datetime(subnode.get('joined'))
+                joined = self.parse_datetime(subnode.get('joined')).date()
                 
                 role = Cosponsor.get_role_for(person, obj, joined)
                 if not role:
@@ -179,27 +228,33 @@ class BillProcessor(XmlProcessor):
                     continue
 
                 value = subnode.get('withdrawn')
-                withdrawn = self.parse_datetime(value) if value else None
-                
-                ob, isnew = Cosponsor.objects.get_or_create(
-                    person=person,
-                    bill=obj,
-                    defaults={
-                        "joined": joined,
-                        "withdrawn": withdrawn,
-                        "role": role
-                    })
-                if ob.joined != joined or ob.withdrawn != withdrawn or ob.role != role:
-                    ob.joined = joined
-                    ob.withdrawn = withdrawn
-                    ob.role = role
-                    ob.save()
-                cosp.add(ob.id)
-
-        obsolete_cosp = Cosponsor.objects.filter(bill=obj).exclude(id__in=cosp)
-        if obsolete_cosp.count() > 0:
+                withdrawn = self.parse_datetime(value).date() if value else None
+
+                cosponsors[person.id] = (person, joined, withdrawn, role)
+
+        # Diff against the existing records in one query and then write
+        # the changes in bulk.
+        existing = { ob.person_id: ob for ob in Cosponsor.objects.filter(bill=obj) }
+        new_records = []
+        changed_records = []
+        for person_id, (person, joined, withdrawn, role) in cosponsors.items():
+            ob = existing.get(person_id)
+            if ob is None:
+                new_records.append(Cosponsor(person=person, bill=obj, joined=joined, withdrawn=withdrawn, role=role))
+            elif ob.joined != joined or ob.withdrawn != withdrawn or ob.role_id != role.id:
+                ob.joined = joined
+                ob.withdrawn = withdrawn
+                ob.role = role
+                changed_records.append(ob)
+
+        obsolete_cosp = [ob for person_id, ob in existing.items() if person_id not in cosponsors]
+        if obsolete_cosp:
             log.error('Deleting obsolete cosponsor records: %s' % obsolete_cosp)
-            obsolete_cosp.delete()
+            Cosponsor.objects.filter(id__in=[ob.id for ob in obsolete_cosp]).delete()
+        if changed_records:
+            Cosponsor.objects.bulk_update(changed_records, ['joined', 'withdrawn', 'role'])
+        if new_records:
+            Cosponsor.objects.bulk_create(new_records)
            
 
     def session_handler(self, value):
@@ -216,11 +271,9 @@ class BillProcessor(XmlProcessor):
                     log.warn("Missing code attribute on committee %s." % subnode.get("name"))
                 continue
             try:
-                com = Committee.objects.get(code=subnode.get('code'))
-            except Committee.DoesNotExist:
+                comlist.append(get_committee_id(subnode.get('code')))
+            except KeyError:
                 log.error('Could not find committee %s' % subnode.get('code'))
-            else:
-                comlist.append(com)
         obj.committees.set(comlist)
 
     def process_terms(self, obj, node, congress):
@@ -234,13 +287,31 @@ class BillProcessor(XmlProcessor):
         obj.terms.set(termlist)
 
     def process_relatedbills(self, obj, node):
-        RelatedBill.objects.filter(bill=obj).delete()
+        from collections import Counter
+
+        related = Counter()
         for subnode in node.xpath('./relatedbills/bill'):
             try:
-                related_bill = Bill.objects.get(congress=subnode.get("session"), bill_type=BillType.by_xml_code(subnode.get("type")), number=int(subnode.get("number")))
+                related_bill_id = get_bill_id(subnode.get("session"), BillType.by_xml_code(subnode.get("type")), subnode.get("number"))
             except Bill.DoesNotExist:
                 continue
-            RelatedBill.objects.create(bill=obj, related_bill=related_bill, relation=subnode.get("relation")[0:16])
+            related[(related_bill_id, subnode.get("relation")[0:16])] += 1
+
+        # Keep existing records that are still present, delete the rest
+        # in one statement, and insert what's new in bulk.
+        obsolete = []
+        for id, related_bill_id, relation in RelatedBill.objects.filter(bill=obj).values_list("id", "related_bill_id", "relation"):
+            if related[(related_bill_id, relation)] > 0:
+                related[(related_bill_id, relation)] -= 1
+            else:
+                obsolete.append(id)
+        if obsolete:
+            RelatedBill.objects.filter(id__in=obsolete).delete()
+        RelatedBill.objects.bulk_create([
+            RelatedBill(bill=obj, related_bill_id=related_bill_id, relation=relation)
+            for (related_bill_id, relation), count in sorted(related.items())
+            for i in range(count)
+        ])
                     
     def process_committee_reports(self, obj, node):
         obj.committee_reports = [
@@ -338,114 +409,58 @@ def main(options):
 
     # Bills
     
+    # Bills whose search index documents need updating are queued during
+    # the parse and indexed in batches at the end.
     bill_index = None
     if not options.disable_indexing:
-        from bill.search_indexes import BillIndex
-        bill_index = BillIndex()
+        bill_index = BillIndexQueue()
 
     if options.congress:
-        files = glob.glob(settings.CONGRESS_DATA_PATH + '/%s/bills/*/*/data.xml' % options.congress)
+        files_pattern = settings.CONGRESS_DATA_PATH + '/%s/bills/*/*/data.xml' % options.congress
         log.info('Parsing unitedstates/congress bills of only congress#%s' % options.congress)
     else:
-        files = glob.glob(settings.CONGRESS_DATA_PATH + '/*/bills/*/*/data.xml')
+        files_pattern = settings.CONGRESS_DATA_PATH + '/*/bills/*/*/data.xml'
+    files = glob.glob(files_pattern)
         
     if options.filter and options.filter != "recent":
         files = [f for f in files if re.match(options.filter, f)]
         
     log.info('Processing bills: %d files' % len(files))
-    total = len(files)
-    progress = Progress(total=total, name='files', step=100)
-
-    bill_processor = BillProcessor()
-    seen_bill_ids = []
-    for fname in files:
-        progress.tick()
-        
-        # With indexing or events enabled, if the bill metadata file hasn't changed check
-        # the bill's latest text file for changes so we can create a text-is-available
-        # event and so we can index the bill's text.
-        if (not options.congress or int(options.congress)>42) and (bill_index and not options.disable_events) and not File.objects.is_changed(fname) and not options.force:
-            m = re.match(re.escape(settings.CONGRESS_DATA_PATH) + r'/(?P<congress>\d+)/bills/(?P<bill_type>[a-z]+)/(?P<bill_type_2>[a-z]+)(?P<number>\d+)/data.xml', fname)
 
-            try:
-                b = Bill.objects.get(congress=int(m.group("congress")), bill_type=BillType.by_slug(m.group("bill_type")), number=m.group("number"))
-                seen_bill_ids.append(b.id)
-                
-                # Update the index/events for any bill with recently changed text
-                textfile = get_bill_text_metadata(b, None)
-                if not textfile:
-                    if b.congress >= 103 and b.introduced_date < (datetime.now()-timedelta(days=42)).date():
-                        print("No bill text?", fname, b.introduced_date)
-                    continue
-                textfile = textfile.get("text_file")
-                if not textfile:
-                    print("Bill text exists but text-only layer missing", fname, b.introduced_date)
-                elif len(textfile) > 100:
-                    pass # File has a limit on path length and docs.house.gov filenames can be very long
-                elif os.path.exists(textfile) and File.objects.is_changed(textfile):
-                    b.update_index(bill_index) # index the full text
-                    b.create_events() # events for new bill text documents
-                    File.objects.save_file(textfile)
-                    
-                continue
-            except Bill.DoesNotExist:
-                print("Unchanged metadata file but bill doesn't exist:", fname)
-                pass # just parse as normal
-            
-        if options.slow:
-            time.sleep(1)
-
-        if options.filter == "recent":
-          if datetime.fromtimestamp(os.path.getmtime(fname)) < datetime.now() - timedelta(days=1):
-            continue
-            
-        tree = etree.parse(fname)
-        for node in tree.xpath('/bill'):
-            try:
-                bill = bill_processor.process(Bill(), node)
-            except:
-                print(fname)
-                raise
-           
-            seen_bill_ids.append(bill.id) # don't delete me later
-            
-            # So far this is just for American Memory bills.
-            if node.xpath("string(source/@url)"):
-                bill.source_link = str(node.xpath("string(source/@url)"))
-            else:
-                bill.source_link = None
-
-            actions = []
-            for axn in tree.xpath("actions/*[@state]"):
-                if axn.xpath("string(@state)") == "REFERRED": continue # we don't track this state
-                actions.append( (
-                	repr(bill_processor.parse_datetime(axn.xpath("string(@datetime)"))),
-                	BillStatus.by_xml_code(axn.xpath("string(@state)")),
-                	axn.xpath("string(text)"),
-                    etree.tostring(axn, encoding=str),
-                	) )
-                
-            bill.sliplawpubpriv = None
-            bill.sliplawnum = None
-            for axn in tree.xpath("actions/enacted"):
-                bill.sliplawpubpriv = "PUB" if axn.get("type") == "public" else "PRI"
-                bill.sliplawnum = int(axn.get("number").split("-")[1])
-                    
-            bill.major_actions = actions
-            try:
-                bill.save()
-            except:
-                print(bill)
-                raise
-
-            if bill_index:
-                bill.update_index(bill_index)
+    # Load the feeds that events will be created in with a few bulk queries
+    # rather than one query per feed per bill.
+    if not options.disable_events and options.congress and int(options.congress) >= 112:
+        Bill.prefetch_event_feeds(Bill.objects.filter(congress=options.congress), create=False)
+
+    # Load the checksum records of the bill files (and the text files
+    # in the same directories) in one query. The records of the files
+    # that were parsed are written only at the end, after the bills have
+    # been indexed, so that if anything fails before then the files are
+    # parsed (and the bills indexed) again on the next run.
+    File.objects.preload(files_pattern)
+
+    workers = int(getattr(options, "workers", None) or 1)
+    if workers > 1:
+        seen_bill_ids, parsed_bill_ids = process_bill_files_parallel(files, options, bill_index, workers)
+    else:
+        seen_bill_ids, parsed_bill_ids = process_bill_files(files, options, bill_index)
+
+    # Store the prognoses of the parsed bills before indexing, which reads
+    # them. A bill's prognosis also depends on its identical bills, so the
+    # bills that are identical to a parsed bill are updated (and re-indexed)
+    # too.
+    if parsed_bill_ids:
+        from bill.prognosis import update_stored_prognoses_by_id
+        companion_bill_ids = set()
+        for i in range(0, len(parsed_bill_ids), 500):
+            companion_bill_ids |= set(RelatedBill.objects.filter(related_bill__in=parsed_bill_ids[i:i+500], relation="identical")
+                .values_list("bill_id", flat=True))
+        companion_bill_ids -= set(parsed_bill_ids)
+        count = update_stored_prognoses_by_id(set(parsed_bill_ids) | companion_bill_ids)
+        log.info('Updated prognoses: %d' % count)
+        if bill_index:
+            bill_index.bill_ids |= companion_bill_ids
 
-            if not options.disable_events:
-                bill.create_events()
-                
-        File.objects.save_file(fname)
-        
     # delete bill objects that are no longer represented on disk.... this is too dangerous.
     if options.congress and not options.filter:
         # this doesn't work because seen_bill_ids is too big for sqlite!
@@ -454,12 +469,279 @@ def main(options):
         
     # The rest is for current only...
     
-    if options.congress and int(options.congress) != settings.CURRENT_CONGRESS:
-        return
-        
-    # Find what might be coming up this week.
-    load_docs_house_gov(options, bill_index)
-    #load_senate_floor_schedule(options, bill_index) # the file seems to have changed schema and doesn't have any bills listed
+    if not options.congress or int(options.congress) == settings.CURRENT_CONGRESS:
+        # Find what might be coming up this week.
+        load_docs_house_gov(options, bill_index)
+        #load_senate_floor_schedule(options, bill_index) # the file seems to have changed schema and doesn't have any bills listed
+
+    if bill_index:
+        bill_index.flush()
+
+    File.objects.flush()
+
+
+class BillIndexQueue:
+    """
+    Collects the bills whose search index documents need to be updated
+    during a parse and then updates them in large batches, building the
+    documents from bills loaded with their related objects prefetched,
+    rather than loading and writing one document per bill as it is parsed.
+    """
+
+    BATCH_SIZE = 500
+
+    def __init__(self):
+        from bill.search_indexes import BillIndex
+        self.index = BillIndex()
+        self.bill_ids = set()
+
+    def add(self, bill):
+        self.bill_ids.add(bill.id)
+
+    def flush(self):
+        bill_ids = sorted(self.bill_ids)
+        self.bill_ids = set()
+        if not bill_ids: return
+
+        backend = self.index.get_backend(using="bill")
+        batches = [bill_ids[i:i+self.BATCH_SIZE] for i in range(0, len(bill_ids), self.BATCH_SIZE)]
+        progress = Progress(total=len(batches), name='index batches')
+        start = time.time()
+        for i, batch in enumerate(batches):
+            progress.tick()
+            bills = list(Bill.objects.filter(id__in=batch).prefetch_related(*self.index.prefetch_related_list))
+            # Commit once, with the last batch.
+            backend.update(self.index, bills, commit=(i == len(batches)-1))
+        elapsed = time.time() - start
+        log.info('Indexed %d bills in %.1f seconds (%.1f docs/sec)' % (len(bill_ids), elapsed, len(bill_ids) / max(elapsed, .001)))
+
+
+def update_prognoses(options):
+    """
+    Recompute the stored prognoses of all current bills whose
+    model or inputs have changed (parse.py bill -m update_prognoses).
+    """
+    from bill.prognosis import update_stored_prognoses_by_id
+    bill_ids = Bill.objects.filter(congress=settings.CURRENT_CONGRESS).values_list("id", flat=True)
+    count = update_stored_prognoses_by_id(bill_ids)
+    log.info('Updated prognoses: %d' % count)
+
+
+def process_bill_files(files, options, bill_index, progress_name='files'):
+    """
+    Parse the given bill data.xml files in order and return the
+    ids of the bills that they represent and the ids of the bills
+    that were parsed (i.e. not skipped because they were unchanged).
+    """
+
+    progress = Progress(total=len(files), name=progress_name, step=100)
+    bill_processor = BillProcessor()
+    seen_bill_ids = []
+    parsed_bill_ids = []
+    for fname in files:
+        progress.tick()
+        seen_bill_ids.extend(process_bill_file(fname, options, bill_processor, bill_index, parsed_bill_ids))
+    return seen_bill_ids, parsed_bill_ids
+
+
+def process_bill_file(fname, options, bill_processor, bill_index, parsed_bill_ids):
+    """
+    Parse one bill data.xml file and return the ids of the bills it
+    represents. The ids of the bills that are parsed are added to
+    parsed_bill_ids.
+    """
+
+    seen_bill_ids = []
+
+    # With indexing or events enabled, if the bill metadata file hasn't changed check
+    # the bill's latest text file for changes so we can create a text-is-available
+    # event and so we can index the bill's text.
+    if (not options.congress or int(options.congress)>42) and (bill_index and not options.disable_events) and not File.objects.is_changed(fname) and not options.force:
+        m = re.match(re.escape(settings.CONGRESS_DATA_PATH) + r'/(?P<congress>\d+)/bills/(?P<bill_type>[a-z]+)/(?P<bill_type_2>[a-z]+)(?P<number>\d+)/data.xml', fname)
+
+        try:
+            b = Bill.objects.get(congress=int(m.group("congress")), bill_type=BillType.by_slug(m.group("bill_type")), number=m.group("number"))
+            seen_bill_ids.append(b.id)
+
+            # Update the index/events for any bill with recently changed text
+            textfile = get_bill_text_metadata(b, None)
+            if not textfile:
+                if b.congress >= 103 and b.introduced_date < (datetime.now()-timedelta(days=42)).date():
+                    print("No bill text?", fname, b.introduced_date)
+                return seen_bill_ids
+            textfile = textfile.get("text_file")
+            if not textfile:
+                print("Bill text exists but text-only layer missing", fname, b.introduced_date)
+            elif len(textfile) > 100:
+                pass # File has a limit on path length and docs.house.gov filenames can be very long
+            elif os.path.exists(textfile) and File.objects.is_changed(textfile):
+                bill_index.add(b) # index the full text
+                b.create_events() # events for new bill text documents
+                File.objects.save_file(textfile)
+
+            return seen_bill_ids
+        except Bill.DoesNotExist:
+            print("Unchanged metadata file but bill doesn't exist:", fname)
+            pass # just parse as normal
+
+    if options.slow:
+        time.sleep(1)
+
+    if options.filter == "recent":
+      if datetime.fromtimestamp(os.path.getmtime(fname)) < datetime.now() - timedelta(days=1):
+        return seen_bill_ids
+
+    tree = etree.parse(fname)
+    for node in tree.xpath('/bill'):
+        try:
+            bill = bill_processor.process(Bill(), node)
+        except:
+            print(fname)
+            raise
+
+        seen_bill_ids.append(bill.id) # don't delete me later
+
+        # So far this is just for American Memory bills.
+        if node.xpath("string(source/@url)"):
+            bill.source_link = str(node.xpath("string(source/@url)"))
+        else:
+            bill.source_link = None
+
+        actions = []
+        for axn in tree.xpath("actions/*[@state]"):
+            if axn.xpath("string(@state)") == "REFERRED": continue # we don't track this state
+            actions.append( (
+            	repr(bill_processor.parse_datetime(axn.xpath("string(@datetime)"))),
+            	BillStatus.by_xml_code(axn.xpath("string(@state)")),
+            	axn.xpath("string(text)"),
+                etree.tostring(axn, encoding=str),
+            	) )
+
+        bill.sliplawpubpriv = None
+        bill.sliplawnum = None
+        for axn in tree.xpath("actions/enacted"):
+            bill.sliplawpubpriv = "PUB" if axn.get("type") == "public" else "PRI"
+            bill.sliplawnum = int(axn.get("number").split("-")[1])
+
+        bill.major_actions = actions
+        try:
+            bill.save()
+        except:
+            print(bill)
+            raise
+
+        # The bill's prognosis is stored after all of the files are parsed.
+        parsed_bill_ids.append(bill.id)
+
+        if bill_index:
+            bill_index.add(bill)
+
+        if not options.disable_events:
+            bill.create_events()
+
+    File.objects.save_file(fname)
+    return seen_bill_ids
+
+
+def shard_bill_files(files, workers):
+    """
+    Group bill files by congress and bill type (i.e. by the
+    data/congress/{congress}/bills/{bill_type} directory) and distribute
+    the groups over the workers, largest group first, so that each worker
+    gets about the same number of files. The assignment only depends on
+    the file list so it is the same from run to run.
+    """
+
+    groups = { }
+    for fname in sorted(files):
+        groups.setdefault(os.path.dirname(os.path.dirname(fname)), []).append(fname)
+
+    shards = [[] for i in range(workers)]
+    for key in sorted(groups, key=lambda key : (-len(groups[key]), key)):
+        min(shards, key=len).extend(groups[key])
+    return [shard for shard in shards if shard]
+
+
+def process_bill_files_parallel(files, options, bill_index, workers):
+    """
+    Parse bill files in forked worker processes, one shard of
+    congress/bill type directories per worker, and return the merged
+    ids of the bills seen and of the bills parsed, sorted. The bills
+    each worker queued for indexing are added to bill_index, and the
+    File records each worker saved are queued to be written by the
+    parent after indexing.
+    """
+
+    import multiprocessing
+    import django.db
+
+    # Load the caches before forking so that each worker gets a copy
+    # rather than each querying for them separately.
+    load_person_cache()
+    load_term_cache()
+    load_committee_cache()
+
+    shards = shard_bill_files(files, workers)
+    log.info('Processing bills with %d workers' % len(shards))
+
+    # Django database connections can't be shared across processes, so
+    # close them before forking. Each worker opens its own connection.
+    for db in django.db.connections.all(): db.close()
+
+    ctx = multiprocessing.get_context("fork")
+    pool = []
+    for i, shard in enumerate(shards):
+        parent_conn, child_conn = ctx.Pipe(duplex=False)
+        proc = ctx.Process(target=bill_files_worker, args=(child_conn, shard, options, bill_index, 'files (worker %d)' % (i+1)))
+        proc.start()
+        child_conn.close()
+        pool.append((proc, parent_conn))
+
+    seen_bill_ids = set()
+    parsed_bill_ids = set()
+    errors = []
+    for proc, conn in pool:
+        try:
+            status, value = conn.recv()
+        except EOFError:
+            status, value = "error", "worker exited with code %s" % proc.exitcode
+        conn.close()
+        proc.join()
+        if status == "ok":
+            seen_bill_ids |= set(value[0])
+            parsed_bill_ids |= set(value[1])
+            if bill_index:
+                bill_index.bill_ids |= set(value[2])
+            File.objects.add_pending(value[3])
+        else:
+            errors.append(value)
+
+    if errors:
+        for error in errors:
+            log.error(error)
+        raise Exception("%d of %d bill parser workers failed." % (len(errors), len(pool)))
+
+    return sorted(seen_bill_ids), sorted(parsed_bill_ids)
+
+
+def bill_files_worker(conn, files, options, bill_index, progress_name):
+    import traceback
+    import django.db
+
+    # close db connections in forked children on start
+    # in case there was any shared state with parent process
+    for db in django.db.connections.all(): db.close()
+
+    try:
+        seen_bill_ids, parsed_bill_ids = process_bill_files(files, options, bill_index, progress_name=progress_name)
+        # The parent process stores the prognoses, does the indexing, and then
+        # writes the File records.
+        conn.send(("ok", (seen_bill_ids, parsed_bill_ids, sorted(bill_index.bill_ids) if bill_index else [], File.objects.get_pending())))
+    except Exception:
+        conn.send(("error", traceback.format_exc()))
+    finally:
+        conn.close()
+        for db in django.db.connections.all(): db.close()
 
 
 def load_senate_floor_schedule(options, bill_index):
@@ -476,7 +758,7 @@ def load_senate_floor_schedule(options, bill_index):
                 if bill.docs_house_gov_postdate is None or bill.senate_floor_schedule_postdate > bill.docs_house_gov_postdate: bill.scheduled_consideration_date = entry["date"]
                 bill.save()
                 if bill_index:
-                    bill.update_index(bill_index)
+                    bill_index.add(bill)
                 if not options.disable_events:
                     bill.create_events()
 
@@ -541,7 +823,7 @@ def load_docs_house_gov(options, bill_index):
             bill.docs_house_gov_postdate = BillProcessor.parse_datetime(billinfo["published_at"])
             if bill.senate_floor_schedule_postdate is None or bill.docs_house_gov_postdate > bill.senate_floor_schedule_postdate: bill.scheduled_consideration_date = BillProcessor.parse_datetime(data["week_of"])
             bill.save()
-            if bill_index: bill.update_index(bill_index)
+            if bill_index: bill_index.add(bill)
             if not options.disable_events: bill.create_events()
 
 if __name__ == '__main__':
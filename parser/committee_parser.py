@@ -143,6 +143,10 @@ def parse_committee_members(options):
         total = len(tree)
         progress = Progress(total=total + 1, name='committees') # it's an error if total is zero
         
+        # Note the current membership to know which committees' bills need
+        # their stored prognoses refreshed afterwards.
+        old_membership = set(CommitteeMember.objects.values_list("person_id", "committee_id", "role"))
+
         # We can delete CommitteeMember objects because we don't have
         # any foreign keys to them.
         CommitteeMember.objects.all().delete()
@@ -167,6 +171,18 @@ def parse_committee_members(options):
             
             progress.tick()
 
+        # Refresh the stored prognoses of current bills referred to committees
+        # whose membership changed. (The prognosis reads membership from
+        # data/historical-committee-membership, which run_scrapers.py
+        # regenerates before this runs.)
+        new_membership = set(CommitteeMember.objects.values_list("person_id", "committee_id", "role"))
+        changed_committees = set(committee_id for person_id, committee_id, role in old_membership ^ new_membership)
+        if changed_committees:
+            from bill.prognosis import update_stored_prognoses_by_id
+            bill_ids = Bill.committees.through.objects.filter(bill__congress=settings.CURRENT_CONGRESS, committee_id__in=changed_committees).values_list("bill_id", flat=True)
+            count = update_stored_prognoses_by_id(bill_ids)
+            log.info('Updated bill prognoses: %d' % count)
+
         File.objects.save_file(MEMBERS_FILE)
 
 def parse_committee_schedules(options):
@@ -0,0 +1,23 @@
+# Generated by Django 4.1.13 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('parser', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='file',
+            name='size',
+            field=models.BigIntegerField(blank=True, help_text='The size of the file when the checksum was saved.', null=True),
+        ),
+        migrations.AddField(
+            model_name='file',
+            name='mtime_ns',
+            field=models.BigIntegerField(blank=True, help_text='The modification time of the file in nanoseconds when the checksum was saved.', null=True),
+        ),
+    ]
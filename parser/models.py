@@ -3,13 +3,20 @@ Internal info about statuses
 of previus parsings.
 """
 import binascii
+import os
+import re
 from io import BytesIO
 
 from django.db import models
+from django.utils import timezone
+
+CHUNK_SIZE = 1024*1024
 
 def crc(fname, content=None):
     """
-    Calculate CRC-32 checksum of the file contents.
+    Calculate CRC-32 checksum of the file contents,
+    reading the file in chunks. (The checksum is the
+    same however the contents are split up.)
     """
 
     if content is not None:
@@ -17,14 +24,60 @@ def crc(fname, content=None):
     else:
         fobj = open(fname, 'rb')
     value = 0
-    for line in fobj:
-        value = binascii.crc32(line, value)
+    with fobj:
+        for chunk in iter(lambda : fobj.read(CHUNK_SIZE), b''):
+            value = binascii.crc32(chunk, value)
     value = value & 0xFFFFFFFF
-    fobj.close()
     return "%08x" % value
 
 
 class FileManager(models.Manager):
+    """
+    Tracks which files have changed since they were last parsed.
+
+    A file whose size and modification time are the same as when its
+    checksum was saved is assumed to be unchanged without reading it.
+    Otherwise it is hashed and the checksum compared.
+
+    A parser can call `preload` with the glob pattern of its files to
+    load all of their records in one query rather than one query per
+    file, and then `flush` at the end to write the saved checksums in
+    bulk. Between the two, nothing is written, so a parser can flush
+    only after everything that depends on the files (e.g. indexing)
+    has succeeded.
+    """
+
+    # Per-process state between preload() and flush().
+    preloaded_prefixes = []
+    known_files = { } # path => File
+    pending_files = { } # path => File to write in flush()
+    hashed_files = { } # path => (size, mtime_ns, checksum) computed in is_changed()
+
+    def preload(self, pattern):
+        """
+        Load the records of all files in the directory that the
+        glob pattern starts with.
+        """
+
+        prefix = re.split(r"[*?\[]", pattern, 1)[0]
+        for fobj in self.filter(path__startswith=prefix).order_by("id"):
+            self.known_files.setdefault(fobj.path, fobj) # first record, like get() would (mostly) find
+        self.preloaded_prefixes.append(prefix)
+
+    def is_preloaded(self, path):
+        return any(path.startswith(prefix) for prefix in self.preloaded_prefixes)
+
+    def get_file(self, path):
+        """
+        Return the File record for the path, or None.
+        """
+
+        if path in self.known_files:
+            return self.known_files[path]
+        if self.is_preloaded(path):
+            return None
+        return self.filter(path=path).order_by("id").first()
+
     def is_changed(self, path, content=None):
         """
         Compare checksum of the file stored in DB and
@@ -32,27 +85,104 @@ class FileManager(models.Manager):
         `is_changed`  is always true if no info about the file
         is stored in DB.
         """
-        
-        checksum = crc(path, content)
-        try:
-            fobj = File.objects.get(path=path)
-        except File.DoesNotExist:
+
+        fobj = self.get_file(path)
+        if content is not None:
+            return fobj is None or str(fobj.checksum) != crc(path, content)
+        if fobj is None:
+            return True
+
+        # If the file's stats haven't changed, don't read it.
+        st = os.stat(path)
+        if fobj.size == st.st_size and fobj.mtime_ns == st.st_mtime_ns:
+            return False
+
+        checksum = crc(path)
+        self.hashed_files[path] = (st.st_size, st.st_mtime_ns, checksum)
+        if str(fobj.checksum) != checksum:
             return True
-        else:
-            return str(fobj.checksum) != checksum
+
+        # The file was touched but its contents are the same (or the stats
+        # weren't stored yet). Store the new stats so the next run doesn't
+        # have to read it.
+        fobj.size = st.st_size
+        fobj.mtime_ns = st.st_mtime_ns
+        self.write_file(fobj, ["size", "mtime_ns"])
+        return False
 
     def save_file(self, path, content=None):
         """
         Save checksum of the file.
         """
 
-        checksum = crc(path, content)
-        try:
-            fobj = File.objects.get(path=path)
-        except File.DoesNotExist:
-            fobj = File(path=path)
-        fobj.checksum = checksum
-        fobj.save()
+        fobj = self.get_file(path) or File(path=path)
+        if content is not None:
+            # The stats of the file on disk don't describe the content.
+            fobj.checksum = crc(path, content)
+            fobj.size = None
+            fobj.mtime_ns = None
+        else:
+            st = os.stat(path)
+            hashed = self.hashed_files.pop(path, None)
+            if hashed and hashed[0:2] == (st.st_size, st.st_mtime_ns):
+                fobj.checksum = hashed[2] # is_changed just read it
+            else:
+                fobj.checksum = crc(path)
+            fobj.size = st.st_size
+            fobj.mtime_ns = st.st_mtime_ns
+        fobj.processed = timezone.now()
+        self.write_file(fobj, ["checksum", "size", "mtime_ns", "processed"])
+
+    def write_file(self, fobj, fields):
+        if self.preloaded_prefixes:
+            self.known_files[fobj.path] = fobj
+            self.pending_files[fobj.path] = fobj
+        elif fobj.id:
+            fobj.save(update_fields=fields)
+        else:
+            fobj.save()
+
+    def get_pending(self):
+        """
+        Return the records waiting to be written, e.g. to pass them
+        from a worker process to the parent process.
+        """
+
+        return list(self.pending_files.values())
+
+    def add_pending(self, fobjs):
+        """
+        Queue records from `get_pending` in another process to be
+        written by `flush` in this one.
+        """
+
+        for fobj in fobjs:
+            self.pending_files[fobj.path] = fobj
+
+    def discard_pending(self, paths):
+        """
+        Don't write the records saved for these paths, e.g. because
+        something that depends on the files failed, so that they are
+        processed again on the next run.
+        """
+
+        for path in paths:
+            self.pending_files.pop(path, None)
+
+    def flush(self):
+        """
+        Write the records saved since `preload` in bulk and
+        forget the preloaded records.
+        """
+
+        updated = [fobj for fobj in self.pending_files.values() if fobj.id]
+        created = [fobj for fobj in self.pending_files.values() if not fobj.id]
+        self.bulk_update(updated, ["checksum", "size", "mtime_ns", "processed"], batch_size=500)
+        self.bulk_create(created, batch_size=500)
+        self.preloaded_prefixes.clear()
+        self.known_files.clear()
+        self.pending_files.clear()
+        self.hashed_files.clear()
 
 
 class File(models.Model):
@@ -62,6 +192,8 @@ class File(models.Model):
 
     path = models.CharField(max_length=100, db_index=True)
     checksum = models.CharField(max_length=8)
+    size = models.BigIntegerField(blank=True, null=True, help_text="The size of the file when the checksum was saved.")
+    mtime_ns = models.BigIntegerField(blank=True, null=True, help_text="The modification time of the file in nanoseconds when the checksum was saved.")
     processed = models.DateTimeField(auto_now=True)
 
     def __str__(self):
@@ -150,7 +150,7 @@ def update_people_table(options):
     for p in SRC_FILES:
         log.info('Opening %s...' % p)
         f = BASE_PATH + p + ".yaml"
-        y = yaml_load(f)
+        y = yaml_load(f, copy=True) # we modify it
         for m in y:
             if p == "legislators-current":
                 # We know all terms but the last are non-current and the last is.
@@ -197,6 +197,11 @@ def update_people_table(options):
     processed_persons = set()
     created_persons = set()
 
+    # Note the majority party before updating roles to know which stored
+    # bill prognoses to refresh afterwards.
+    updated_role_persons = set()
+    majority_party = get_majority_party()
+
     progress = Progress(total=len(legislator_data))
     log.info('Processing persons')
 
@@ -335,6 +340,9 @@ def update_people_table(options):
                 log.warn("Deleted %s" % pr)
                 pr.delete()
             
+            if did_update_any:
+                updated_role_persons.add(person.id)
+
             if did_update_any and not options.disable_events:
                 # Create the events for the roles after all have been loaded
                 # because we don't create events for ends of terms and
@@ -382,11 +390,42 @@ def update_people_table(options):
                 p.delete()
         log.info('Missing/deleted persons: %d' % len(removed_persons))
     
+        # Refresh the stored prognoses of bills affected by role changes.
+        update_bill_prognoses(updated_role_persons, majority_party)
+
         # Mark the files as processed.
         for p in SRC_FILES:
             f = BASE_PATH + p + ".yaml"
             File.objects.save_file(f)
 
+def get_majority_party():
+    from bill.prognosis import load_majority_party
+    try:
+        return load_majority_party(CURRENT_CONGRESS)
+    except IndexError: # no roles loaded yet
+        return None
+
+def update_bill_prognoses(person_ids, majority_party):
+    """
+    Refresh the stored prognoses of current bills sponsored or
+    cosponsored by the given people, or of all current bills
+    if the majority party changed.
+    """
+    from bill.models import Bill, Cosponsor
+    from bill.prognosis import update_stored_prognoses_by_id
+    bills = Bill.objects.filter(congress=CURRENT_CONGRESS)
+    if get_majority_party() != majority_party:
+        bill_ids = set(bills.values_list("id", flat=True))
+    else:
+        person_ids = sorted(person_ids)
+        bill_ids = set()
+        for i in range(0, len(person_ids), 500):
+            chunk = person_ids[i:i+500]
+            bill_ids |= set(bills.filter(sponsor_id__in=chunk).values_list("id", flat=True))
+            bill_ids |= set(Cosponsor.objects.filter(bill__congress=CURRENT_CONGRESS, person_id__in=chunk).values_list("bill_id", flat=True))
+    count = update_stored_prognoses_by_id(bill_ids)
+    log.info('Updated bill prognoses: %d' % count)
+
 def filter_yaml_term_structure(node):
     ret = { }
     for k, v in node.items():
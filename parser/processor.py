@@ -136,32 +136,59 @@ class YamlProcessor(Processor):
     def get_node_child_value(self, node, name):
         raise Exception("Not available for YAML files.")
 
-def yaml_load(path):
+YAML_CACHE_VERSION = 1 # increment when the format of the .pickle2 files changes
+yaml_cache = { } # path => (key, data) of the YAML files loaded in this process
+
+def yaml_load(path, copy=False):
     # Loading YAML is ridiculously slow. In congress-legislators's
     # utils, we cache the YAML in a pickled file which is a lot
     # faster. The format of the pickle file is incompatible with
 	# what the congress project utils.py does, so use a different filename.
-
-    import pickle as pickle, os.path, hashlib
+    #
+    # The pickled file is used as long as the YAML file's size and
+    # modification time match the ones stored in it, so the YAML file
+    # isn't read at all when it hasn't changed. The data is also kept
+    # in memory for later calls in the same process. Those calls get the
+    # same object, so callers that modify it should pass copy=True.
+
+    import pickle as pickle, os
     import yaml
     try:
         from yaml import CSafeLoader as Loader, CDumper as Dumper
     except ImportError:
         from yaml import SafeLoader as Loader, Dumper
 
-    # Check if the .pickle file exists and a hash stored inside it
-    # matches the hash of the YAML file, and if so unpickle it.
-    h = hashlib.sha1(open(path, 'rb').read()).hexdigest()
-    if os.path.exists(path + ".pickle2"):
-        store = pickle.load(open(path + ".pickle2", 'rb'))
-        if store["hash"] == h:
-            return store["data"]
-
-    # No cached pickled data exists, so load the YAML file.
-    data = yaml.load(open(path), Loader=Loader)
-
-    # Store in a pickled file for fast access later.
-    pickle.dump({ "hash": h, "data": data }, open(path+".pickle2", "wb"))
-
-    return data
+    st = os.stat(path)
+    key = [YAML_CACHE_VERSION, path, st.st_size, st.st_mtime_ns]
 
+    cached = yaml_cache.get(path)
+    if cached is None or cached[0] != key:
+        # Check if the .pickle2 file exists and was stored for this
+        # version of the YAML file, and if so unpickle it.
+        cached = None
+        try:
+            with open(path + ".pickle2", 'rb') as f:
+                store = pickle.load(f)
+            if isinstance(store, dict) and store.get("key") == key:
+                cached = (key, store["data"])
+        except (IOError, EOFError, pickle.UnpicklingError):
+            pass
+
+        if cached is None:
+            # No cached pickled data exists, so load the YAML file.
+            with open(path) as f:
+                data = yaml.load(f, Loader=Loader)
+
+            # Store in a pickled file for fast access later. Write to a
+            # temporary file first so other processes never see part of it.
+            tmp_path = "%s.pickle2.%d.tmp" % (path, os.getpid())
+            with open(tmp_path, "wb") as f:
+                pickle.dump({ "key": key, "data": data }, f, protocol=5)
+            os.replace(tmp_path, path + ".pickle2")
+            cached = (key, data)
+
+        yaml_cache[path] = cached
+
+    if copy:
+        return pickle.loads(pickle.dumps(cached[1], protocol=5))
+    return cached[1]
@@ -12,7 +12,7 @@ from parser.processor import XmlProcessor
 from person.models import Person, PersonRole
 from person.types import RoleType
 from parser.models import File
-from person.util import load_roles_at_date
+from person.util import RoleDateIndex
 from bill.models import Bill, BillType, Amendment, AmendmentType
 from vote.models import (Vote, VoteOption, VoteSource, Voter,
                          CongressChamber, VoteCategory, VoterType)
@@ -119,17 +119,22 @@ def main(options):
     voter_processor = VoterProcessor()
     voter_processor.PERSON_CACHE = dict((x.pk, x) for x in Person.objects.all())
 
+    # Load the roles of all legislators (and vice presidents) once rather
+    # than querying for the roles of the voters on each vote.
+    role_index = RoleDateIndex(congress=options.congress if not options.filter else None)
+
     chamber_mapping = {'s': CongressChamber.senate,
                        'h': CongressChamber.house}
 
     if options.filter:
-        files = glob.glob(options.filter)
+        files_pattern = options.filter
         log.info('Parsing rolls matching %s' % options.filter)
     elif options.congress:
-        files = glob.glob(settings.CONGRESS_DATA_PATH + '/%s/votes/*/*/data.xml' % options.congress)
+        files_pattern = settings.CONGRESS_DATA_PATH + '/%s/votes/*/*/data.xml' % options.congress
         log.info('Parsing rolls of only congress#%s' % options.congress)
     else:
-        files = glob.glob(settings.CONGRESS_DATA_PATH + '/*/votes/*/*/data.xml')
+        files_pattern = settings.CONGRESS_DATA_PATH + '/*/votes/*/*/data.xml'
+    files = glob.glob(files_pattern)
     log.info('Processing votes: %d files' % len(files))
     total = len(files)
     progress = Progress(total=total, name='files', step=10)
@@ -143,21 +148,37 @@ def main(options):
         qs.delete()
 
     seen_obj_ids = set()
+    changed_vote_ids = []
+    changed_vote_files = { } # vote id => fname
     had_error = False
 
+    # Load the checksum records of the files and the votes already in the
+    # database with a query each, rather than querying for them for each
+    # file, so that files that haven't changed are skipped quickly.
+    File.objects.preload(files_pattern)
+    existing_votes = Vote.objects.all()
+    if options.congress and not options.filter:
+        existing_votes = existing_votes.filter(congress=options.congress)
+    existing_votes = {
+        (congress, chamber, session, number): (vote_id, missing_data)
+        for vote_id, congress, chamber, session, number, missing_data
+        in existing_votes.values_list("id", "congress", "chamber", "session", "number", "missing_data")
+    }
+
     for fname in files:
         progress.tick()
 
         match = re.search(r"(?P<congress>\d+)/votes/(?P<session>[ABC0-9]+)/(?P<chamber>[hs])(?P<number>\d+)/data.xml$", fname)
         
-        try:
-            existing_vote = Vote.objects.get(congress=int(match.group("congress")), chamber=chamber_mapping[match.group("chamber")], session=match.group("session"), number=int(match.group("number")))
-        except Vote.DoesNotExist:
-            existing_vote = None
+        existing_vote_id, existing_vote_missing_data = existing_votes.get(
+            (int(match.group("congress")), chamber_mapping[match.group("chamber")], match.group("session"), int(match.group("number"))),
+            (None, None))
         
-        if not File.objects.is_changed(fname) and not options.force and existing_vote != None and not existing_vote.missing_data:
-            seen_obj_ids.add(existing_vote.id)
+        if not File.objects.is_changed(fname) and not options.force and existing_vote_id != None and not existing_vote_missing_data:
+            seen_obj_ids.add(existing_vote_id)
             continue
+
+        existing_vote = Vote.objects.get(id=existing_vote_id) if existing_vote_id else None
             
         try:
             tree = etree.parse(fname)
@@ -259,23 +280,29 @@ def main(options):
                 # Process roll options, overwrite existing options where possible.
                 seen_option_ids = set()
                 roll_options = {}
+                existing_options = { }
+                if existing_vote:
+                    for option_id, option_key in VoteOption.objects.filter(vote=vote).values_list("id", "key"):
+                        existing_options.setdefault(option_key, option_id) # there can be duplicates, I had the database corruption problem
                 for option_node in roll_node.xpath('./option'):
                     option = option_processor.process(VoteOption(), option_node)
                     option.vote = vote
-                    if existing_vote:
-                        try:
-                            option.id = VoteOption.objects.filter(vote=vote, key=option.key)[0].id # get is better, but I had the database corruption problem
-                        except IndexError:
-                            pass
+                    if option.key in existing_options:
+                        option.id = existing_options[option.key]
                     option.save()
                     roll_options[option.key] = option
                     seen_option_ids.add(option.id)
                 log_delete_qs(VoteOption.objects.filter(vote=vote).exclude(id__in=seen_option_ids)) # may cascade and delete the Voters too?
 
                 # Process roll voters, overwriting existing voters where possible.
+                # Existing records are keyed on (vote, person).
+                existing_voter_ids = set()
+                existing_voters = { }
                 if existing_vote:
-                    existing_voters = dict(Voter.objects.filter(vote=vote).values_list("person", "id"))
-                seen_voter_ids = set()
+                    for voter_id, person_id in Voter.objects.filter(vote=vote).values_list("id", "person"):
+                        existing_voter_ids.add(voter_id)
+                        if person_id is not None:
+                            existing_voters[person_id] = voter_id
                 voters = list()
                 for voter_node in roll_node.xpath('./voter'):
                     voter = voter_processor.process(roll_options, Voter(), voter_node)
@@ -285,18 +312,15 @@ def main(options):
                     # for VP votes, load the actual person & role...
                     if voter.voter_type == VoterType.vice_president:
                         try:
-                            r = PersonRole.objects.get(role_type=RoleType.vicepresident, startdate__lte=vote.created, enddate__gte=vote.created)
+                            r = role_index.vice_president_at_date(vote.created)
                             voter.person_role = r
-                            voter.person = r.person
+                            voter.person = voter_processor.PERSON_CACHE.get(r.person_id) or r.person
                         except PersonRole.DoesNotExist:
                             # overlapping roles? missing data?
                             log.error('Could not resolve vice president in %s' % fname)
                         
-                    if existing_vote and voter.person:
-                        try:
-                            voter.id = existing_voters[voter.person.id]
-                        except KeyError:
-                            pass
+                    if voter.person and voter.person.id in existing_voters:
+                        voter.id = existing_voters.pop(voter.person.id) # pop so a duplicate voter gets a new record
                         
                     voters.append(voter)
                     
@@ -305,7 +329,7 @@ def main(options):
                         vote.save()
                         
                 # pre-fetch the role of each voter
-                load_roles_at_date([x.person for x in voters if x.person != None], vote.created, vote.congress)
+                role_index.load_roles_at_date([x.person for x in voters if x.person != None], vote.created, vote.congress)
                 for voter in list(voters):
                     if voter.voter_type != VoterType.vice_president:
                         voter.person_role = voter.person.role
@@ -330,16 +354,23 @@ def main(options):
                             vote.missing_data = True
                             vote.save()
 
-                # save all of the records (inserting/updating)
-                for voter in voters:
-                    voter.save()
-                    seen_voter_ids.add(voter.id)
-                    
-                # remove obsolete voter records
-                log_delete_qs(Voter.objects.filter(vote=vote).exclude(id__in=seen_voter_ids)) # possibly already deleted by cascade above
+                # remove obsolete voter records first, since the ids of new
+                # records aren't known after a bulk insert on all databases
+                obsolete_voter_ids = existing_voter_ids - set(voter.id for voter in voters if voter.id)
+                if obsolete_voter_ids:
+                    log_delete_qs(Voter.objects.filter(id__in=obsolete_voter_ids))
+
+                # save all of the records (updating, then inserting) in bulk
+                Voter.objects.bulk_update([voter for voter in voters if voter.id],
+                    ["person", "person_role", "voter_type", "option", "voteview_extra_code", "created"],
+                    batch_size=500)
+                Voter.objects.bulk_create([voter for voter in voters if not voter.id],
+                    batch_size=500)
 
-                # pre-calculate totals
-                vote.calculate_totals()
+                # pre-calculate totals from the records we have in memory
+                vote.calculate_totals(voters=voters, options=list(roll_options.values()))
+                changed_vote_ids.append(vote.id)
+                changed_vote_files[vote.id] = fname
 
                 if not options.disable_events:
                     vote.create_event()
@@ -349,10 +380,131 @@ def main(options):
         except Exception as ex:
             log.error('Error in processing %s' % fname, exc_info=ex)
             had_error = True
-        
+
     # delete vote objects that are no longer represented on disk
     if options.congress and not options.filter and not had_error:
         log_delete_qs(Vote.objects.filter(congress=options.congress).exclude(id__in = seen_obj_ids))
 
+    # update the rows of the votes that changed in the vote matrix store
+    # (votes deleted above are dropped from it the next time it's updated)
+    if changed_vote_ids:
+        from vote import matrix_store
+        matrix_store.update_votes(changed_vote_ids)
+
+    # compute the statistical analyses and render the images of the votes
+    # that changed
+    failed_vote_ids = run_vote_workers(changed_vote_ids, options.workers, update_vote_analytics_and_images)
+
+    # Record the checksums of the files now that their votes are done. The
+    # files of votes that failed post-processing aren't recorded so that
+    # they are processed again on the next run.
+    File.objects.discard_pending([changed_vote_files[vote_id] for vote_id in failed_vote_ids])
+    File.objects.flush()
+
+
+def update_analytics(options):
+    """
+    Compute the stored analytics of votes that don't have them or
+    that have them from an older version of the analysis
+    (parse.py vote -m update_analytics).
+    """
+    votes = Vote.objects.all()
+    if options.congress:
+        votes = votes.filter(congress=options.congress)
+    vote_ids = [vote.id for vote in votes.only("id", "analytics") if not vote.get_stored_analytics()]
+    run_vote_workers(vote_ids, options.workers, update_vote_analytics_and_images)
+
+
+def update_vote_analytics_and_images(vote):
+    from vote import image_store
+    vote.compute_analytics()
+    vote.save(update_fields=["analytics"])
+    image_store.render_images(vote)
+
+
+def run_vote_workers(vote_ids, workers, func):
+    """
+    Call func on each of the given votes, in that many forked
+    worker processes if workers is more than one. An error on one
+    vote is logged and the other votes are still processed. Returns
+    the ids of the votes that failed.
+    """
+
+    if not vote_ids: return []
+    workers = min(workers or 1, len(vote_ids))
+    log.info('Post-processing %d votes' % len(vote_ids))
+    if workers <= 1:
+        failed_vote_ids = vote_worker(None, vote_ids, func)
+        if failed_vote_ids:
+            log.error("Post-processing failed for %d votes: %s" % (len(failed_vote_ids), ", ".join(map(str, failed_vote_ids))))
+        return failed_vote_ids
+
+    import multiprocessing
+    import django.db
+    from vote.analysis import load_ideology_scores
+
+    # Load the data files used by the analyses before forking so each
+    # worker gets a copy.
+    Person.load_caucus_membership_data()
+    congresses = set()
+    for i in range(0, len(vote_ids), 500):
+        congresses |= set(Vote.objects.filter(id__in=vote_ids[i:i+500]).values_list("congress", flat=True))
+    for congress in congresses:
+        load_ideology_scores(congress)
+
+    # Django database connections can't be shared across processes, so
+    # close them before forking. Each worker opens its own connection.
+    for db in django.db.connections.all(): db.close()
+
+    ctx = multiprocessing.get_context("fork")
+    pool = []
+    for i in range(workers):
+        parent_conn, child_conn = ctx.Pipe(duplex=False)
+        proc = ctx.Process(target=vote_worker, args=(child_conn, vote_ids[i::workers], func))
+        proc.start()
+        child_conn.close()
+        pool.append((proc, parent_conn))
+
+    failed_vote_ids = []
+    for i, (proc, conn) in enumerate(pool):
+        try:
+            failed_vote_ids.extend(conn.recv())
+        except EOFError:
+            # The worker died without reporting, so we don't know which
+            # of its votes were done.
+            log.error("Vote worker exited with code %s" % proc.exitcode)
+            failed_vote_ids.extend(vote_ids[i::workers])
+        conn.close()
+        proc.join()
+
+    if failed_vote_ids:
+        log.error("Post-processing failed for %d votes: %s" % (len(failed_vote_ids), ", ".join(map(str, sorted(failed_vote_ids)))))
+    return failed_vote_ids
+
+
+def vote_worker(conn, vote_ids, func):
+    import django.db
+
+    if conn is not None:
+        # close db connections in forked children on start
+        # in case there was any shared state with parent process
+        for db in django.db.connections.all(): db.close()
+
+    failed_vote_ids = []
+    try:
+        for vote_id in vote_ids:
+            try:
+                func(Vote.objects.get(id=vote_id))
+            except Exception as ex:
+                log.error('Error in post-processing vote %d' % vote_id, exc_info=ex)
+                failed_vote_ids.append(vote_id)
+        if conn is not None:
+            conn.send(failed_vote_ids)
+        return failed_vote_ids
+    finally:
+        if conn is not None:
+            conn.close()
+            for db in django.db.connections.all(): db.close()
+
 if __name__ == '__main__':
     main()
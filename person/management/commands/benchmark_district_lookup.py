@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand
+
+import random
+import time
+
+from person.views import create_district_lookup_service
+
+class Command(BaseCommand):
+	help = 'Times district lookups with and without the tile cache on random points in the continental United States.'
+
+	def add_arguments(self, parser):
+		parser.add_argument('--count', type=int, default=2000, help='number of points to look up')
+		parser.add_argument('--seed', type=int, default=0, help='random seed for the points')
+
+	def handle(self, *args, **options):
+		rand = random.Random(options["seed"])
+		points = [(rand.uniform(-125, -66), rand.uniform(24, 50)) for i in range(options["count"])]
+
+		# The old behavior: each lookup decodes its tile and tests each polygon.
+		uncached = create_district_lookup_service(cache_size=0)
+		start = time.time()
+		expected = [uncached(lng, lat) for lng, lat in points]
+		uncached_time = time.time() - start
+
+		# Cold cache, then warm cache, using the batch lookup.
+		cached = create_district_lookup_service()
+		start = time.time()
+		results = cached.lookup(points)
+		cold_time = time.time() - start
+		start = time.time()
+		warm_results = [cached(lng, lat) for lng, lat in points]
+		warm_time = time.time() - start
+
+		assert results == expected
+		assert warm_results == expected
+
+		n = len(points)
+		print("%d points, %d in a district" % (n, sum(1 for r in expected if r is not None)))
+		print("uncached:           %8.1f ms (%.2f ms/point)" % (uncached_time*1000, uncached_time*1000/n))
+		print("batch, cold cache:  %8.1f ms (%.2f ms/point)" % (cold_time*1000, cold_time*1000/n))
+		print("single, warm cache: %8.1f ms (%.2f ms/point)" % (warm_time*1000, warm_time*1000/n))
@@ -543,9 +543,16 @@ class Person(models.Model):
         return caucuses
 
     def get_feed(self, feed_type="p"):
-        if feed_type not in ("p", "pv", "ps"): raise ValueError(feed_type)
         from events.models import Feed
-        return Feed.objects.get_or_create(feedname="%s:%d" % (feed_type, self.id))[0]
+        return Feed.get_cached(self.get_feedname(feed_type))
+
+    def get_feedname(self, feed_type="p"):
+        return Person.feedname_for_id(self.id, feed_type)
+
+    @staticmethod
+    def feedname_for_id(person_id, feed_type="p"):
+        if feed_type not in ("p", "pv", "ps"): raise ValueError(feed_type)
+        return "%s:%d" % (feed_type, person_id)
 
     @staticmethod
     def from_feed(feed):
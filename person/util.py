@@ -52,3 +52,55 @@ def load_roles_at_date(persons, when, congress):
     for person in persons:
         person.role = roles_by_person.get(person.id)
     return None 
+
+
+class RoleDateIndex(object):
+    """
+    An in-memory index of roles by person for looking up the roles of
+    many people on many dates without a query per date.
+
+    role_at_date returns the same role that load_roles_at_date would
+    assign to person.role. Only roles that overlap the given congress
+    are loaded, or all roles if congress is None.
+    """
+
+    def __init__(self, congress=None, role_types=(RoleType.representative, RoleType.senator, RoleType.vicepresident)):
+        roles = PersonRole.objects.filter(role_type__in=role_types).order_by('id')
+        if congress:
+            from us import get_congress_dates
+            startdate, enddate = get_congress_dates(int(congress))
+            roles = roles.filter(startdate__lte=enddate, enddate__gte=startdate)
+
+        self.roles_by_person = {}
+        self.vice_presidents = []
+        for role in roles:
+            # Cache the congress numbers, which is slow-ish to compute.
+            role.congress_numbers_cached = role.congress_numbers()
+            if role.role_type == RoleType.vicepresident:
+                self.vice_presidents.append(role)
+            else:
+                self.roles_by_person.setdefault(role.person_id, []).append(role)
+
+    def role_at_date(self, person_id, when, congress):
+        if hasattr(when, 'date'): when = when.date()
+        ret = None
+        for role in self.roles_by_person.get(person_id, []):
+            if role.startdate <= when <= role.enddate:
+                if role.congress_numbers_cached is not None and congress not in role.congress_numbers_cached: continue
+                ret = role # the last match wins, like load_roles_at_date
+        return ret
+
+    def load_roles_at_date(self, persons, when, congress):
+        # Same as load_roles_at_date above, for a single date, but without
+        # any queries.
+        for person in persons:
+            person.role = self.role_at_date(person.id, when, congress)
+
+    def vice_president_at_date(self, when):
+        # Like PersonRole.objects.get(role_type=RoleType.vicepresident, ...)
+        # for the date, raising DoesNotExist/MultipleObjectsReturned.
+        if hasattr(when, 'date'): when = when.date()
+        roles = [role for role in self.vice_presidents if role.startdate <= when <= role.enddate]
+        if len(roles) == 0: raise PersonRole.DoesNotExist()
+        if len(roles) > 1: raise PersonRole.MultipleObjectsReturned()
+        return roles[0]
@@ -865,8 +865,10 @@ def lookup_district(request):
         district_features["query"] = lng_lat # if was a geocode request
     return district_features
 
-def create_district_lookup_service():
+def create_district_lookup_service(cache_size=256):
     import math
+    import collections
+    import threading
     import gzip
     import urllib.request
     from pmtiles.reader import Reader, MmapSource
@@ -883,15 +885,23 @@ def create_district_lookup_service():
             return resp.read()
 
     class PmtilesLookup:
-        def __init__(self, filename, zoomlevel):
+        # Looks up the features containing points. The archive is opened once,
+        # and decoded tiles are kept in an LRU cache along with an STRtree of
+        # their prepared polygons, so repeated lookups in the same area only
+        # do the point-in-polygon tests.
+
+        def __init__(self, filename, zoomlevel, cache_size=256):
             if not filename.lower().startswith("https://"):
-                with open(filename, "r+b") as f:
-                    source = MmapSource(f)
+                self.file = open(filename, "r+b") # kept open for the life of the mmap
+                source = MmapSource(self.file)
             else:
                 source = PmtilesWebSource(filename)
             self.reader = Reader(source)
             self.header = self.reader.header()
             self.zoomlevel = zoomlevel
+            self.cache_size = cache_size
+            self.tiles = collections.OrderedDict()
+            self.lock = threading.Lock()
 
         @staticmethod
         def lnglat_to_tile(zoom, lon, lat):
@@ -904,46 +914,85 @@ def create_district_lookup_service():
             y = math.modf((1-math.log(math.tan(lat*math.pi/180) + 1/math.cos(lat*math.pi/180))/math.pi)/2 *math.pow(2,zoom))
             return ((int(x[1]), x[0]), (int(y[1]), y[0]))
 
-        def get_tile(self, lng, lat):
-            (x, tilex), (y, tiley) = self.lnglat_to_tile(self.zoomlevel, lng, lat)
+        def get_tile(self, x, y):
+            # Returns the decoded tile as (STRtree of its polygons, the
+            # feature properties of each polygon), or None if there is no
+            # tile here.
+            with self.lock:
+                if (x, y) in self.tiles:
+                    self.tiles.move_to_end((x, y))
+                    return self.tiles[(x, y)]
+            tile = self.load_tile(x, y)
+            if self.cache_size > 0:
+                with self.lock:
+                    self.tiles[(x, y)] = tile
+                    while len(self.tiles) > self.cache_size:
+                        self.tiles.popitem(last=False)
+            return tile
+
+        def load_tile(self, x, y):
             tile = self.reader.get(self.zoomlevel, x, y)
+            if tile is None: return None
             if self.header["tile_compression"] == Compression.GZIP:
                 tile = gzip.decompress(tile)
             features = mapbox_vector_tile.decode(tile, default_options={ "y_coord_down": True })
-            return (features, tilex, tiley)
-
-        def intersect_features(self, features, tilex, tiley):
-            if not 'layer' in features: return
+            if not 'layer' in features: return None
             layer = features['layer']
             extent = layer['extent']
-            if not 'features' in layer: return
+            if not 'features' in layer: return None
+
+            # Make a polygon for each part of each feature, in feature order,
+            # in the tile's coordinate space (0-1).
+            polygons = []
+            properties = []
             for feature in layer['features']:
                 geometry = feature['geometry']
-                #print(geometry['type'], feature['properties']['title_short'])
                 if geometry['type'] == 'Polygon':
                     geometry = [geometry['coordinates']]
                 elif geometry['type'] == 'MultiPolygon':
                     geometry = geometry['coordinates']
                 else:
                     continue
-                geometry = [
-                    [ [(ptx / extent, pty / extent) for (ptx, pty) in ring]
-                     for ring in poly ]
-                    for poly in geometry ]
                 for poly in geometry:
-                    if shapely.Polygon(poly[0], poly[1:]).contains(shapely.Point((tilex, tiley))):
-                        #print("", "matched")
-                        yield feature
-                        break # no need to match other polygons within this MultiPolygon
+                    poly = [ [(ptx / extent, pty / extent) for (ptx, pty) in ring]
+                             for ring in poly ]
+                    polygons.append(shapely.Polygon(poly[0], poly[1:]))
+                    properties.append(feature['properties'])
+            if not polygons: return None
+            shapely.prepare(polygons)
+            return (shapely.STRtree(polygons), properties)
+
+        def lookup(self, points):
+            # Returns the properties of the first feature containing each
+            # (lng, lat) point, or None for points not in any feature.
+            results = [None] * len(points)
+
+            # Group the points by tile.
+            by_tile = { }
+            for i, (lng, lat) in enumerate(points):
+                (x, tilex), (y, tiley) = self.lnglat_to_tile(self.zoomlevel, lng, lat)
+                by_tile.setdefault((x, y), []).append((i, tilex, tiley))
+
+            for (x, y), tile_points in by_tile.items():
+                tile = self.get_tile(x, y)
+                if tile is None: continue
+                tree, properties = tile
+                query_points = shapely.points([(tilex, tiley) for i, tilex, tiley in tile_points])
+                matches = { }
+                for point_index, polygon_index in zip(*tree.query(query_points, predicate="within")):
+                    # Take the first feature in the tile that matches.
+                    if point_index not in matches or polygon_index < matches[point_index]:
+                        matches[point_index] = polygon_index
+                for point_index, polygon_index in matches.items():
+                    results[tile_points[point_index][0]] = properties[polygon_index]
+            return results
 
         def __call__(self, lng, lat):
-            (features, tilex, tiley) = self.get_tile(lng, lat)
-            for feature in self.intersect_features(features, tilex, tiley):
-                return feature['properties']
+            return self.lookup([(lng, lat)])[0]
 
     fname = settings.DISTRICT_PMTILES_FILE
     zoom = 12
-    pmtiles = PmtilesLookup(fname, zoom)
+    pmtiles = PmtilesLookup(fname, zoom, cache_size=cache_size)
 
     return pmtiles
 
@@ -76,13 +76,14 @@ if "committees" in sys.argv:
 	# Committee events.
 	os.system("cd %s; usc-run committee_meetings --docs=False --log=%s" % (settings.CONGRESS_PROJECT_PATH, log_level))
 	
-	# Load into db.
-	os.system("./parse.py -l ERROR committee")
-
-	# Generate historical XML, used by prognosis & session stats.
+	# Generate historical XML, used by prognosis & session stats. Do this before
+	# loading into the db, which refreshes stored bill prognoses.
 	os.system(". %s/congress-legislators/scripts/.env/bin/activate; python committee/archive_committee_membership.py %s/congress-legislators/ data/historical-committee-membership/%s.xml"
 		% (settings.CONGRESS_PROJECT_PATH, settings.CONGRESS_PROJECT_PATH, CONGRESS))
 
+	# Load into db.
+	os.system("./parse.py -l ERROR committee")
+
 	# Save a fixture.
 	os.system("./manage.py dumpdata --format json committee.Committee committee.CommitteeMember > data/db/django-fixture-committees.json")
 
@@ -100,12 +101,22 @@ if "text" in sys.argv:
 	os.system("cd %s; usc-run govinfo --collections=CRPT --extract=mods --years=%s --log=%s" % (settings.CONGRESS_PROJECT_PATH,
 		",".join(str(datetime.datetime.now().year + d) for d in (-1, 0)), log_level))
 
+	# Update the index of text version metadata for bills with new text.
+	os.system("./manage.py update_bill_text_versions_index --congress=%d" % CONGRESS)
+
+	# Pre-render the HTML of new text versions so that the first page view
+	# of a large bill doesn't have to.
+	os.system("./manage.py prerender_bill_text --congress=%d" % CONGRESS)
+
+	# And the page images used for bill thumbnails and social media cards.
+	os.system("./manage.py prerender_bill_text_images --congress=%d" % CONGRESS)
+
 	# Update text incorporation analysis for any new text versions.
 	os.system("analysis/text_incorporation.py analyze %d" % CONGRESS)
 	os.system("analysis/text_incorporation.py load %d" % CONGRESS)
 
 	# Clear old bill text PDF thumbnail images. They'll be regenerated on the fly if a user visits a page that needs it.
-	find_cmd = """find congress/ -mtime +90 \( -name "document-_text_image*.png" -or -name "document-card*.png" -or -name "document-thumbnail*.png" \)  -print0"""
+	find_cmd = """find data/misc/bill-text-images -mtime +90 -name "*.png" -print0"""
 	#os.system(find_cmd + """ | du --files0-from=- -hc | tail -n1""") # show total size on disk that would be reclaimed
 	#os.system(find_cmd + """ | xargs -0 rm""")
 
@@ -20,7 +20,7 @@ def build_haystack_index(model):
 			return model.objects.prefetch_related(*self.prefetch_related_list)
 			
 	I.__name__ = model.__name__
-	I.prefetch_related_list = []
+	I.prefetch_related_list = list(getattr(model, "haystack_prefetch_related", []))
 			
 	fieldmap = dict( (f.name, f) for f in model._meta.get_fields() )
 	
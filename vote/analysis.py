@@ -88,3 +88,62 @@ def logistic_regression_fit_best_model(X, Y):
   return last_fit_model
 
 
+ideology_scores = { }
+
+def load_ideology_scores(congress):
+  global ideology_scores
+  if congress in ideology_scores: return
+  from numpy import median
+  import csv
+  ideology_scores[congress] = { }
+  for ch in ('h', 's'):
+    try:
+      scores_by_party = { }
+      for ideolog in csv.reader(open("data/analysis/by-congress/%d/sponsorshipanalysis_%s.txt" % (congress, ch))):
+        if ideolog[0] == "ID": continue # header row
+        if float(ideolog[2]) <  .1: continue # very low leadership score, ideology is not reliable
+        ideology_scores[congress][int(ideolog[0])] = float(ideolog[1])
+        scores_by_party.setdefault(ideolog[4].strip(), []).append(float(ideolog[1]))
+      ideology_scores[congress]["MEDIAN"] = median(list(ideology_scores[congress].values()))
+      for party in scores_by_party:
+        ideology_scores[congress]["MEDIAN:"+party] = median(scores_by_party[party])
+    except IOError:
+      ideology_scores[congress] = None
+
+def attach_ideology_scores(voters, congress):
+  global ideology_scores
+  has_ideology_scores = False
+  load_ideology_scores(congress)
+  if ideology_scores[congress]:
+    for voter in voters:
+      if voter.person and voter.person.id in ideology_scores[congress]:
+        voter.ideolog_score = ideology_scores[congress][voter.person.id]
+        has_ideology_scores = True
+      else:
+        voter.ideolog_score = \
+          ideology_scores[congress].get("MEDIAN:" + (voter.person_role.party if voter.person and voter.person_role else ""),
+            ideology_scores[congress]["MEDIAN"])
+  return has_ideology_scores
+
+def get_vote_outliers(voters):
+  # Run a really simple statistical model to see which voters don't
+  # match predicted outcomes.
+
+  party_values = { "Democrat": -1, "Republican": 1 }
+  vote_values = { "+": 1, "-": 0 }
+  x = [ ]
+  y = [ ]
+  for voter in voters:
+    x.append({
+      "intercept": 1,
+      "party": party_values.get(voter.party, 0), # independents and unrecognized parties get 0
+      "ideology": getattr(voter, 'ideolog_score', 0), # ideology scores may not be available in a Congress, also not available for vice president
+    })
+    y.append(vote_values.get(voter.option.key, .5)) # present, not voting, etc => .5
+
+  # Perform regression.
+  model = logistic_regression_fit_best_model(x, y)
+
+  # Mark voters whose vote is far from the prediction.
+  for i, v in enumerate(voters):
+    v.is_outlier = (abs(model['fittedvalues'][i]['resid']) > .7) if model else False
@@ -0,0 +1,108 @@
+# An on-disk store of the rendered vote images (the seating diagram, the
+# district map, and the thumbnails made from them) so that page views don't
+# render them. Images are rendered in bulk by the vote parser when votes
+# change and by "manage.py prerender_vote_images".
+#
+# Each image file is named by a hash of the vote id, the image type, and a
+# hash of the vote's totals, so a vote re-parsed with different results
+# gets new files. A small JSON index per vote records which images exist
+# for the totals they were rendered from, which answers whether a vote has
+# a diagram without rendering it.
+
+import hashlib, json, os
+
+IMAGE_STORE_PATH = "data/vote-images"
+IMAGE_TYPES = ("map", "diagram", "thumbnail", "card")
+IMAGE_VERSION = 1 # increment when the renderers change to invalidate stored images
+
+def get_totals_hash(vote):
+    return hashlib.sha1(json.dumps([
+        IMAGE_VERSION,
+        vote.question,
+        vote.result,
+        vote.total_plus,
+        vote.total_minus,
+        vote.total_other,
+        vote.majority_party_percent_plus,
+        vote.party_uniformity,
+    ]).encode("utf8")).hexdigest()
+
+def get_index_path(vote_id):
+    return os.path.join(IMAGE_STORE_PATH, "index", "%d.json" % vote_id)
+
+def get_image_path(key):
+    return os.path.join(IMAGE_STORE_PATH, key[0:2], key)
+
+def write_file_atomic(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+def load_index(vote):
+    # Returns the index of the vote's stored images, or None if the images
+    # haven't been rendered for the vote's current totals.
+    try:
+        with open(get_index_path(vote.id)) as f:
+            index = json.load(f)
+    except (IOError, ValueError):
+        return None
+    if index.get("totals") != get_totals_hash(vote):
+        return None
+    return index
+
+def has_image(index, image_type):
+    return index is not None and index["images"].get(image_type) is not None
+
+def get_image(vote, image_type):
+    # Returns (body, mime_type) for a stored image, or None if the vote
+    # doesn't have that image or it hasn't been rendered yet.
+    index = load_index(vote)
+    if not has_image(index, image_type):
+        return None
+    key, mime_type = index["images"][image_type]
+    try:
+        with open(get_image_path(key), "rb") as f:
+            return (f.read(), mime_type)
+    except IOError:
+        return None
+
+def render_images(vote, force=False):
+    # Render and store all of the images for the vote unless they're already
+    # stored for its current totals. Returns the vote's index.
+    from django.http import Http404
+    from vote.views import render_vote_image
+
+    index = load_index(vote)
+    if index is not None and not force:
+        return index
+
+    totals_hash = get_totals_hash(vote)
+    images = { }
+    for image_type in IMAGE_TYPES:
+        try:
+            body, mime_type = render_vote_image(vote, image_type)
+        except Http404:
+            images[image_type] = None # vote doesn't have this sort of image
+            continue
+        key = hashlib.sha1(("%d:%s:%s" % (vote.id, image_type, totals_hash)).encode("ascii")).hexdigest()
+        write_file_atomic(get_image_path(key), body)
+        images[image_type] = (key, mime_type)
+
+    # Write the new index, then remove the images the old one pointed to.
+    try:
+        with open(get_index_path(vote.id)) as f:
+            old_images = json.load(f)["images"]
+    except (IOError, ValueError, KeyError):
+        old_images = { }
+    index = { "totals": totals_hash, "images": images }
+    write_file_atomic(get_index_path(vote.id), json.dumps(index).encode("utf8"))
+    for image_type, image in old_images.items():
+        if image and image != list(images.get(image_type) or []):
+            try:
+                os.unlink(get_image_path(image[0]))
+            except OSError:
+                pass
+
+    return index
@@ -0,0 +1,48 @@
+from django.core.management.base import BaseCommand
+from django.test import RequestFactory
+
+import time
+
+from vote.models import Vote, CongressChamber
+from vote.views import vote_details
+
+class Command(BaseCommand):
+	help = 'Times rendering vote pages with the stored analytics vs. computing them on each render.'
+
+	def add_arguments(self, parser):
+		parser.add_argument('--count', type=int, default=20, help='number of recent votes with stored analytics to render')
+		parser.add_argument('--repeat', type=int, default=3, help='number of renders per vote to average over')
+
+	def handle(self, *args, **options):
+		votes = [vote for vote in Vote.objects.exclude(analytics=None).order_by("-created")[0:options["count"]*5]
+			if vote.get_stored_analytics()][0:options["count"]]
+		if not votes:
+			print("No votes have stored analytics. Run: parse.py vote -m update_analytics")
+			return
+
+		def render(vote):
+			request = RequestFactory().get(vote.get_absolute_url())
+			chamber_code = 'h' if vote.chamber == CongressChamber.house else 's'
+			start = time.time()
+			for i in range(options["repeat"]):
+				vote_details(request, vote.congress, vote.session, chamber_code, vote.number)
+			return (time.time() - start) / options["repeat"]
+
+		# Render once first so that per-process caches (ideology scores,
+		# caucus membership) don't count against either case.
+		render(votes[0])
+
+		stored = [render(vote) for vote in votes]
+
+		# Computing on each render is what happens when the stored analytics
+		# are from another version of the analysis.
+		version = Vote.ANALYTICS_VERSION
+		Vote.ANALYTICS_VERSION = None
+		try:
+			computed = [render(vote) for vote in votes]
+		finally:
+			Vote.ANALYTICS_VERSION = version
+
+		for vote, a, b in zip(votes, computed, stored):
+			print("%-40s computed %8.1f ms, stored %8.1f ms" % (vote, a*1000, b*1000))
+		print("%d votes: computed %.1f ms, stored %.1f ms on average" % (len(votes), sum(computed)/len(votes)*1000, sum(stored)/len(votes)*1000))
@@ -0,0 +1,52 @@
+from django.core.management.base import BaseCommand
+from django.conf import settings
+
+import time
+
+from vote.models import Vote, CongressChamber
+from vote.views import get_vote_matrix
+from vote import matrix_store
+
+class Command(BaseCommand):
+	help = 'Times building a vote comparison table from the vote matrix store vs. querying the voters of each vote.'
+
+	def add_arguments(self, parser):
+		parser.add_argument('--congress', type=int, default=settings.CURRENT_CONGRESS, help='Congress to take House votes from')
+		parser.add_argument('--count', type=int, default=100, help='number of recent votes in the table')
+		parser.add_argument('--repeat', type=int, default=3, help='number of times to build the table to average over')
+
+	def handle(self, *args, **options):
+		matrix = matrix_store.load_matrix(options["congress"], CongressChamber.house)
+		if matrix is None:
+			print("The vote matrix store hasn't been built. Run: ./manage.py update_vote_matrix --congress %d" % options["congress"])
+			return
+		vote_ids = [vote.id for vote in Vote.objects.filter(congress=options["congress"], chamber=CongressChamber.house).order_by("-created")
+			if matrix_store.get_stored_row(matrix, vote) is not None][0:options["count"]]
+
+		def build(use_store):
+			# Use new Vote instances each time because they cache their totals.
+			elapsed = 0
+			for i in range(options["repeat"]):
+				votes = list(Vote.objects.filter(id__in=vote_ids).order_by("created"))
+				start = time.time()
+				result = get_vote_matrix(votes, use_store=use_store)
+				elapsed += time.time() - start
+			return result, elapsed / options["repeat"]
+
+		def summarize(result):
+			votes, party_totals, voters = result
+			return (
+				[(pt["party"], pt["total_votes"], pt["votes"]) for pt in party_totals],
+				[(v["person"].id, v["person_name"], v.get("party"), v.get("state_district"), v["total_plus"], v["total_votes"],
+				  [(x.option_id, x.person_role_id, x.party, x.person_name) if x else None for x in v["votes"]])
+				 for v in voters],
+			)
+
+		# Build once first so that per-process caches don't count against either case.
+		build(True)
+
+		queried, queried_time = build(False)
+		stored, stored_time = build(True)
+		print("%d votes x %d voters: queried %.1f ms, stored %.1f ms" % (len(vote_ids), len(stored[2]), queried_time*1000, stored_time*1000))
+		if summarize(queried) != summarize(stored):
+			print("The tables are different!")
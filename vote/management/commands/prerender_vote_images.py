@@ -0,0 +1,42 @@
+from django.core.management.base import BaseCommand
+
+from vote.models import Vote
+from vote import image_store
+from parser.vote_parser import run_vote_workers
+
+class Command(BaseCommand):
+	help = 'Renders vote diagrams, maps and thumbnails into the vote image store for votes that need them.'
+
+	def add_arguments(self, parser):
+		parser.add_argument('--congress', type=int, help='only votes in this Congress')
+		parser.add_argument('--workers', type=int, default=1, help='number of worker processes to render with')
+		parser.add_argument('--force', action='store_true', help='re-render images that are already stored')
+		parser.add_argument('--check', type=int, metavar='VOTE_ID', help='render each type of image for this vote without storing them, to check that the renderers work')
+
+	def handle(self, *args, **options):
+		if options["check"]:
+			self.check_renderers(Vote.objects.get(id=options["check"]))
+			return
+
+		votes = Vote.objects.order_by("-created")
+		if options["congress"]:
+			votes = votes.filter(congress=options["congress"])
+
+		# The index check only reads a small file per vote.
+		vote_ids = [vote.id for vote in votes if options["force"] or image_store.load_index(vote) is None]
+		print("Rendering images for", len(vote_ids), "votes.")
+
+		def render(vote):
+			image_store.render_images(vote, force=options["force"])
+		run_vote_workers(vote_ids, options["workers"], render)
+
+	def check_renderers(self, vote):
+		from django.http import Http404
+		from vote.views import render_vote_image
+		for image_type in image_store.IMAGE_TYPES:
+			try:
+				body, mime_type = render_vote_image(vote, image_type)
+			except Http404:
+				print(image_type, "not available for this vote")
+				continue
+			print(image_type, mime_type, len(body), "bytes")
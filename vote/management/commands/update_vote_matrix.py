@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+from django.conf import settings
+
+from vote.models import CongressChamber
+from vote import matrix_store
+
+class Command(BaseCommand):
+	help = 'Rebuilds the vote matrix store, which the vote parser otherwise updates as votes change.'
+
+	def add_arguments(self, parser):
+		parser.add_argument('--congress', type=int, action='append', help='Congress to rebuild (may be repeated, defaults to the current Congress)')
+
+	def handle(self, *args, **options):
+		for congress in (options["congress"] or [settings.CURRENT_CONGRESS]):
+			for chamber in (CongressChamber.house, CongressChamber.senate):
+				count = matrix_store.update_matrix(congress, chamber)
+				print(congress, CongressChamber.by_value(chamber).label, count, "votes")
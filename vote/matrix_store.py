@@ -0,0 +1,250 @@
+# A columnar store of how everyone voted on every roll call vote, so that
+# vote comparison tables and the analysis scripts can slice a matrix rather
+# than querying for the Voter records of each vote one vote at a time.
+#
+# There is one compressed numpy file per Congress and chamber holding:
+#
+#   vote_ids     (votes)           the Vote ids of the rows
+#   totals       (votes, 3)        total_plus, total_minus, total_other of each
+#                                  vote when it was stored, to tell if a row is stale
+#   person_ids   (people)          the Person ids of the columns
+#   options      (votes, people)   int8 option codes: 0 if the person wasn't
+#                                  a voter, then OPTION_CODES for the usual
+#                                  options and 5 and up for any others
+#   option_ids   (votes, codes)    the VoteOption id for each code (0 if unused)
+#   role_ids     (votes, people)   the PersonRole id of the voter (0 if none)
+#   voter_types  (votes, people)   the VoterType of the voter
+#
+# The vote parser updates the rows of the votes that it loads. Votes that
+# had voters that couldn't be matched to a person aren't stored, and callers
+# fall back to the database for them.
+
+import os
+
+import numpy
+
+MATRIX_STORE_PATH = "data/vote-matrix"
+OPTION_CODES = { "+": 1, "-": 2, "P": 3, "0": 4 }
+MAX_OPTION_CODE = 127 # int8
+
+def get_matrix_path(congress, chamber):
+    from vote.models import CongressChamber
+    return os.path.join(MATRIX_STORE_PATH, "%d-%s.npz" % (congress, "s" if chamber == CongressChamber.senate else "h"))
+
+_matrix_cache = { }
+def load_matrix(congress, chamber):
+    # Returns a dict of the arrays of the store for the Congress and chamber,
+    # plus vote_index and person_index mapping ids to rows and columns, or
+    # None if the store hasn't been built. Cached until the file changes.
+    path = get_matrix_path(congress, chamber)
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+    cached = _matrix_cache.get(path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    with numpy.load(path) as f:
+        matrix = { key: f[key] for key in f.files }
+    matrix["vote_index"] = { vote_id: i for i, vote_id in enumerate(matrix["vote_ids"].tolist()) }
+    matrix["person_index"] = { person_id: j for j, person_id in enumerate(matrix["person_ids"].tolist()) }
+    _matrix_cache[path] = (mtime, matrix)
+    return matrix
+
+def save_matrix(path, arrays):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp_path, "wb") as f:
+        numpy.savez_compressed(f, **arrays)
+    os.replace(tmp_path, path)
+
+def fetch_vote_rows(vote_ids):
+    # Query the voters of the votes in bulk and return a dict from Vote id
+    # to (totals, option ids by code, { person id: (code, role id, voter type) }),
+    # leaving out votes with voters that aren't matched to a person.
+    from vote.models import Vote, VoteOption, Voter
+    rows = { }
+    for i in range(0, len(vote_ids), 500):
+        batch = vote_ids[i:i+500]
+        codes = { }
+        for vote_id, total_plus, total_minus, total_other in Vote.objects.filter(id__in=batch).values_list("id", "total_plus", "total_minus", "total_other"):
+            rows[vote_id] = ((total_plus, total_minus, total_other), { }, { })
+            codes[vote_id] = { }
+        for vote_id, option_id, key in VoteOption.objects.filter(vote__in=batch).order_by("id").values_list("vote", "id", "key"):
+            option_codes = codes[vote_id]
+            code = OPTION_CODES.get(key)
+            if code is None or code in rows[vote_id][1]: # other options, or duplicate options
+                code = max(list(option_codes.values()) + [len(OPTION_CODES)]) + 1
+            if code > MAX_OPTION_CODE: raise ValueError("Vote %d has too many options." % vote_id)
+            option_codes[option_id] = code
+            rows[vote_id][1][code] = option_id
+        for vote_id, person_id, role_id, voter_type, option_id in Voter.objects.filter(vote__in=batch).values_list("vote", "person", "person_role", "voter_type", "option"):
+            if vote_id not in rows: continue
+            if person_id is None:
+                del rows[vote_id]
+                continue
+            rows[vote_id][2][person_id] = (codes[vote_id][option_id], role_id or 0, voter_type)
+    return rows
+
+def update_matrix(congress, chamber, changed_vote_ids=None):
+    # Re-fetch the rows of the changed votes, or of all votes if None, keep
+    # the other rows that are already stored, and drop votes that no longer
+    # exist. Returns the number of votes stored.
+    from vote.models import Vote
+    vote_ids = list(Vote.objects.filter(congress=congress, chamber=chamber).order_by("id").values_list("id", flat=True))
+
+    existing = load_matrix(congress, chamber) if changed_vote_ids is not None else None
+    if existing is None:
+        changed_vote_ids = vote_ids
+    changed_vote_ids = set(changed_vote_ids) & set(vote_ids)
+    new_rows = fetch_vote_rows(sorted(changed_vote_ids))
+
+    # Which votes and people have rows and columns?
+    kept = [vote_id for vote_id in vote_ids
+        if vote_id not in changed_vote_ids and existing and vote_id in existing["vote_index"]]
+    stored_vote_ids = sorted(kept + list(new_rows))
+    person_ids = set()
+    if kept:
+        kept_rows = [existing["vote_index"][vote_id] for vote_id in kept]
+        has_vote = (existing["options"][kept_rows, :] != 0).any(axis=0)
+        person_ids |= set(existing["person_ids"][has_vote].tolist())
+    for totals, option_ids, voters in new_rows.values():
+        person_ids |= set(voters)
+    person_ids = sorted(person_ids)
+    person_index = { person_id: j for j, person_id in enumerate(person_ids) }
+    num_codes = max([len(OPTION_CODES)]
+        + ([existing["option_ids"].shape[1]] if kept else [])
+        + [max(option_ids, default=0) for totals, option_ids, voters in new_rows.values()])
+
+    arrays = {
+        "vote_ids": numpy.array(stored_vote_ids, dtype=numpy.int64),
+        "totals": numpy.zeros((len(stored_vote_ids), 3), dtype=numpy.int32),
+        "person_ids": numpy.array(person_ids, dtype=numpy.int64),
+        "options": numpy.zeros((len(stored_vote_ids), len(person_ids)), dtype=numpy.int8),
+        "option_ids": numpy.zeros((len(stored_vote_ids), num_codes), dtype=numpy.int64),
+        "role_ids": numpy.zeros((len(stored_vote_ids), len(person_ids)), dtype=numpy.int32),
+        "voter_types": numpy.zeros((len(stored_vote_ids), len(person_ids)), dtype=numpy.int8),
+    }
+
+    # Copy the kept rows over, moving the columns of the people that are
+    # still present to their new positions.
+    if kept:
+        old_person_ids = existing["person_ids"].tolist()
+        old_columns = [j for j, person_id in enumerate(old_person_ids) if person_id in person_index]
+        new_columns = [person_index[old_person_ids[j]] for j in old_columns]
+        new_row_index = { vote_id: i for i, vote_id in enumerate(stored_vote_ids) }
+        rows = [new_row_index[vote_id] for vote_id in kept]
+        for key in ("options", "role_ids", "voter_types"):
+            arrays[key][numpy.ix_(rows, new_columns)] = existing[key][numpy.ix_(kept_rows, old_columns)]
+        arrays["totals"][rows] = existing["totals"][kept_rows]
+        arrays["option_ids"][rows, 0:existing["option_ids"].shape[1]] = existing["option_ids"][kept_rows]
+
+    # Fill in the rows of the changed votes.
+    for i, vote_id in enumerate(stored_vote_ids):
+        if vote_id not in new_rows: continue
+        totals, option_ids, voters = new_rows[vote_id]
+        arrays["totals"][i] = totals
+        for code, option_id in option_ids.items():
+            arrays["option_ids"][i, code-1] = option_id
+        for person_id, (code, role_id, voter_type) in voters.items():
+            j = person_index[person_id]
+            arrays["options"][i, j] = code
+            arrays["role_ids"][i, j] = role_id
+            arrays["voter_types"][i, j] = voter_type
+
+    save_matrix(get_matrix_path(congress, chamber), arrays)
+    return len(stored_vote_ids)
+
+def update_votes(vote_ids):
+    # Update the stores for the Congresses and chambers of the given votes.
+    from vote.models import Vote
+    changed = { }
+    for i in range(0, len(vote_ids), 500):
+        for vote_id, congress, chamber in Vote.objects.filter(id__in=vote_ids[i:i+500]).values_list("id", "congress", "chamber"):
+            changed.setdefault((congress, chamber), []).append(vote_id)
+    for (congress, chamber), ids in sorted(changed.items()):
+        update_matrix(congress, chamber, ids)
+
+def get_stored_row(matrix, vote):
+    # Returns the row of the vote in the matrix, or None if it isn't stored
+    # or was stored with different totals.
+    if matrix is None: return None
+    i = matrix["vote_index"].get(vote.id)
+    if i is None: return None
+    if matrix["totals"][i].tolist() != [vote.total_plus, vote.total_minus, vote.total_other]: return None
+    return i
+
+def get_stored_voters(votes):
+    # Returns a dict from Vote id to a tuple of a list of (unsaved) Voter
+    # instances with the person, role, and option attached and a list of the
+    # vote's options, for the given votes that are up to date in the store.
+    # The Person and PersonRole instances aren't shared between votes, like
+    # the ones from the database, since callers attach vote-specific
+    # information to them.
+    import copy
+    from person.models import Person, PersonRole
+    from vote.models import VoteOption, Voter
+
+    cells = { }
+    for vote in votes:
+        matrix = load_matrix(vote.congress, vote.chamber)
+        i = get_stored_row(matrix, vote)
+        if i is None: continue
+        columns = numpy.nonzero(matrix["options"][i])[0]
+        cells[vote.id] = (vote, list(zip(
+            matrix["person_ids"][columns].tolist(),
+            matrix["options"][i, columns].tolist(),
+            matrix["role_ids"][i, columns].tolist(),
+            matrix["voter_types"][i, columns].tolist(),
+        )), matrix["option_ids"][i].tolist())
+
+    people = Person.objects.in_bulk({ person_id for vote, voters, option_ids in cells.values() for person_id, code, role_id, voter_type in voters })
+    roles = PersonRole.objects.in_bulk({ role_id for vote, voters, option_ids in cells.values() for person_id, code, role_id, voter_type in voters if role_id })
+    options = VoteOption.objects.in_bulk({ option_id for vote, voters, option_ids in cells.values() for option_id in option_ids if option_id })
+
+    ret = { }
+    for vote_id, (vote, voters, option_ids) in cells.items():
+        # If any records were deleted since the vote was stored, use the database.
+        if any(person_id not in people or (role_id and role_id not in roles) or option_ids[code-1] not in options
+               for person_id, code, role_id, voter_type in voters):
+            continue
+        ret[vote_id] = ([
+            Voter(
+                vote=vote,
+                person=copy.copy(people[person_id]),
+                person_role=copy.copy(roles[role_id]) if role_id else None,
+                option=options[option_ids[code-1]],
+                voter_type=voter_type,
+                created=vote.created,
+            )
+            for person_id, code, role_id, voter_type in voters
+        ], [options[option_id] for option_id in sorted(option_ids) if option_id in options])
+    return ret
+
+def iter_vote_voters(votes, chunk_size=100):
+    # Yields (vote, voters) for each of the votes, getting the voters from
+    # the store a chunk of votes at a time and from the database for votes
+    # that aren't up to date in the store.
+    votes = list(votes)
+    for i in range(0, len(votes), chunk_size):
+        chunk = votes[i:i+chunk_size]
+        stored_voters = get_stored_voters(chunk)
+        for vote in chunk:
+            if vote.id in stored_voters:
+                yield vote, vote.get_voters(voters=stored_voters[vote.id][0])
+            else:
+                yield vote, vote.get_voters()
+
+def get_person_votes(matrix, person_id, skip_options=()):
+    # Returns a dict from Vote id to VoteOption id for how the person voted
+    # on each vote in the matrix that they were a voter in, except votes where
+    # they chose an option whose key is in skip_options.
+    j = matrix["person_index"].get(person_id)
+    if j is None: return { }
+    rows = numpy.nonzero(matrix["options"][:, j])[0]
+    for key in skip_options:
+        rows = rows[matrix["options"][rows, j] != OPTION_CODES[key]]
+    codes = matrix["options"][rows, j].astype(numpy.int64)
+    return dict(zip(
+        matrix["vote_ids"][rows].tolist(),
+        matrix["option_ids"][rows, codes-1].tolist()))
@@ -0,0 +1,19 @@
+# Generated by Django 4.1.13 on 2026-10-18 12:00
+
+from django.db import migrations
+import jsonfield.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vote', '0004_auto_20241108_0741'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='vote',
+            name='analytics',
+            field=jsonfield.fields.JSONField(blank=True, help_text='Statistical analyses of the voters computed when the vote is loaded (outliers and the caucus feature analysis), see compute_analytics.', null=True),
+        ),
+    ]
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 import math
+from collections import Counter
 
 from django.db import models
 from django.db.models import Q, F
@@ -7,6 +8,7 @@ from django.urls import reverse
 from django.conf import settings
 
 from common import enum
+from jsonfield import JSONField
 
 from us import get_session_ordinal
 from bill.models import BillSummary
@@ -101,6 +103,7 @@ class Vote(models.Model):
     related_amendment = models.ForeignKey('bill.Amendment', related_name='votes', blank=True, null=True, help_text="A related amendment.", on_delete=models.PROTECT)
     missing_data = models.BooleanField(default=False, help_text="If something in the source could be parsed and we should revisit the file.")
     question_details = models.TextField(help_text="Additional descriptive text for what the vote was about.", blank=True, null=True)
+    analytics = JSONField(blank=True, null=True, help_text="Statistical analyses of the voters computed when the vote is loaded (outliers and the caucus feature analysis), see compute_analytics.")
     
     class Meta:
         # The ordering makes sure votes are in the right order on bill pages.
@@ -108,6 +111,9 @@ class Vote(models.Model):
         unique_together = (('congress', 'chamber', 'session', 'number'),)
 
     MAJOR_CATEGORIES = (VoteCategory.passage_suspension, VoteCategory.passage, VoteCategory.passage_part, VoteCategory.nomination, VoteCategory.ratification, VoteCategory.veto_override)
+
+    # Increment to have stored analytics recomputed (see compute_analytics).
+    ANALYTICS_VERSION = 1
         
     api_additional_fields = {
         "link": lambda obj : settings.SITE_ROOT_URL + obj.get_absolute_url(),
@@ -146,11 +152,21 @@ class Vote(models.Model):
                 return value
         return None
 
-    def calculate_totals(self):
+    def calculate_totals(self, voters=None, options=None):
+        # The parser already has the Voter and VoteOption records in memory
+        # and can pass them in so that we don't query for them again.
+        if voters is None: voters = self.get_voters()
+        if options is None: options = list(self.options.all())
+        option_keys = { option.id: option.key for option in options }
+
         # totals by yes/no/other
-        self.total_plus = self.voters.filter(option__key='+').count()
-        self.total_minus = self.voters.filter(option__key='-').count()
-        self.total_other = self.voters.count() - (self.total_plus + self.total_minus)
+        self.total_plus = 0
+        self.total_minus = 0
+        for voter in voters:
+            key = option_keys.get(voter.option_id)
+            if key == '+': self.total_plus += 1
+            elif key == '-': self.total_minus += 1
+        self.total_other = len(voters) - (self.total_plus + self.total_minus)
 
         # margin, percent of yes votes
         if self.total_plus + self.total_minus == 0:
@@ -160,7 +176,7 @@ class Vote(models.Model):
             self.percent_plus = self.total_plus/float(self.total_plus + self.total_minus + self.total_other)
             self.margin = abs(self.total_plus - self.total_minus) / float(self.total_plus + self.total_minus)
 
-        totals = self.totals(include_features=False)
+        totals = self.totals(include_features=False, voters=voters, options=options)
 
         if self.total_plus > 0:
             # how did the majority party vote?
@@ -185,13 +201,18 @@ class Vote(models.Model):
             raise ValueError("No regex matched for result {}.".format(self.result))
 
         # which option was the winner? some results match an option text exactly, like votes for Speaker
-        winning_option = self.options.filter(value=self.result).first()
+        options_by_key = { }
+        for option in options: options_by_key.setdefault(option.key, option)
+        def get_option(key):
+            if key not in options_by_key: raise VoteOption.DoesNotExist()
+            return options_by_key[key]
+        winning_option = ([option for option in options if option.value == self.result] + [None])[0]
         if self.required == "QUORUM":
             if self.result == "Passed":
-                winning_option = self.options.get(key="P")
+                winning_option = get_option("P")
             elif self.result == "Failed":
-                winning_option = self.options.get(key="0")
-        elif winning_option is None and self.passed is not None and self.options.filter(key__in=("+", "-")).exists():
+                winning_option = get_option("0")
+        elif winning_option is None and self.passed is not None and ("+" in options_by_key or "-" in options_by_key):
             # If there's no match and the vote has +/- options and we determined
             # the vote passed or failed, then a passed vote is + and a failed vote is -.
             # Some failed votes don't have a '-' option because everyone voted present,
@@ -200,20 +221,23 @@ class Vote(models.Model):
             # failed votes without '+' options, so we can't assume '+' exists, but only
             # if there is no '-'.
             if self.passed:
-                winning_option = self.options.get(key="+")
+                winning_option = get_option("+")
             else:
                 try:
-                    winning_option = self.options.get(key="-")
+                    winning_option = get_option("-")
                 except VoteOption.DoesNotExist:
-                    winning_option = self.options.create(key="-", value="No" if self.options.get(key="+").value == "Aye" else "Nay")
+                    winning_option = self.options.create(key="-", value="No" if get_option("+").value == "Aye" else "Nay")
+                    options.append(winning_option)
         if winning_option is not None and not winning_option.winner:
             # Winner is known. Set its winner field to true and the other options to false.
             self.options.update(winner=False)
+            for option in options: option.winner = False
             winning_option.winner = True
             winning_option.save()
         else:
             # No winner known.
             self.options.update(winner=None)
+            for option in options: option.winner = None
 
         self.save()
 
@@ -253,11 +277,16 @@ class Vote(models.Model):
     def has_time(self):
         return self.source != VoteSource.keithpoole
 
-    def get_voters(self, filter_people=None):
-        # Fetch from database.
-        voters = self.voters.all()
-        if filter_people: voters = voters.filter(person__in=filter_people)
-        ret = list(voters.select_related('person', 'person_role', 'option'))
+    def get_voters(self, filter_people=None, voters=None):
+        if voters is not None:
+            # Use the Voter records the caller already has.
+            ret = list(voters)
+            if filter_people: ret = [voter for voter in ret if voter.person in filter_people]
+        else:
+            # Fetch from database.
+            voters = self.voters.all()
+            if filter_people: voters = voters.filter(person__in=filter_people)
+            ret = list(voters.select_related('person', 'person_role', 'option'))
 
         # Add the exact party of the person at this time.
         for voter in ret:
@@ -271,22 +300,28 @@ class Vote(models.Model):
 
         return ret
        
-    def totals(self, include_features=True):
+    def totals(self, include_features=True, voters=None, options=None):
         # If cached value exists then return it
         if hasattr(self, '_cached_totals'):
             return self._cached_totals
         # else do all these things:
 
-        items = []
-
-        # Extract all voters.
-        all_voters = self.get_voters()
-        all_options = list(self.options.all())
-        voters_by_option = {}
-        for option in all_options:
-            voters_by_option[option] = [x for x in all_voters if x.option == option]
+        # Extract all voters, or use the ones passed in, and tally
+        # them by option and by party in one pass.
+        all_voters = self.get_voters(voters=voters)
+        all_options = list(options) if options is not None else list(self.options.all())
+        voters_by_option = { option.id: [] for option in all_options }
+        party_sizes = Counter()
+        total_count_voting = 0
+        party_is_caucus = False
+        for voter in all_voters:
+            voters_by_option.setdefault(voter.option_id, []).append(voter)
+            party_sizes[voter.party] += 1
+            if voter.option.key not in ("0", "P"):
+                total_count_voting += 1
+            if getattr(voter, "party_is_caucus", False):
+                party_is_caucus = True
         total_count = len(all_voters)
-        party_is_caucus = any(getattr(x, "party_is_caucus", False) for x in all_voters)
 
         # How many legislators count toward or against passage? For most votes, only ayes
         # and nays count toward a majority (i.e. present and not voting don't), or special
@@ -296,30 +331,32 @@ class Vote(models.Model):
         # that case and include present/not voting in the % breakdown.
         if self.required == "3/5" and "Cloture" in self.question: # best way to detect but perhaps imperfect
             total_count_voting = 0 # fall back to total body
-        else:
-            total_count_voting = len([x for x in all_voters if x.option.key not in ("0", "P")])
 
         # Find all parties which participated in vote
-        # and sort them in order which they should be displayed
-
-        def cmp_party(x):
-            """
-            Sort the parties by the number of voters in that party.
-            """
-            return -len([v for v in all_voters if v.party == x])
-        
-        all_parties = list(set(x.party for x in all_voters))
-        all_parties.sort(key=cmp_party)
+        # and sort them in order which they should be displayed,
+        # by the number of voters in that party.
+        all_parties = list(party_sizes)
+        all_parties.sort(key=lambda party : -party_sizes[party])
         total_party_stats = dict((x, {'yes': 0, 'no': 0, 'other': 0, 'total': 0})\
                                  for x in all_parties)
 
-        # Perform a statistical analysis using additional features.
-        feature_analysis = self.feature_analysis(all_voters) if include_features else None
+        # Perform a statistical analysis using additional features, or use the
+        # analysis stored when the vote was loaded.
+        feature_analysis = None
+        if include_features:
+            analytics = self.get_stored_analytics()
+            if analytics:
+                feature_analysis = analytics["features"] and {
+                    "featurelist": analytics["features"]["featurelist"],
+                    "featuremap": dict(analytics["features"]["featuremap"]),
+                }
+            else:
+                feature_analysis = self.feature_analysis(all_voters)
 
         # For each option find the count, the percent of voting members, and the party break down.
         details = []
         for option in all_options:
-            voters = voters_by_option.get(option, [])
+            voters = voters_by_option.get(option.id, [])
             if option.key in ("0", "P") and total_count_voting > 0:
                 # Present and not-voting are not counted toward passage so they
                 # are omitted from the percent, unless this is a quorum call and
@@ -334,7 +371,7 @@ class Vote(models.Model):
                 # idea for cloture votes, which require 3/5ths of senators sworn, i.e.
                 # not senators voting but all senators serving.
                 percent = int(round(len(voters) / float(total_count_voting or total_count) * 100.0))
-            party_stats = dict((x, 0) for x in all_parties)
+            party_stats = Counter()
             for voter in voters:
                 party = voter.party
                 party_stats[party] += 1
@@ -345,23 +382,29 @@ class Vote(models.Model):
                     total_party_stats[party]['no'] += 1
                 else:
                     total_party_stats[party]['other'] += 1
-            party_counts = [party_stats.get(x, 0) for x in all_parties]
-            party_counts = [{"party": all_parties[i], "count": c} for i, c in enumerate(party_counts)]
-                
-            detail = {'option': option, 'count': len(voters),
-                'percent': percent, 'party_counts': party_counts,
-                'feature_counts': [{
+            party_counts = [{"party": party, "count": party_stats[party]} for party in all_parties]
+
+            feature_counts = None
+            if feature_analysis and option.key in ("+", "-"):
+                by_feature = Counter()
+                by_feature_party = Counter()
+                for v in voters:
+                    for feature in set(feature_analysis["featuremap"].get(v.person.id, [])):
+                        by_feature[feature] += 1
+                        by_feature_party[(feature, v.party)] += 1
+                feature_counts = [{
                   'feature': feature,
-                  'count': len([v for v in voters
-                                if feature in feature_analysis["featuremap"].get(v.person.id, [])]),
+                  'count': by_feature[feature],
                   'by_party':
-                     [ {"party": party,
-                        "count": len([v for v in voters if v.party == party
-                                     and feature in feature_analysis["featuremap"].get(v.person.id, [])]) }
+                     [ {"party": party, "count": by_feature_party[(feature, party)] }
                         for party in all_parties ]
                    }
                    for feature in feature_analysis["featurelist"]
-                 ] if feature_analysis and option.key in ("+", "-") else None
+                 ]
+                
+            detail = {'option': option, 'count': len(voters),
+                'percent': percent, 'party_counts': party_counts,
+                'feature_counts': feature_counts,
                 }
             if option.key == '+':
                 detail['yes'] = True
@@ -467,6 +510,41 @@ class Vote(models.Model):
           "featuremap": featuremap
         }
 
+    def compute_analytics(self, voters=None):
+        # Run the statistical analyses shown on the vote page, which are too
+        # slow to run on each page load, and set self.analytics. Outliers are
+        # stored by person since bulk-created Voter records may not have ids.
+        from vote.analysis import attach_ideology_scores, get_vote_outliers
+        voters = self.get_voters(voters=voters)
+        attach_ideology_scores(voters, self.congress)
+        get_vote_outliers(voters)
+        features = self.feature_analysis(voters)
+        self.analytics = {
+            "version": Vote.ANALYTICS_VERSION,
+            "outliers": sorted(set(voter.person.id for voter in voters if voter.is_outlier and voter.person)),
+            "features": {
+                "featurelist": features["featurelist"],
+                "featuremap": sorted(features["featuremap"].items()), # JSON keys can't be ints
+            } if features else None,
+        }
+
+    def get_stored_analytics(self):
+        if self.analytics and self.analytics.get("version") == Vote.ANALYTICS_VERSION:
+            return self.analytics
+        return None
+
+    def mark_outliers(self, voters):
+        # Sets is_outlier on the voters, which must have ideology scores
+        # attached if the analytics weren't stored.
+        analytics = self.get_stored_analytics()
+        if not analytics:
+            from vote.analysis import get_vote_outliers
+            get_vote_outliers(voters)
+            return
+        outliers = set(analytics["outliers"])
+        for voter in voters:
+            voter.is_outlier = voter.person is not None and voter.person.id in outliers
+
     def summary(self):
         ret = self.result
         if self.total_plus + self.total_minus > 0: # not all votes have aye/no outcomes
@@ -494,11 +572,14 @@ class Vote(models.Model):
     def create_event(self):
         if self.congress < 111: return # not interested, creates too much useless data and slow to load
         from events.models import Feed, Event
+        from person.models import Person
         with Event.update(self) as E:
             E.add("vote", self.created, Vote.AllVotesFeed())
-            for v in self.voters.all():
-                if v.person_id:
-                    E.add("vote", self.created, v.person.get_feed("pv"))
+            feednames = [Person.feedname_for_id(person_id, "pv")
+                for person_id in self.voters.exclude(person=None).values_list("person_id", flat=True)]
+            Feed.prefetch(feednames)
+            for feedname in feednames:
+                E.add("vote", self.created, Feed.get_cached(feedname))
     
     def render_event(self, eventid, feeds):
         if feeds:
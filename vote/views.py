@@ -6,13 +6,13 @@ from datetime import datetime
 from django.http import HttpResponse, Http404, HttpResponseRedirect
 from django.shortcuts import get_object_or_404, render
 from django.urls import reverse
-from django.views.decorators.cache import cache_page
 
 from common.decorators import render_to
 
-from numpy import median
-
 from vote.models import Vote, CongressChamber, VoterType, VoteCategory, VoteSummary
+from vote.analysis import attach_ideology_scores, get_vote_outliers, load_ideology_scores
+from vote import analysis as vote_analysis
+from vote import image_store
 from vote.search import vote_search_manager
 from events.models import Feed
 from us import get_all_sessions
@@ -21,8 +21,6 @@ from twostream.decorators import anonymous_view, user_view_for
 
 from settings import CURRENT_CONGRESS
 
-ideology_scores = { }
-
 @anonymous_view
 def vote_list(request):
     # Get the default session to show. We may have sessions listed that are
@@ -67,15 +65,12 @@ def vote_details(request, congress, session, chamber_code, number):
       and vote.related_bill.votes.filter(chamber=vote.chamber, category__in=(VoteCategory.passage, VoteCategory.passage_suspension)).order_by('-created').first() != vote:
       has_subsequent_vote = True
     
-    # Test if we have diagrams for this vote. The only
-    # way to test is to try to make it.
+    # Test if we have diagrams for this vote in the image store, which
+    # are rendered when the vote is loaded.
+    image_index = image_store.load_index(vote)
     has_diagram = { }
     for image_type in ("map", "diagram"):
-        try:
-            vote_thumbnail_image(request, congress, session, chamber_code, number, image_type)
-            has_diagram[image_type] = True
-        except Http404:
-            has_diagram[image_type] = False
+        has_diagram[image_type] = image_store.has_image(image_index, image_type)
     
     # sorting by party actually sorts by party first and by ideology score
     # second.
@@ -88,8 +83,8 @@ def vote_details(request, congress, session, chamber_code, number):
     reconsiderers = vote.possible_reconsideration_votes(voters)
     reconsiderers_titles = "/".join(v.person_role.leadership_title for v in reconsiderers)
 
-    # compute statistical outliers (this marks the Voter instances with an is_outlier attribute)
-    get_vote_outliers(voters)
+    # mark statistical outliers (this sets an is_outlier attribute on the Voter instances)
+    vote.mark_outliers(voters)
 
     return {'vote': vote,
             'voters': voters,
@@ -132,64 +127,6 @@ def go_to_summary_admin(request):
     summary, is_new = VoteSummary.objects.get_or_create(vote=get_object_or_404(Vote, id=request.GET["vote"]))
     return HttpResponseRedirect("/admin/vote/votesummary/%d" % summary.id)
 
-def load_ideology_scores(congress):
-    global ideology_scores
-    if congress in ideology_scores: return
-    ideology_scores[congress] = { }
-    for ch in ('h', 's'):
-        try:
-            scores_by_party = { }
-            for ideolog in csv.reader(open("data/analysis/by-congress/%d/sponsorshipanalysis_%s.txt" % (congress, ch))):
-                if ideolog[0] == "ID": continue # header row
-                if float(ideolog[2]) <  .1: continue # very low leadership score, ideology is not reliable
-                ideology_scores[congress][int(ideolog[0])] = float(ideolog[1])
-                scores_by_party.setdefault(ideolog[4].strip(), []).append(float(ideolog[1]))
-            ideology_scores[congress]["MEDIAN"] = median(list(ideology_scores[congress].values()))
-            for party in scores_by_party:
-                ideology_scores[congress]["MEDIAN:"+party] = median(scores_by_party[party])
-        except IOError:
-            ideology_scores[congress] = None
-
-def attach_ideology_scores(voters, congress):
-    global ideology_scores
-    has_ideology_scores = False
-    load_ideology_scores(congress)
-    if ideology_scores[congress]:
-        for voter in voters:
-            if voter.person and voter.person.id in ideology_scores[congress]:
-                voter.ideolog_score = ideology_scores[congress][voter.person.id]
-                has_ideology_scores = True
-            else:
-                voter.ideolog_score = \
-            	ideology_scores[congress].get("MEDIAN:" + (voter.person_role.party if voter.person and voter.person_role else ""),
-            		ideology_scores[congress]["MEDIAN"])
-    return has_ideology_scores
-
-def get_vote_outliers(voters):
-	# Run a really simple statistical model to see which voters don't
-	# match predicted outcomes.
-
-	from vote.analysis import logistic_regression_fit_best_model
-
-	party_values = { "Democrat": -1, "Republican": 1 }
-	vote_values = { "+": 1, "-": 0 }
-	x = [ ]
-	y = [ ]
-	for voter in voters:
-		x.append({
-			"intercept": 1,
-			"party": party_values.get(voter.party, 0), # independents and unrecognized parties get 0
-			"ideology": getattr(voter, 'ideolog_score', 0), # ideology scores may not be available in a Congress, also not available for vice president
-		})
-		y.append(vote_values.get(voter.option.key, .5)) # present, not voting, etc => .5
-
-	# Perform regression.
-	model = logistic_regression_fit_best_model(x, y)
-
-	# Mark voters whose vote is far from the prediction.
-	for i, v in enumerate(voters):
-		v.is_outlier = (abs(model['fittedvalues'][i]['resid']) > .7) if model else False
-
 @anonymous_view
 def vote_export_csv(request, congress, session, chamber_code, number):
     vote = load_vote(congress, session, chamber_code, number)
@@ -225,9 +162,23 @@ def vote_get_json(request, congress, session, chamber_code, number):
     return HttpResponseRedirect("/api/v2/vote/%d" % vote.id)
     
 @anonymous_view
-@cache_page(60 * 60 * 6)
 def vote_thumbnail_image(request, congress, session, chamber_code, number, image_type):
 	vote = load_vote(congress, session, chamber_code, number)
+
+	# Images are served from the image store and are not rendered here.
+	image = image_store.get_image(vote, image_type)
+	if image is None:
+		raise Http404()
+	body, mime_type = image
+
+	# Return response.
+	r = HttpResponse(body, content_type=mime_type)
+	r["Content-Length"] = len(body)
+	return r
+
+def render_vote_image(vote, image_type):
+	# Renders a vote image, see vote.image_store. Raises Http404 if the
+	# vote doesn't have this sort of image.
 	if image_type == "map":
 		# SVG map.
 		body, mime_type = vote_thumbnail_image_map(vote)
@@ -242,11 +193,7 @@ def vote_thumbnail_image(request, congress, session, chamber_code, number, image
 		body, mime_type = vote_thumbnail_wide(vote)
 	else:
 		raise Http404()
-
-	# Return response.
-	r = HttpResponse(body, content_type=mime_type)
-	r["Content-Length"] = len(body)
-	return r
+	return body, mime_type
 
 vote_diagram_colors = { # see also person.views.membersoverview
 	("D", "+"): (0/255.0, 142/255.0, 209/255.0), # same as CSS color
@@ -647,9 +594,9 @@ def vote_thumbnail_image_seating_diagram(vote, image_width=330, image_height=190
 
     # See if we have ideology scores.
 	voter_details = None
+	load_ideology_scores(vote.congress)
+	ideology_scores = vote_analysis.ideology_scores
 	if True:
-		global ideology_scores
-		load_ideology_scores(vote.congress)
 		if ideology_scores[vote.congress]:
 			voter_details = [ ]
 			
@@ -918,7 +865,7 @@ def vote_comparison_table_arbitrary_add(request):
         raise Http404()
     return HttpResponseRedirect("/congress/votes/compare/" + ",".join(v.congressproject_id for v in vote_comparison_list))
 
-def get_vote_matrix(votes, filter_people=None, tqdm=lambda _ : _):
+def get_vote_matrix(votes, filter_people=None, tqdm=lambda _ : _, use_store=True):
 	# Convert votes array to Vote instances with extra fields attached as instance fields.
 	# votes is an array of tuples of the form
 	# (Vote instance | Vote id, Vote slug, { extra dict info })
@@ -956,6 +903,12 @@ def get_vote_matrix(votes, filter_people=None, tqdm=lambda _ : _):
 
 	votes = [fetch_vote(item) for item in votes]
 
+	# Get the voters from the vote matrix store for the votes that are up to
+	# date in it, which takes a few queries in total rather than a query for
+	# each vote. Other votes fall back to the database.
+	from vote.matrix_store import get_stored_voters
+	stored_voters = get_stored_voters(votes) if use_store else { }
+
 	# For each vote, make a list of all of the votes except that one for "Remove" links.
 	for vote in votes:
 		vote.comparison_remove_me_list = ",".join([vote2.congressproject_id for vote2 in votes if vote2 != vote])
@@ -967,7 +920,10 @@ def get_vote_matrix(votes, filter_people=None, tqdm=lambda _ : _):
 	if not filter_people:
 		party_totals = { }
 		for i, vote in enumerate(votes):
-			totals = vote.totals()
+			if vote.id in stored_voters:
+				totals = vote.totals(voters=stored_voters[vote.id][0], options=stored_voters[vote.id][1])
+			else:
+				totals = vote.totals()
 			for party, party_total in zip(totals['parties'], totals['party_counts']):
 				pt = party_totals.setdefault(party, {
 					"party": party,
@@ -986,7 +942,11 @@ def get_vote_matrix(votes, filter_people=None, tqdm=lambda _ : _):
 
 	voters = { }
 	for i, vote in enumerate(tqdm(votes)):
-		for voter in vote.get_voters(filter_people=filter_people):
+		if vote.id in stored_voters:
+			vote_voters = vote.get_voters(filter_people=filter_people, voters=stored_voters[vote.id][0])
+		else:
+			vote_voters = vote.get_voters(filter_people=filter_people)
+		for voter in vote_voters:
 			if filter_people and voter.person not in filter_people: continue
 			v = voters.setdefault(voter.person_id, {
 				"person": voter.person,
@@ -64,8 +64,9 @@ def index(request):
     from bill.models import Bill
     dhg_bills = Bill.objects.filter(congress=settings.CURRENT_CONGRESS, docs_house_gov_postdate__gt=datetime.now() - timedelta(days=10)).filter(docs_house_gov_postdate__gt=F('current_status_date'))
     sfs_bills = Bill.objects.filter(congress=settings.CURRENT_CONGRESS, senate_floor_schedule_postdate__gt=datetime.now() - timedelta(days=5)).filter(senate_floor_schedule_postdate__gt=F('current_status_date'))
-    coming_up = list((dhg_bills | sfs_bills))
-    coming_up.sort(key = lambda bill : -bill.proscore())
+    coming_up = list((dhg_bills | sfs_bills).select_related("sponsor", "sponsor_role"))
+    proscores = Bill.proscores(coming_up)
+    coming_up.sort(key = lambda bill : -proscores[bill.id])
     if len(coming_up) > 0:
         post_groups.append({
             "title": "Legislation Coming Up",